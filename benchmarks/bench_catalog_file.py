@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Startup and lookup benchmark for `snakebyte.catalog_file`
+
+Builds a synthetic catalog (without touching the filesystem), saves it, and
+compares how long it takes to become usable again by opening the mapped
+file versus unpickling the same entries into a `FileCatalog`, along with
+``arg_test_cb`` lookup rates for each.
+
+Run from the root of the source tree::
+
+    python benchmarks/bench_catalog_file.py [entries]
+"""
+
+__author__  = "Stephan Sokolow (deitarion/SSokolow)"
+__license__ = "GNU GPL 3.0 or later"
+__docformat__ = "restructuredtext en"
+
+import os, pickle, random, shutil, sys, tempfile
+from timeit import default_timer
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from snakebyte.catalog import CatalogEntry, FileCatalog
+from snakebyte.catalog_file import MappedCatalog, write_catalog
+
+ROOT = '/srv/share'
+
+def make_entries(count, seed=0):
+    """Generate ``count`` plausible `CatalogEntry` objects"""
+    rng, entries = random.Random(seed), []
+    for pos in range(count):
+        path = 'Series %03d/Season %02d/Episode %05d [%08X].mkv' % (
+               rng.randint(0, 999), rng.randint(1, 20), pos,
+               rng.getrandbits(32))
+        entries.append(CatalogEntry(path, ROOT + '/' + path,
+                                    rng.randint(0, 2 ** 32), 1.5e9 + pos))
+    return entries
+
+def timed(label, func):
+    """Call ``func`` once, print how long it took, and return its result"""
+    start = default_timer()
+    result = func()
+    print("%-32s %10.2f ms" % (label, (default_timer() - start) * 1000))
+    return result
+
+def lookups(label, catalog, queries):
+    """Report ``arg_test_cb`` calls per second over ``queries``"""
+    test = catalog.arg_test_cb
+    start = default_timer()
+    for query in queries:
+        test(query, None)
+    print("%-32s %10.0f lookups/sec" % (label,
+          len(queries) / (default_timer() - start)))
+
+def main(argv):
+    """Build, save, and reload a catalog of the requested size"""
+    count = int(argv[1]) if len(argv) > 1 else 200000
+    entries = make_entries(count)
+    live = FileCatalog([ROOT])
+    live.seed(entries)
+
+    rng = random.Random(1)
+    queries = [rng.choice(entries).path[:rng.randint(5, 60)]
+               for _ in range(50000)]
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        mapped_path = os.path.join(tmpdir, 'catalog.bin')
+        pickle_path = os.path.join(tmpdir, 'catalog.pickle')
+        print("%d entries\n" % count)
+        timed("write_catalog", lambda: write_catalog(live, mapped_path))
+        with open(pickle_path, 'wb') as fobj:
+            timed("pickle.dump", lambda: pickle.dump(entries, fobj, -1))
+        print("%-32s %10.1f MiB" % ("mapped file size",
+              os.path.getsize(mapped_path) / 1048576.0))
+
+        mapped = timed("open MappedCatalog",
+                       lambda: MappedCatalog(mapped_path))
+
+        def unpickle():
+            with open(pickle_path, 'rb') as fobj:
+                catalog = FileCatalog([ROOT])
+                catalog.seed(pickle.load(fobj))
+            return catalog
+        unpickled = timed("unpickle + build FileCatalog", unpickle)
+
+        print('')
+        lookups("MappedCatalog.arg_test_cb", mapped, queries)
+        lookups("FileCatalog.arg_test_cb", unpickled, queries)
+        mapped.close()
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Throughput benchmark for `snakebyte.framing`
+
+Run from the root of the source tree::
+
+    python benchmarks/bench_framing.py [megabytes]
+"""
+
+__author__  = "Stephan Sokolow (deitarion/SSokolow)"
+__license__ = "GNU GPL 3.0 or later"
+__docformat__ = "restructuredtext en"
+
+import os, random, sys, time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from snakebyte.framing import LineFramer
+
+#: Templates for the mix of traffic seen in a busy fserve channel
+TEMPLATES = [
+    b':nick%d!user@host.example PRIVMSG #fserve :!get Some Show S01E%02d.mkv',
+    b':nick%d!user@host.example PRIVMSG #fserve :lol that was episode %d',
+    b':nick%d!user@host.example JOIN #fserve %d',
+    b'@time=2013-01-01T00:00:00.000Z :srv PRIVMSG #fserve :!queue %d %d',
+    b'PING :irc%d.example.net %d',
+]
+
+def make_stream(size):
+    """Generate roughly ``size`` bytes of CRLF-terminated IRC traffic"""
+    rng, lines, total = random.Random(0), [], 0
+    while total < size:
+        line = rng.choice(TEMPLATES) % (rng.randint(0, 999),
+                                        rng.randint(0, 99)) + b'\r\n'
+        lines.append(line)
+        total += len(line)
+    return b''.join(lines)
+
+def bench(label, stream, chunk_size, consume):
+    """Feed ``stream`` in ``chunk_size`` pieces and report MB/s"""
+    chunks = [stream[x:x + chunk_size]
+              for x in range(0, len(stream), chunk_size)]
+    framer, count = LineFramer(), 0
+    start = time.time()
+    for chunk in chunks:
+        count += consume(framer, chunk)
+    elapsed = time.time() - start
+    print("%-28s %6d-byte chunks: %8.1f MB/s (%d messages)" % (
+          label, chunk_size, len(stream) / elapsed / 1e6, count))
+
+def frame_only(framer, chunk):
+    """Consume messages without looking at them"""
+    count = 0
+    for _ in framer.feed(chunk):
+        count += 1
+    return count
+
+def frame_and_decode(framer, chunk):
+    """Consume messages and decode their command and trailing parameter"""
+    count = 0
+    for message in framer.feed(chunk):
+        if message.command == 'PRIVMSG':
+            message.trailing
+        count += 1
+    return count
+
+def frame_and_lex(framer, chunk):
+    """Consume messages, tokenizing PRIVMSGs with the POSIX lexer"""
+    count = 0
+    for _ in framer.feed_lexed(chunk):
+        count += 1
+    return count
+
+if __name__ == '__main__':
+    megabytes = float(sys.argv[1]) if len(sys.argv) > 1 else 8
+    stream = make_stream(int(megabytes * 1e6))
+
+    for chunk_size in (4096, 65536):
+        bench("framing", stream, chunk_size, frame_only)
+        bench("framing + decoding", stream, chunk_size, frame_and_decode)
+        bench("framing + decoding + lexing", stream, chunk_size,
+              frame_and_lex)
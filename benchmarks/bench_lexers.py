@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Micro-benchmark comparing `snakebyte.shell_lexers` against ``shlex``
+
+Run from the root of the source tree::
+
+    python benchmarks/bench_lexers.py [iterations]
+"""
+
+__author__  = "Stephan Sokolow (deitarion/SSokolow)"
+__license__ = "GNU GPL 3.0 or later"
+__docformat__ = "restructuredtext en"
+
+import os, shlex, sys, timeit
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from snakebyte.shell_lexers import ARG_PREFIX, posix_lexer, smart_lexer
+
+#: Command lines of the kind an fserve sees during a join flood
+SAMPLE_LINES = [
+    '!list',
+    '!queue',
+    '!get Some.Show.S01E01.720p.mkv',
+    '!get "The O\'Neill Story (1998) [DVDRip].avi"',
+    "!get 'My Favourite Album - 01 - Track.flac'",
+    '!get Linux\\ ISOs/debian-7.0.0-amd64-netinst.iso',
+    '!find --exact "season 2" episode',
+    '!remove 3',
+]
+
+#: Names a prefix-aware ``arg_test_cb`` will accept in the smart lexer run
+SHARED_FILES = set(['Some Very Long Album Name - %02d - Track Title.flac' % x
+                    for x in range(0, 20)])
+SHARED_PREFIXES = set(x[:y] for x in SHARED_FILES for y in range(len(x)))
+
+def prefix_cb(candidate_str, argv):
+    """Stand-in for a catalog lookup that counts how often it's called"""
+    prefix_cb.calls += 1
+    if candidate_str in SHARED_FILES:
+        return True
+    return ARG_PREFIX if candidate_str in SHARED_PREFIXES else False
+prefix_cb.prefix_aware, prefix_cb.calls = True, 0
+
+def plain_cb(candidate_str, argv):
+    """Like `prefix_cb` but without the prefix hinting"""
+    plain_cb.calls += 1
+    return candidate_str in SHARED_FILES
+plain_cb.calls = 0
+
+def bench(func, iterations):
+    """Return the average number of microseconds ``func`` takes per line"""
+    def run():
+        for line in SAMPLE_LINES:
+            func(line)
+    seconds = min(timeit.repeat(run, number=iterations, repeat=3))
+    return seconds / (iterations * len(SAMPLE_LINES)) * 1e6
+
+if __name__ == '__main__':
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+
+    for line in SAMPLE_LINES:
+        assert posix_lexer(line, {}) == shlex.split(line), line
+
+    reference = bench(shlex.split, iterations)
+    candidate = bench(lambda x: posix_lexer(x, {}), iterations)
+    print("shlex.split: %8.2f usec/line" % reference)
+    print("posix_lexer: %8.2f usec/line (%.1fx faster)" %
+          (candidate, reference / candidate))
+
+    # Smart lexer on long lines with lots of spaces
+    print("\nsmart_lexer on '!get' lines naming N files with spaces:")
+    for count in (1, 5, 20):
+        line = '!get ' + ' '.join(sorted(SHARED_FILES)[:count])
+        words = len(line.split())
+        for name, callback in (('plain', plain_cb), ('prefix', prefix_cb)):
+            commands = {'!get': ([], callback)}
+            assert len(smart_lexer(line, commands)) == count + 1
+            callback.calls = 0
+            smart_lexer(line, commands)
+            calls = callback.calls
+
+            seconds = min(timeit.repeat(lambda: smart_lexer(line, commands),
+                                        number=iterations // 10, repeat=3))
+            print("  %6s cb, %3d words: %9.2f usec/line, %4d calls "
+                  "(N**2 = %d)" % (name, words,
+                      seconds / (iterations // 10) * 1e6, calls, words ** 2))
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Fairness benchmark for privilege classes in `snakebyte.queue`
+
+Simulates a busy fserve: users of each class arrive at random, queue a few
+files each, and a fixed number of send slots serve the queue. It then
+reports how long requests from each class waited, with and without class
+weights. Plain round-robin should treat every class alike, while weighted
+scheduling should shorten privileged waits without any class's worst case
+growing without bound.
+
+Also reports the cost of `FairQueue.set_class` as the queue grows.
+
+Run from the root of the source tree::
+
+    python benchmarks/bench_queue_classes.py [requests]
+"""
+
+__author__  = "Stephan Sokolow (deitarion/SSokolow)"
+__license__ = "GNU GPL 3.0 or later"
+__docformat__ = "restructuredtext en"
+
+import heapq, itertools, os, random, sys
+from timeit import default_timer
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from snakebyte.queue import FairQueue
+
+WEIGHTS = {'op': 4, 'voice': 2, 'regular': 1}
+
+#: (class, share of arriving users)
+MIX = [('op', 0.1), ('voice', 0.2), ('regular', 0.7)]
+
+SLOTS = 4
+MEAN_SEND = 60.0     #: Mean seconds per file sent
+FILES_PER_USER = 5
+
+def percentile(values, fraction):
+    """Return the value ``fraction`` of the way through sorted ``values``"""
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+def simulate(requests, weighted, seed=0):
+    """Run the simulation until ``requests`` files have been sent.
+
+    :returns: ``{class: [wait_seconds, ...]}``
+    """
+    rng, users = random.Random(seed), itertools.count()
+    classes, waits = {}, dict((x, []) for x in WEIGHTS)
+
+    now, ticks = [0.0], itertools.count()
+    if weighted:
+        queue = FairQueue(class_weights=WEIGHTS, class_cb=classes.get)
+    else:
+        # Simulated time, with a counter to break ties deterministically
+        queue = FairQueue(priority_cb=lambda key: (now[0], next(ticks)))
+
+    # Arrivals nearly match service so that the queue stays busy
+    arrival_rate = SLOTS / MEAN_SEND / FILES_PER_USER * 0.95
+    events = [(rng.expovariate(arrival_rate), 'arrive')]
+    free_slots, sent = SLOTS, 0
+
+    while sent < requests:
+        now[0], kind = heapq.heappop(events)
+        if kind == 'arrive':
+            user, roll = next(users), rng.random()
+            for cls, share in MIX:  # pragma: no branch
+                roll -= share
+                if roll < 0:
+                    break
+            classes[user] = cls
+            queue.extend(user, [now[0]] * FILES_PER_USER)
+            heapq.heappush(events, (now[0] + rng.expovariate(arrival_rate),
+                                    'arrive'))
+        else:
+            free_slots += 1
+
+        while free_slots and queue:
+            user, queued_at = queue.pop()
+            waits[classes[user]].append(now[0] - queued_at)
+            heapq.heappush(events, (now[0] + rng.expovariate(1 / MEAN_SEND),
+                                    'done'))
+            free_slots -= 1
+            sent += 1
+    return waits
+
+def report(label, waits):
+    """Print per-class wait statistics in minutes"""
+    print(label)
+    for cls in sorted(WEIGHTS, key=WEIGHTS.get, reverse=True):
+        values = [x / 60 for x in waits[cls]]
+        print("  %-8s %6d sent  mean %7.1f  p50 %7.1f  p95 %7.1f  "
+              "max %7.1f min" % (
+                  cls, len(values), sum(values) / len(values),
+                  percentile(values, 0.5), percentile(values, 0.95),
+                  max(values)))
+
+def time_set_class(size, calls=20000):
+    """Time `FairQueue.set_class` on a queue of ``size`` buckets"""
+    queue = FairQueue(class_weights=WEIGHTS)
+    for key in range(size):
+        queue.push(key, None)
+    rng = random.Random(size)
+    keys = [rng.randrange(size) for _ in range(calls)]
+    names = [rng.choice(list(WEIGHTS)) for _ in range(calls)]
+
+    start = default_timer()
+    for key, cls in zip(keys, names):
+        queue.set_class(key, cls)
+    elapsed = default_timer() - start
+    print("  %7d buckets: %6.2f us per call" % (size,
+          elapsed / calls * 1e6))
+
+def main(argv):
+    """Compare round-robin and weighted waits, then time set_class"""
+    requests = int(argv[1]) if len(argv) > 1 else 50000
+    print("%d files through %d slots, weights %s\n" % (requests, SLOTS,
+          ', '.join('%s=%d' % x for x in sorted(WEIGHTS.items()))))
+    report("Round-robin (no classes):", simulate(requests, False))
+    report("Weighted classes:", simulate(requests, True))
+
+    print("\nFairQueue.set_class:")
+    for size in (1000, 10000, 100000):
+        time_set_class(size)
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmark for `snakebyte.scanner` on a synthetic deep directory tree
+
+Compares a serial ``os.walk`` rescan of a `FileCatalog` with a
+`ShareScanner`-driven one, both for the initial scan and for a rescan of an
+unchanged tree.
+
+Local disks answer too quickly to show what parallelism buys on network
+mounts, so ``--delay`` adds an artificial per-directory listing latency
+(applied to ``os.scandir``, which ``os.walk`` uses too).
+
+Run from the root of the source tree::
+
+    python benchmarks/bench_scanner.py [--depth N] [--fanout N]
+        [--files N] [--delay MS]
+"""
+
+__author__  = "Stephan Sokolow (deitarion/SSokolow)"
+__license__ = "GNU GPL 3.0 or later"
+__docformat__ = "restructuredtext en"
+
+import os, shutil, sys, tempfile, time
+from timeit import default_timer
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from snakebyte.catalog import FileCatalog
+from snakebyte.scanner import ShareScanner
+
+def make_tree(root, depth, fanout, files):
+    """Create ``fanout ** depth`` leaf directories with ``files`` files in
+    every directory, backdated so the scanner may trust their mtimes.
+
+    :returns: The number of directories created.
+    """
+    count, level = 1, [root]
+    for _ in range(depth):
+        next_level = []
+        for parent in level:
+            for pos in range(fanout):
+                path = os.path.join(parent, 'dir%02d' % pos)
+                os.mkdir(path)
+                next_level.append(path)
+        level = next_level
+        count += len(level)
+
+    for dirpath, _, _ in os.walk(root):
+        for pos in range(files):
+            path = os.path.join(dirpath, 'file%03d.bin' % pos)
+            with open(path, 'w') as fobj:
+                fobj.write('x' * pos)
+    for dirpath, _, _ in os.walk(root):
+        os.utime(dirpath, (1000000000, 1000000000))
+    return count
+
+def add_latency(delay):
+    """Make every directory listing take at least ``delay`` seconds"""
+    real_scandir = os.scandir
+
+    def slow_scandir(*args, **kwargs):
+        time.sleep(delay)
+        return real_scandir(*args, **kwargs)
+    os.scandir = slow_scandir
+
+def timed_rescan(label, catalog):
+    """Rescan a catalog and print how long it took"""
+    start = default_timer()
+    changes = catalog.rescan()
+    elapsed = default_timer() - start
+    print("%-34s %8.3f s  (%d files added)" % (label, elapsed,
+          len(changes.added)))
+    return elapsed
+
+def main(argv):
+    """Build the tree and compare serial and parallel scans"""
+    from optparse import OptionParser
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option('--depth', type='int', default=4)
+    parser.add_option('--fanout', type='int', default=5)
+    parser.add_option('--files', type='int', default=10)
+    parser.add_option('--delay', type='float', default=2.0,
+                      help="Per-directory latency in ms (default: %default)")
+    parser.add_option('--workers', type='int', default=16)
+    parser.add_option('--per-device', type='int', default=8)
+    opts, _ = parser.parse_args(argv[1:])
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        dirs = make_tree(tmpdir, opts.depth, opts.fanout, opts.files)
+        print("%d directories, %d files, %.1fms listing latency\n" % (
+              dirs, dirs * opts.files, opts.delay))
+        if opts.delay:
+            add_latency(opts.delay / 1000.0)
+
+        serial = FileCatalog([tmpdir])
+        scanner = ShareScanner(opts.workers, opts.per_device)
+        parallel = FileCatalog([tmpdir], scanner=scanner)
+
+        timed_rescan("os.walk: initial scan", serial)
+        timed_rescan("ShareScanner: initial scan", parallel)
+        timed_rescan("os.walk: unchanged rescan", serial)
+        timed_rescan("ShareScanner: unchanged rescan", parallel)
+        print("%-34s %8d listed, %d reused" % ("", scanner.listed,
+                                              scanner.reused))
+        assert list(serial) == list(parallel)
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Loopback benchmark for `snakebyte.shaping` with `snakebyte.transfer`
+
+Sends files to local DCC receivers through a shaped `TransferEngine` and
+compares the throughput each user and the whole engine achieved against the
+configured limits. Also reports the cost of one `BandwidthShaper.grant`.
+
+Run from the root of the source tree::
+
+    python benchmarks/bench_shaping.py [megabytes_per_file]
+"""
+
+__author__  = "Stephan Sokolow (deitarion/SSokolow)"
+__license__ = "GNU GPL 3.0 or later"
+__docformat__ = "restructuredtext en"
+
+import os, shutil, socket, struct, sys, tempfile, threading, time
+from timeit import default_timer
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from snakebyte.queue import FairQueue
+from snakebyte.shaping import BandwidthShaper
+from snakebyte.transfer import TransferEngine
+
+MB = 1024 * 1024
+
+#: (label, global_rate, bucket_rate, slot_rate) in MB/s
+SCENARIOS = [
+    ('global only', 16, None, None),
+    ('global + per-bucket', 16, 6, None),
+    ('global + per-slot', 16, None, 3),
+    ('all three', 12, 6, 4),
+]
+
+#: Users and how many files each queues (and hence slots they occupy)
+USERS = [('alice', 3), ('bob', 1), ('carol', 1)]
+
+def receive(port, size):
+    """Drain one DCC SEND, acknowledging as a real client would"""
+    sock = socket.create_connection(('127.0.0.1', port))
+    received = 0
+    while received < size:
+        data = sock.recv(65536)
+        if not data:
+            break
+        received += len(data)
+        sock.sendall(struct.pack('!I', received % 2 ** 32))
+    sock.recv(1)
+    sock.close()
+
+def offer(transfer):
+    """Connect a receiver thread to a newly offered transfer"""
+    thread = threading.Thread(target=receive,
+                              args=(transfer.port, transfer.size))
+    thread.daemon = True
+    thread.start()
+
+def run_scenario(path, label, global_rate, bucket_rate, slot_rate):
+    """Run every user's transfers at once and print achieved rates"""
+    def mbps(rate):
+        return None if rate is None else rate * MB
+
+    queue, done = FairQueue(), []
+    for user, count in USERS:
+        queue.extend(user, [path] * count)
+
+    shaper = BandwidthShaper(mbps(global_rate), mbps(bucket_rate),
+                             mbps(slot_rate))
+    engine = TransferEngine(queue, slots=sum(x[1] for x in USERS),
+                            host='127.0.0.1', offer_cb=offer,
+                            done_cb=done.append, shaper=shaper)
+    start = time.time()
+    engine.run_until_idle(timeout=0.1)
+    elapsed = time.time() - start
+    engine.close()
+
+    print("\n%s (global=%s, bucket=%s, slot=%s MB/s)" % (
+          label, global_rate, bucket_rate, slot_rate))
+    for user, _ in USERS:
+        mine = [x for x in done if x.key == user]
+        rates = ', '.join('%.2f' % (x.bytes_sent / x.duration / MB)
+                          for x in mine)
+        span = max(x.finished for x in mine) - min(x.started for x in mine)
+        print("  %-6s slots: %s MB/s  (combined %.2f)" % (user, rates,
+              sum(x.bytes_sent for x in mine) / span / MB))
+    total = sum(x.bytes_sent for x in done)
+    print("  total: %.2f MB/s over %.2fs" % (total / elapsed / MB, elapsed))
+
+def bench_grant(count=200000):
+    """Report the average cost of one grant() call"""
+    shaper = BandwidthShaper(1e12, 1e12, 1e12)
+    for slot in range(8):
+        shaper.register(slot, slot % 4)
+    grant = shaper.grant
+    start = default_timer()
+    for pos in range(count):
+        grant(pos & 7, 65536)
+    print("\ngrant(): %.2f us per call" %
+          ((default_timer() - start) / count * 1e6))
+
+def main(argv):
+    """Create a test file and run every scenario"""
+    size = int(float(argv[1]) * MB) if len(argv) > 1 else 8 * MB
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, 'payload.bin')
+        with open(path, 'wb') as fobj:
+            fobj.write(os.urandom(size))
+        for scenario in SCENARIOS:
+            run_scenario(path, *scenario)
+    finally:
+        shutil.rmtree(tmpdir)
+    bench_grant()
+
+if __name__ == '__main__':
+    main(sys.argv)
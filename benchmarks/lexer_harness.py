@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Differential benchmark and fuzzing harness for all registered lexers
+
+Generates corpora of realistic and adversarial fserve command lines, runs
+every lexer in `snakebyte.shell_lexers.LEXERS` over them, and reports:
+
+ - Throughput (lines per second) and latency percentiles per lexer
+ - Lines where a lexer's output or error differs from ``shlex.split``
+
+Differences are expected for lexers which deliberately deviate from POSIX
+rules (``mirc`` always, ``smart`` whenever hints apply), so the exit code
+only reflects lexers listed with ``--strict`` (``posix`` by default).
+
+Run from the root of the source tree::
+
+    python benchmarks/lexer_harness.py [--lines N] [--seed N] [--strict NAME]
+"""
+
+__author__  = "Stephan Sokolow (deitarion/SSokolow)"
+__license__ = "GNU GPL 3.0 or later"
+__docformat__ = "restructuredtext en"
+
+import os, random, shlex, sys
+from timeit import default_timer
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from snakebyte.shell_lexers import LEXERS
+
+COMMANDS = ['!get', '!list', '!queue', '!find', '!remove', '!help']
+WORDS = ['Some', 'Show', 'S01E01', '720p.mkv', "O'Neill", 'The', 'story.txt',
+         u'Caf\xe9', u'東京', u'\U0001f600', '#1.epub', '-v', '--all',
+         '(2001)', '[DVDRip]', 'A&B', '$HOME', '*.avi', '100%']
+
+#: Characters which stress quoting and escaping rules
+NASTY = ['"', "'", '\\', ' ', '\t', '\r', '\n', '\x0b', u'\xa0', '#']
+
+def realistic_line(rng):
+    """A command line of the kind real users type"""
+    words = [rng.choice(WORDS) for _ in range(rng.randint(0, 6))]
+    style = rng.random()
+    if style < 0.2 and words:
+        words = ['"%s"' % ' '.join(words)]
+    elif style < 0.3 and words:
+        words = ["'%s'" % ' '.join(words).replace("'", '')]
+    elif style < 0.4 and words:
+        words = ['\\ '.join(words)]
+    return ' '.join([rng.choice(COMMANDS)] + words)
+
+def adversarial_line(rng):
+    """A short line built mostly from quoting and whitespace characters"""
+    pool = NASTY + list('ab')
+    return u''.join(rng.choice(pool) for _ in range(rng.randint(0, 16)))
+
+def long_line(rng):
+    """A very long line with many spaces"""
+    return ' '.join([rng.choice(COMMANDS)] +
+                    [rng.choice(WORDS) for _ in range(rng.randint(100, 400))])
+
+def make_corpus(count, seed=0):
+    """Generate ``count`` lines: 80% realistic, 18% adversarial, 2% long"""
+    rng, corpus = random.Random(seed), []
+    for _ in range(count):
+        roll = rng.random()
+        if roll < 0.8:
+            corpus.append(realistic_line(rng))
+        elif roll < 0.98:
+            corpus.append(adversarial_line(rng))
+        else:
+            corpus.append(long_line(rng))
+    return corpus
+
+def make_commands():
+    """A ``commands`` table whose hints accept every WORDS combination so
+    that hint-following lexers actually take their slow paths."""
+    known = set(WORDS)
+
+    def arg_test_cb(candidate_str, argv):
+        return all(x in known for x in candidate_str.split())
+    return dict((x, (['-v', '--all'], arg_test_cb)) for x in COMMANDS)
+
+def outcome(func, line):
+    """Run a lexer, reducing errors to a comparable value"""
+    try:
+        return func(line)
+    except ValueError as err:
+        return ('ValueError', str(err))
+
+def percentile(sorted_values, fraction):
+    """Return the value at ``fraction`` through an already-sorted list"""
+    pos = min(len(sorted_values) - 1, int(fraction * len(sorted_values)))
+    return sorted_values[pos]
+
+def run(corpus, commands, lexers=None):
+    """Run each lexer over the corpus, timing every line.
+
+    :returns: A dict mapping lexer names to ``(timings, differences)`` where
+        ``differences`` lists ``(line, expected, actual)`` tuples.
+    """
+    reference = [outcome(shlex.split, x) for x in corpus]
+    results = {}
+    for lexer in lexers or LEXERS:
+        timings, differences = [], []
+        for line, expected in zip(corpus, reference):
+            start = default_timer()
+            actual = outcome(lambda x: lexer(x, commands), line)
+            timings.append(default_timer() - start)
+            if actual != expected:
+                differences.append((line, expected, actual))
+        results[lexer.name] = (timings, differences)
+    return results
+
+def clip(value, length=100):
+    """Shorten the ``repr`` of long sample lines"""
+    text = repr(value)
+    return text if len(text) <= length else text[:length - 3] + '...'
+
+def report(results, show=3):
+    """Print a summary table followed by sample differences"""
+    print("%-8s %12s %9s %9s %9s %9s %7s" % ('lexer', 'lines/sec',
+          'p50 us', 'p99 us', 'p99.9 us', 'max us', 'diffs'))
+    for name, (timings, differences) in sorted(results.items()):
+        ordered = sorted(timings)
+        print("%-8s %12.0f %9.1f %9.1f %9.1f %9.1f %7d" % (name,
+              len(timings) / sum(timings),
+              percentile(ordered, 0.5) * 1e6,
+              percentile(ordered, 0.99) * 1e6,
+              percentile(ordered, 0.999) * 1e6,
+              ordered[-1] * 1e6, len(differences)))
+
+    for name, (_, differences) in sorted(results.items()):
+        for line, expected, actual in differences[:show]:
+            print("\n[%s] %s\n  shlex: %s\n  %s: %s" % (
+                  name, clip(line), clip(expected), name, clip(actual)))
+
+def main(argv):
+    """Parse arguments, run the harness, and return an exit code"""
+    from optparse import OptionParser
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option('--lines', type='int', default=20000,
+                      help="Corpus size (default: %default)")
+    parser.add_option('--seed', type='int', default=0,
+                      help="Random seed for the corpus (default: %default)")
+    parser.add_option('--strict', action='append', default=[],
+                      help="Fail if this lexer differs from shlex. May be "
+                           "repeated. (default: posix)")
+    opts, _ = parser.parse_args(argv[1:])
+
+    unknown = set(opts.strict) - set(x.name for x in LEXERS)
+    if unknown:
+        parser.error("Unknown lexer(s) for --strict: %s (choose from %s)" % (
+            ', '.join(sorted(unknown)),
+            ', '.join(sorted(x.name for x in LEXERS))))
+
+    results = run(make_corpus(opts.lines, opts.seed), make_commands())
+    report(results)
+
+    failed = [x for x in opts.strict or ['posix'] if results[x][1]]
+    if failed:
+        print("\nFAILED: %s differ from shlex" % ', '.join(failed))
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
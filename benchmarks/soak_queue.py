@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Soak test for `snakebyte.queue.FairQueue`
+
+Runs millions of randomized queue operations against a population of
+users which slowly churns (old keys stop being used as new ones arrive,
+like users leaving and joining a channel) and, once per window of
+operations, records:
+
+ - memory allocated by ``snakebyte/queue.py`` according to ``tracemalloc``
+ - heap entries versus live buckets, plus the size of every other
+   per-bucket structure the queue keeps
+ - latency percentiles for each kind of operation
+
+The operation mix includes the awkward cases: replacing existing buckets
+with ``__setitem__``, emptying buckets through the lists `__getitem__`
+returns, occasional `clear` calls, and deleting subqueues behind the
+queue's back to exercise `pop`'s "in heap but not subqueues" recovery.
+
+The queue's contents are kept roughly constant, so after warm-up nothing
+should grow. The run fails (exit status 1) if memory, the heap/bucket gap,
+or latency trends upward over the measured windows, or if per-bucket
+bookkeeping outlives its bucket.
+
+Run from the root of the source tree::
+
+    python benchmarks/soak_queue.py [--ops N] [--window N] [--classes]
+"""
+
+__author__  = "Stephan Sokolow (deitarion/SSokolow)"
+__license__ = "GNU GPL 3.0 or later"
+__docformat__ = "restructuredtext en"
+
+import logging, os, random, sys, time, tracemalloc
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from snakebyte import queue as queue_module
+from snakebyte.queue import FairQueue
+
+WEIGHTS = {'op': 4, 'voice': 2}
+
+def percentile(values, fraction):
+    """Return the value ``fraction`` of the way through sorted ``values``"""
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+def slope(values):
+    """Least-squares slope of ``values`` against their index"""
+    count = len(values)
+    mean_x, mean_y = (count - 1) / 2.0, sum(values) / float(count)
+    num = sum((x - mean_x) * (y - mean_y) for x, y in enumerate(values))
+    den = sum((x - mean_x) ** 2 for x in range(count))
+    return num / den if den else 0.0
+
+class Soak(object):
+    """Drives randomized operations and gathers per-window measurements"""
+
+    def __init__(self, opts):
+        self.opts, self.rng = opts, random.Random(opts.seed)
+        if opts.classes:
+            self.queue = FairQueue(class_weights=WEIGHTS,
+                                   class_cb=lambda key: None)
+        else:
+            self.queue = FairQueue()
+        self.done, self.windows = 0, []
+
+        #: ``(name, weight, operation)``
+        ops = [
+            ('push', 30, self.op_push),
+            ('extend', 8, self.op_extend),
+            ('pop', 34, self.op_pop),
+            ('pop_key', 8, self.op_pop_key),
+            ('setitem', 6, self.op_setitem),
+            ('delitem', 4, self.op_delitem),
+            ('record', 5, self.op_record),
+            ('empty', 2, self.op_empty),
+            ('desync', 1, self.op_desync),
+            ('clear', 0.0001, self.op_clear),
+        ]
+        if opts.classes:
+            ops.append(('set_class', 5, self.op_set_class))
+        self.names = [x[0] for x in ops]
+        self.funcs = [x[2] for x in ops]
+        self.weights = [x[1] for x in ops]
+
+    def key(self):
+        """Pick a user from the currently active (slowly churning) set"""
+        return self.done // self.opts.churn + self.rng.randrange(
+                self.opts.users)
+
+    def live_key(self):
+        """Pick a user who (probably) has a bucket"""
+        keys = self.queue._buckets
+        return keys[self.rng.randrange(len(keys))][1] if keys else self.key()
+
+    def op_push(self):
+        self.queue.push(self.key(), 'file')
+
+    def op_extend(self):
+        count = self.rng.randrange(5)
+        self.queue.extend(self.key(), ['file'] * count)
+
+    def op_pop(self):
+        try:
+            self.queue.pop()
+        except IndexError:
+            pass
+
+    def op_pop_key(self):
+        try:
+            self.queue.pop(self.live_key())
+        except (IndexError, KeyError):
+            pass
+
+    def op_setitem(self):
+        key = self.live_key() if self.rng.random() < 0.5 else self.key()
+        self.queue[key] = ['file'] * self.rng.randrange(4)
+
+    def op_delitem(self):
+        try:
+            del self.queue[self.live_key()]
+        except KeyError:
+            pass
+
+    def op_record(self):
+        self.queue.record_transfer(self.live_key(), 1000, 1.0)
+
+    def op_set_class(self):
+        try:
+            self.queue.set_class(self.live_key(),
+                                 self.rng.choice([None, 'op', 'voice']))
+        except KeyError:
+            pass
+
+    def op_empty(self):
+        try:
+            del self.queue[self.live_key()][:]
+        except KeyError:
+            pass
+
+    def op_desync(self):
+        self.queue._subqueues.pop(self.live_key(), None)
+
+    def op_clear(self):
+        self.queue.clear()
+
+    def run_window(self):
+        """Run one window of operations, recording their latencies"""
+        rng, names, funcs = self.rng, self.names, self.funcs
+        timer, latencies = time.perf_counter, {}
+        for name in names:
+            latencies[name] = []
+
+        for _ in range(0, self.opts.window, 1000):
+            # Hold the queue near its target size so that growth means leaks
+            weights = list(self.weights)
+            if len(self.queue) > self.opts.items:
+                weights[names.index('push')] = 10
+                weights[names.index('extend')] = 2
+            else:
+                weights[names.index('pop')] = 10
+
+            for pos in rng.choices(range(len(funcs)), weights, k=1000):
+                start = timer()
+                funcs[pos]()
+                latencies[names[pos]].append(timer() - start)
+            self.done += 1000
+        return latencies
+
+    def check_bookkeeping(self):
+        """Return problems with per-bucket structures outliving buckets"""
+        queue, problems = self.queue, []
+        if len(queue._positions) != len(queue._buckets):
+            problems.append("position index out of sync with the heap")
+        if not set(queue._classes) <= set(queue._positions):
+            problems.append("classes kept for buckets not in the heap")
+        if len(queue.transfer_stats) > queue.max_stats:
+            problems.append("transfer stats exceeded max_stats")
+        return problems
+
+    def measure(self, latencies):
+        """Record memory, structure sizes, and latency for a window"""
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+                [tracemalloc.Filter(True, queue_module.__file__)])
+        memory = sum(x.size for x in snapshot.statistics('filename'))
+
+        all_latencies = [x for v in latencies.values() for x in v]
+        row = {
+            'ops': self.done,
+            'memory': memory,
+            'heap': len(self.queue._buckets),
+            'live': len(self.queue._subqueues),
+            'items': len(self.queue),
+            'p50': percentile(all_latencies, 0.5) * 1e6,
+            'p99': percentile(all_latencies, 0.99) * 1e6,
+            'per_op': dict((name, percentile(v, 0.99) * 1e6)
+                           for name, v in latencies.items() if v),
+            'problems': self.check_bookkeeping(),
+            'snapshot': snapshot,
+        }
+        self.windows.append(row)
+        print("%10d %9.1f %7d %7d %8d %8.2f %8.2f  %s" % (row['ops'],
+              memory / 1024.0, row['heap'], row['live'], row['items'],
+              row['p50'], row['p99'], '; '.join(row['problems'])))
+        return row
+
+    def verdict(self):
+        """Look for upward trends after warm-up.
+
+        :returns: A list of failure descriptions.
+        """
+        measured = self.windows[int(len(self.windows) * self.opts.warmup):]
+        if len(measured) < 3:
+            return ["Too few windows to judge trends; raise --ops"]
+
+        failures, count = [], len(measured)
+        for row in self.windows:
+            for problem in row['problems']:
+                failures.append("%s (after %d ops)" % (problem, row['ops']))
+
+        memory = [x['memory'] for x in measured]
+        growth = slope(memory) * count
+        allowed = max(self.opts.memory_tolerance * sum(memory) / count,
+                      64 * 1024)
+        if growth > allowed:
+            failures.append("queue memory grew %.1f KiB over the run "
+                            "(allowed %.1f KiB)" % (
+                                growth / 1024.0, allowed / 1024.0))
+
+        gap = [x['heap'] - x['live'] for x in measured]
+        if slope(gap) * count > max(self.opts.users * 0.05, 10):
+            failures.append("heap entries without live buckets trended "
+                            "upward (%d -> %d)" % (gap[0], gap[-1]))
+
+        third = max(count // 3, 1)
+        for stat in ('p50', 'p99'):
+            early = sorted(x[stat] for x in measured[:third])[third // 2]
+            late = sorted(x[stat] for x in measured[-third:])[third // 2]
+            if late > early * self.opts.latency_tolerance + 1.0:
+                failures.append("%s latency rose from %.2fus to %.2fus" % (
+                                stat, early, late))
+
+        if failures:
+            growth = measured[-1]['snapshot'].compare_to(
+                    measured[0]['snapshot'], 'lineno')
+            print("\nLargest allocation changes in snakebyte/queue.py:")
+            for stat in growth[:5]:
+                print("  %s" % stat)
+        return failures
+
+def main(argv):
+    """Run the soak test and report whether anything trended upward"""
+    from optparse import OptionParser
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option('--ops', type='int', default=2000000,
+                      help="Total operations to run (default: %default)")
+    parser.add_option('--window', type='int', default=100000,
+                      help="Operations per measurement (default: %default)")
+    parser.add_option('--users', type='int', default=2000,
+                      help="Simultaneously active users (default: %default)")
+    parser.add_option('--churn', type='int', default=50,
+                      help="Operations per new user (default: %default)")
+    parser.add_option('--items', type='int', default=5000,
+                      help="Target number of queued items (default: %default)")
+    parser.add_option('--classes', action='store_true', default=False,
+                      help="Use weighted privilege classes")
+    parser.add_option('--warmup', type='float', default=0.2,
+                      help="Fraction of windows to ignore (default: %default)")
+    parser.add_option('--memory-tolerance', type='float', default=0.1,
+                      help="Allowed relative memory growth "
+                           "(default: %default)")
+    parser.add_option('--latency-tolerance', type='float', default=1.5,
+                      help="Allowed latency ratio (default: %default)")
+    parser.add_option('--seed', type='int', default=0)
+    opts, _ = parser.parse_args(argv[1:])
+
+    # The desync operation makes pop() log an error every time it recovers
+    logging.getLogger(queue_module.__name__).setLevel(logging.CRITICAL)
+
+    soak = Soak(opts)
+    tracemalloc.start()
+    print("%10s %9s %7s %7s %8s %8s %8s" % ('ops', 'KiB', 'heap', 'live',
+          'items', 'p50 us', 'p99 us'))
+    while soak.done < opts.ops:
+        soak.measure(soak.run_window())
+    tracemalloc.stop()
+
+    print("\np99 latency by operation in the final window (us):")
+    for name, value in sorted(soak.windows[-1]['per_op'].items()):
+        print("  %-10s %8.2f" % (name, value))
+
+    failures = soak.verdict()
+    if failures:
+        print("\nFAILED:\n  " + "\n  ".join(failures))
+        return 1
+    print("\nPASSED: no upward trends after %d operations" % soak.done)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
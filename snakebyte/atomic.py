@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Crash-safe saving of state files
+
+Everything SnakeByte persists between runs is rewritten in full on each
+save. `atomic_write` writes the new contents to a temporary file in the
+same directory, syncs it, and renames it over the old one, so a crash or
+full disk leaves either the old file or the new one but never a truncated
+mix. `write_json` and `read_json` build on it for the small versioned
+JSON stores.
+"""
+
+__author__  = "Stephan Sokolow (deitarion/SSokolow)"
+__license__ = "GNU GPL 3.0 or later"
+__docformat__ = "restructuredtext en"
+
+import json, logging, os, tempfile
+log = logging.getLogger(__name__)
+
+def atomic_write(path, write_cb, binary=False):
+    """Replace the file at ``path`` with whatever ``write_cb`` writes.
+
+    :Parameters:
+      path : `str`
+        The file to create or replace.
+      write_cb : ``function(fobj)``
+        Called with the temporary file object open for writing.
+      binary : `bool`
+        Open the temporary file in binary rather than text mode.
+
+    Any exception raised while writing removes the temporary file and
+    propagates, leaving ``path`` untouched.
+    """
+    dirname, basename = os.path.split(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix='.%s.' % basename)
+    try:
+        with os.fdopen(fd, 'wb' if binary else 'w') as fobj:
+            write_cb(fobj)
+            fobj.flush()
+            os.fsync(fobj.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+def write_json(path, version, entries):
+    """Atomically save a list of ``entries`` tagged with a format
+    ``version`` for `read_json`."""
+    atomic_write(path, lambda fobj: json.dump(
+        {'version': version, 'entries': entries}, fobj,
+        separators=(',', ':')))
+
+def read_json(path, version):
+    """Load the ``entries`` saved by `write_json`.
+
+    :raises IOError: The file couldn't be read.
+    :raises ValueError: The file isn't valid JSON or was saved with a
+        format version other than ``version``.
+    :raises KeyError: The file has no ``entries``.
+    """
+    with open(path) as fobj:
+        data = json.load(fobj)
+    if not isinstance(data, dict) or data.get('version') != version:
+        raise ValueError("Unsupported version: %r" % (
+            data.get('version') if isinstance(data, dict) else None))
+    return data['entries']
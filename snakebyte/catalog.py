@@ -0,0 +1,330 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""In-memory catalog of the files being served
+
+Provides a prefix trie of served paths which can answer the
+``arg_test_cb`` question asked by `snakebyte.shell_lexers` lexers
+("is this a valid filename, or the prefix of one?") in time proportional
+to the length of the candidate rather than the size of the share.
+"""
+
+__author__  = "Stephan Sokolow (deitarion/SSokolow)"
+__license__ = "GNU GPL 3.0 or later"
+__docformat__ = "restructuredtext en"
+
+import logging, os, stat
+from collections import namedtuple
+log = logging.getLogger(__name__)
+
+from snakebyte.shell_lexers import ARG_PREFIX
+
+#: Placeholder for "this trie node does not terminate a key"
+_MISSING = object()
+
+#: A served file. ``path`` is relative to its share root and always uses
+#: ``/`` as the separator.
+CatalogEntry = namedtuple('CatalogEntry', 'path abspath size mtime')
+
+#: What a call to `FileCatalog.rescan` changed, as lists of `CatalogEntry`
+CatalogChanges = namedtuple('CatalogChanges', 'added removed changed')
+
+class PathTrie(object):
+    """A radix (path-compressed prefix) trie mapping strings to values.
+
+    Each node is a two-item list of ``[edges, value]`` where ``edges`` maps
+    the first character of each outgoing edge label to a ``[label, node]``
+    pair. Compressing chains of single-child nodes into one edge keeps the
+    memory cost proportional to the number of keys rather than the total
+    number of characters in them.
+    """
+
+    def __init__(self):
+        self._root, self._len = [{}, _MISSING], 0
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __len__(self):
+        return self._len
+
+    def _find(self, key):
+        """Walk the trie as far as ``key`` goes.
+
+        :rtype: ``(node, bool)``
+        :returns: The node reached and whether ``key`` ended partway along
+            the edge leading to it. ``node`` is ``None`` if no key in the
+            trie begins with ``key``.
+        """
+        node, pos, length = self._root, 0, len(key)
+        while pos < length:
+            edge = node[0].get(key[pos])
+            if edge is None:
+                return None, False
+
+            label, child = edge
+            if key.startswith(label, pos):
+                node, pos = child, pos + len(label)
+            elif label.startswith(key[pos:]):
+                return child, True
+            else:
+                return None, False
+        return node, False
+
+    def get(self, key, default=None):
+        """Return the value for ``key`` or ``default`` if not present."""
+        node, partial = self._find(key)
+        if node is None or partial or node[1] is _MISSING:
+            return default
+        return node[1]
+
+    def status(self, key):
+        """Classify ``key`` in a form suitable for a prefix-aware
+        ``arg_test_cb``.
+
+        :returns: ``True`` if ``key`` is present, `ARG_PREFIX` if it is only
+            the prefix of a key that is present, or ``False``.
+        """
+        node, partial = self._find(key)
+        if node is None or not (node[0] or node[1] is not _MISSING):
+            return False  # (The root of an empty trie has nothing below it)
+        elif not partial and node[1] is not _MISSING:
+            return True
+        return ARG_PREFIX
+
+    def insert(self, key, value):
+        """Add or replace the value for ``key``."""
+        node, pos, length = self._root, 0, len(key)
+        while pos < length:
+            edge = node[0].get(key[pos])
+            if edge is None:
+                node[0][key[pos]] = [key[pos:], [{}, value]]
+                self._len += 1
+                return
+
+            label, child = edge
+            common, limit = 1, min(len(label), length - pos)
+            while common < limit and label[common] == key[pos + common]:
+                common += 1
+
+            if common < len(label):
+                # Split the edge at the point where the keys diverge
+                child = [{label[common]: [label[common:], child]}, _MISSING]
+                edge[0], edge[1] = label[:common], child
+            node, pos = child, pos + common
+
+        if node[1] is _MISSING:
+            self._len += 1
+        node[1] = value
+
+    def remove(self, key):
+        """Remove ``key`` and prune any nodes left without a purpose.
+
+        :raises KeyError: ``key`` is not present.
+        """
+        path, node, pos = [], self._root, 0
+        while pos < len(key):
+            edge = node[0].get(key[pos])
+            if edge is None or not key.startswith(edge[0], pos):
+                raise KeyError(repr(key))
+            path.append((node, key[pos]))
+            node, pos = edge[1], pos + len(edge[0])
+
+        if node[1] is _MISSING:
+            raise KeyError(repr(key))
+        node[1] = _MISSING
+        self._len -= 1
+
+        # Drop the node if it's now a leaf, then merge whichever node is
+        # left with its only remaining child if that's all it does.
+        if path and not node[0]:
+            parent, char = path.pop()
+            del parent[0][char]
+            node = parent
+        if path and node[1] is _MISSING and len(node[0]) == 1:
+            parent, char = path[-1]
+            edge = parent[0][char]
+            label, grandchild = list(node[0].values())[0]
+            edge[0], edge[1] = edge[0] + label, grandchild
+
+    def items(self, prefix=''):
+        """Lazily iterate ``(key, value)`` pairs in sorted key order,
+        optionally restricted to keys beginning with ``prefix``."""
+        node, partial = self._find(prefix)
+        if node is None:
+            return
+
+        if partial:
+            prefix = self._complete(prefix)
+
+        stack = [(prefix, node)]
+        while stack:
+            key, node = stack.pop()
+            if node[1] is not _MISSING:
+                yield key, node[1]
+            for char in sorted(node[0], reverse=True):
+                label, child = node[0][char]
+                stack.append((key + label, child))
+
+    def _complete(self, prefix):
+        """Extend a prefix which ends partway along an edge to the end of
+        that edge."""
+        node, pos = self._root, 0
+        while True:
+            label, child = node[0][prefix[pos]]
+            if pos + len(label) >= len(prefix):
+                return prefix[:pos] + label
+            node, pos = child, pos + len(label)
+
+class FileCatalog(object):
+    """A catalog of every regular file under a set of share roots.
+
+    Files are identified by their path relative to the root they were found
+    in, with ``/`` as the separator. If two roots contain the same relative
+    path, the root listed first shadows the others.
+
+    ``rescan`` only touches trie entries for files which were added, removed,
+    or modified (by size or mtime) since the previous scan, and `version` is
+    bumped whenever anything changed so that caches built on top of the
+    catalog know when to invalidate themselves.
+
+    Additions and modifications are applied as the scan streams them in,
+    so they become visible before a slow scan finishes. Removals (and the
+    `version` bump) wait until the scan is complete.
+    """
+
+    def __init__(self, roots, casefold=False, scanner=None):
+        """
+        :Parameters:
+          roots : ``list``
+            The directories to be served, in order of precedence.
+          casefold : `bool`
+            If ``True``, lookups ignore differences in case.
+          scanner : `snakebyte.scanner.ShareScanner`
+            Walks the roots in parallel. If ``None``, they are walked one
+            directory at a time with ``os.walk``.
+        """
+        self.roots = list(roots)
+        self.casefold = casefold
+        self.scanner = scanner
+        self.version = 0  #: Incremented whenever the catalog changes
+
+        self._entries, self._trie = {}, PathTrie()
+
+    def __contains__(self, path):
+        return self._fold(path) in self._entries
+
+    def __iter__(self):
+        """Iterate through all entries in sorted order"""
+        for _, entry in self._trie.items():
+            yield entry
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _fold(self, path):
+        """Convert a served path into the key used to look it up"""
+        return path.lower() if self.casefold else path
+
+    def _walk(self):
+        """Stat every regular file under the share roots.
+
+        :rtype: ``iterable`` of ``(root_index, CatalogEntry)``
+        """
+        if self.scanner is not None:
+            for result in self.scanner.scan(self.roots):
+                yield result
+            return
+
+        for index, root in enumerate(self.roots):
+            for dirpath, _, filenames in os.walk(root):
+                for name in filenames:
+                    abspath = os.path.join(dirpath, name)
+                    try:
+                        st = os.stat(abspath)
+                    except OSError as err:
+                        log.warning("Could not stat %s: %s", abspath, err)
+                        continue
+                    if not stat.S_ISREG(st.st_mode):
+                        continue
+
+                    path = os.path.relpath(abspath, root)
+                    path = path.replace(os.sep, '/')
+                    yield index, CatalogEntry(path, abspath,
+                                              st.st_size, st.st_mtime)
+
+    def arg_test_cb(self, candidate_str, argv):  # pylint: disable=W0613
+        """An ``arg_test_cb`` for `snakebyte.shell_lexers` lexers which
+        accepts served paths.
+
+        :returns: ``True`` if ``candidate_str`` names a served file,
+            `ARG_PREFIX` if it is the prefix of one, or ``False``.
+        """
+        return self._trie.status(self._fold(candidate_str))
+    arg_test_cb.prefix_aware = True
+
+    def get(self, path, default=None):
+        """Return the `CatalogEntry` for a served path or ``default``"""
+        return self._entries.get(self._fold(path), default)
+
+    def paths(self, prefix=''):
+        """Lazily iterate the served paths beginning with ``prefix`` in
+        sorted order."""
+        for _, entry in self._trie.items(self._fold(prefix)):
+            yield entry.path
+
+    def seed(self, entries):
+        """Populate the catalog with previously saved `CatalogEntry` objects
+        (eg. from a `snakebyte.catalog_file.MappedCatalog`) without touching
+        the filesystem, so the next `rescan` only reports what changed
+        since they were saved.
+        """
+        for entry in entries:
+            key = self._fold(entry.path)
+            if key not in self._entries:
+                self._entries[key] = entry
+                self._trie.insert(key, entry)
+        self.version += 1
+
+    def rescan(self):
+        """Bring the catalog up to date with the filesystem.
+
+        If the walk fails partway, the changes already applied are kept but
+        `version` is still incremented so cached lookups don't go stale.
+
+        :rtype: `CatalogChanges`
+        """
+        before, found, touched = dict(self._entries), {}, False
+        try:
+            for index, entry in self._walk():
+                key = self._fold(entry.path)
+                if found.get(key, (index,))[0] < index:
+                    continue  # Shadowed by a root listed earlier
+                found[key] = (index, entry)
+                if self._entries.get(key) != entry:
+                    self._entries[key] = entry
+                    self._trie.insert(key, entry)
+                    touched = True
+        except BaseException:
+            if touched:
+                self.version += 1
+            raise
+
+        changes = CatalogChanges([], [], [])
+        for key, (_, entry) in found.items():
+            old = before.get(key)
+            if old is None:
+                changes.added.append(entry)
+            elif old != entry:
+                changes.changed.append(entry)
+        for key in [x for x in before if x not in found]:
+            changes.removed.append(self._entries.pop(key))
+            self._trie.remove(key)
+        for entries in changes:
+            entries.sort()
+
+        if changes.added or changes.removed or changes.changed:
+            self.version += 1
+        log.debug("Rescanned %d files (%d added, %d removed, %d changed)",
+                  len(self._entries), len(changes.added),
+                  len(changes.removed), len(changes.changed))
+        return changes
@@ -0,0 +1,376 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Memory-mapped on-disk format for the file catalog
+
+Rescanning a large share can take minutes, during which a fresh
+`snakebyte.catalog.FileCatalog` has nothing to validate ``!get`` arguments
+against. `write_catalog` saves a catalog as a flat file which
+`MappedCatalog` can open in milliseconds and query in place through
+``mmap`` without building any per-entry objects up front.
+
+Layout (all integers little-endian):
+
+ - A fixed `HEADER`: magic, format version, flags, entry count, and the
+   length of the JSON-encoded list of share roots which follows it.
+ - The roots.
+ - ``count`` fixed-width `RECORD` structs sorted by the UTF-8 encoding of
+   each entry's lookup key, giving each string's offset and length in the
+   blob plus the file's size and mtime.
+ - A blob holding every string, UTF-8 encoded with ``surrogateescape`` so
+   undecodable filenames survive the round trip.
+
+Lookups binary-search the record table, comparing encoded keys, which is
+``O(log n)`` page touches per lookup. `PersistentCatalog` combines the two:
+it answers from the saved file immediately, rescans in the background, then
+switches to the live catalog and saves it for next time.
+"""
+
+__author__  = "Stephan Sokolow (deitarion/SSokolow)"
+__license__ = "GNU GPL 3.0 or later"
+__docformat__ = "restructuredtext en"
+
+import json, logging, mmap, os, struct, threading
+log = logging.getLogger(__name__)
+
+from snakebyte.atomic import atomic_write
+from snakebyte.catalog import CatalogEntry, FileCatalog
+from snakebyte.shell_lexers import ARG_PREFIX
+
+MAGIC = b'SBCATLG\x00'
+FORMAT_VERSION = 1
+FLAG_CASEFOLD = 1
+
+#: magic, version, flags, entry count, length of the encoded roots
+HEADER = struct.Struct('<8sIIQQ')
+
+#: key offset/length, path offset/length, abspath offset/length, size,
+#: mtime. Offsets are relative to the start of the string blob.
+RECORD = struct.Struct('<QIQIQIQd')
+
+#: The leading fields of `RECORD` needed to compare keys
+_KEY_FIELDS = struct.Struct('<QI')
+
+def _encode(text):
+    """Encode a path the way it's stored in the blob"""
+    return text.encode('utf-8', 'surrogateescape')
+
+def _decode(data):
+    """Decode a path stored in the blob"""
+    return bytes(data).decode('utf-8', 'surrogateescape')
+
+def write_catalog(catalog, path):
+    """Save a `snakebyte.catalog.FileCatalog` for `MappedCatalog` to load.
+
+    The file is replaced via `snakebyte.atomic.atomic_write`, so readers
+    never see a partial file.
+    """
+    fold = catalog._fold  # pylint: disable=W0212
+    records, blob, offsets = [], [], {}
+    blob_size = 0
+
+    def intern(text):
+        """Add a string to the blob once and return ``(offset, length)``"""
+        nonlocal blob_size
+        data = _encode(text)
+        if data not in offsets:
+            offsets[data] = blob_size
+            blob.append(data)
+            blob_size += len(data)
+        return offsets[data], len(data)
+
+    for entry in catalog:
+        key = intern(fold(entry.path))
+        records.append((_encode(fold(entry.path)), key + intern(entry.path) +
+                        intern(entry.abspath) + (entry.size, entry.mtime)))
+    records.sort(key=lambda x: x[0])
+
+    roots = json.dumps(catalog.roots, ensure_ascii=True).encode('ascii')
+    flags = FLAG_CASEFOLD if catalog.casefold else 0
+
+    def write(fobj):
+        """Write out the header, roots, record table, and blob"""
+        fobj.write(HEADER.pack(MAGIC, FORMAT_VERSION, flags,
+                               len(records), len(roots)))
+        fobj.write(roots)
+        for _, fields in records:
+            fobj.write(RECORD.pack(*fields))
+        for data in blob:
+            fobj.write(data)
+    atomic_write(path, write, binary=True)
+
+class MappedCatalog(object):
+    """A read-only catalog answering lookups directly from a file saved by
+    `write_catalog`.
+
+    Provides the same query API as `snakebyte.catalog.FileCatalog` (minus
+    `rescan`) so it can stand in for one.
+    """
+    version = 0  #: Mapped catalogs never change
+
+    def __init__(self, path):
+        """
+        :raises ValueError: The file is truncated or not a catalog.
+        :raises OSError: The file couldn't be opened.
+        """
+        self.path = path
+        with open(path, 'rb') as fobj:
+            size = os.fstat(fobj.fileno()).st_size
+            if size < HEADER.size:
+                raise ValueError("Not a catalog file: %s" % path)
+            self._map = mmap.mmap(fobj.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            magic, version, flags, count, roots_len = HEADER.unpack_from(
+                self._map)
+            if magic != MAGIC or version != FORMAT_VERSION:
+                raise ValueError("Not a version %d catalog file: %s" % (
+                                 FORMAT_VERSION, path))
+            self._table = HEADER.size + roots_len
+            self._blob = self._table + count * RECORD.size
+            if self._blob > size or self._blob + self._blob_extent() > size:
+                raise ValueError("Truncated catalog file: %s" % path)
+            self.roots = json.loads(
+                self._map[HEADER.size:self._table].decode('ascii'))
+        except (ValueError, struct.error):
+            self._map.close()
+            raise
+        self.casefold = bool(flags & FLAG_CASEFOLD)
+        self._count = count
+
+    def __contains__(self, path):
+        return self._find(self._fold(path))[1]
+
+    def __iter__(self):
+        """Iterate through all entries in sorted order"""
+        for pos in range(self._count):
+            yield self._entry(pos)
+
+    def __len__(self):
+        return self._count
+
+    def close(self):
+        """Release the mapping. Any further lookups will fail."""
+        self._map.close()
+
+    def _blob_extent(self):
+        """Return the length of blob the record table refers to"""
+        with memoryview(self._map) as view:
+            with view[self._table:self._blob] as table:
+                return max((max(x[0] + x[1], x[2] + x[3], x[4] + x[5])
+                            for x in RECORD.iter_unpack(table)), default=0)
+
+    def _fold(self, path):
+        """Convert a served path into the key used to look it up"""
+        return path.lower() if self.casefold else path
+
+    def _string(self, offset, length):
+        """Return the raw bytes of a string in the blob"""
+        start = self._blob + offset
+        return self._map[start:start + length]
+
+    def _key(self, pos):
+        """Return the encoded lookup key of the record at ``pos``"""
+        offset, length = _KEY_FIELDS.unpack_from(self._map,
+                self._table + pos * RECORD.size)
+        return self._string(offset, length)
+
+    def _entry(self, pos):
+        """Build the `CatalogEntry` for the record at ``pos``"""
+        fields = RECORD.unpack_from(self._map, self._table + pos * RECORD.size)
+        return CatalogEntry(_decode(self._string(fields[2], fields[3])),
+                            _decode(self._string(fields[4], fields[5])),
+                            fields[6], fields[7])
+
+    def _find(self, key):
+        """Binary-search for a lookup key.
+
+        :rtype: ``(int, bool)``
+        :returns: The position of the first record not less than ``key``
+            and whether that record's key is exactly ``key``.
+        """
+        needle, low, high = _encode(key), 0, self._count
+        while low < high:
+            mid = (low + high) // 2
+            if self._key(mid) < needle:
+                low = mid + 1
+            else:
+                high = mid
+        return low, low < self._count and self._key(low) == needle
+
+    def arg_test_cb(self, candidate_str, argv):  # pylint: disable=W0613
+        """An ``arg_test_cb`` which accepts served paths.
+
+        See `snakebyte.catalog.FileCatalog.arg_test_cb`.
+        """
+        pos, found = self._find(self._fold(candidate_str))
+        if found:
+            return True
+        if pos < self._count and self._key(pos).startswith(
+                _encode(self._fold(candidate_str))):
+            return ARG_PREFIX
+        return False
+    arg_test_cb.prefix_aware = True
+
+    def get(self, path, default=None):
+        """Return the `CatalogEntry` for a served path or ``default``"""
+        pos, found = self._find(self._fold(path))
+        return self._entry(pos) if found else default
+
+    def paths(self, prefix=''):
+        """Lazily iterate the served paths beginning with ``prefix`` in
+        sorted order."""
+        needle = _encode(self._fold(prefix))
+        pos = self._find(self._fold(prefix))[0]
+        while pos < self._count and self._key(pos).startswith(needle):
+            yield self._entry(pos).path
+            pos += 1
+
+class PersistentCatalog(object):
+    """A catalog which is usable immediately at startup.
+
+    Lookups are answered from the `MappedCatalog` saved by the previous run
+    (if it covers the same roots) while a `snakebyte.catalog.FileCatalog`
+    seeded from it rescans in a background thread. Once the rescan is done,
+    lookups switch to the live catalog and it's saved for next time.
+
+    If the initial rescan fails, the saved catalog keeps answering, nothing
+    is saved, and the exception is kept in `error`.
+
+    Call `rescan` for later updates, just as with a ``FileCatalog``.
+    """
+
+    def __init__(self, roots, path, casefold=False, ready_cb=None):
+        """
+        :Parameters:
+          roots : ``list``
+            See `snakebyte.catalog.FileCatalog.__init__`.
+          path : `str`
+            Where the catalog is saved between runs.
+          casefold : `bool`
+            See `snakebyte.catalog.FileCatalog.__init__`.
+          ready_cb : ``function(changes)``
+            Called from the background thread with the `CatalogChanges`
+            found by the initial rescan once the live catalog is in use, or
+            with ``None`` if the rescan failed.
+        """
+        self.path, self.ready_cb = path, ready_cb
+        #: Set once the initial rescan has finished, whether or not it
+        #: succeeded. (Check `error`.)
+        self.ready = threading.Event()
+        #: The exception which made the initial rescan fail, if any
+        self.error = None
+        self.live = FileCatalog(roots, casefold)
+        self.current = self.live  #: The catalog answering queries
+        self._swaps = 0
+
+        try:
+            mapped = MappedCatalog(path)
+        except (IOError, OSError, ValueError) as err:
+            log.info("No usable saved catalog (%s). Starting empty.", err)
+        else:
+            if mapped.roots == self.live.roots and (
+                    mapped.casefold == self.live.casefold):
+                self.current = mapped
+            else:
+                log.info("Saved catalog is for different roots. Ignoring.")
+                mapped.close()
+        self._thread = None
+
+    def __contains__(self, path):
+        return path in self.current
+
+    def __iter__(self):
+        return iter(self.current)
+
+    def __len__(self):
+        return len(self.current)
+
+    @property
+    def version(self):
+        """Changes whenever the current catalog is switched or changes"""
+        return (self._swaps, self.current.version)
+
+    def arg_test_cb(self, candidate_str, argv):
+        """See `snakebyte.catalog.FileCatalog.arg_test_cb`."""
+        return self.current.arg_test_cb(candidate_str, argv)
+    arg_test_cb.prefix_aware = True
+
+    def get(self, path, default=None):
+        """Return the `CatalogEntry` for a served path or ``default``"""
+        return self.current.get(path, default)
+
+    def paths(self, prefix=''):
+        """See `snakebyte.catalog.FileCatalog.paths`."""
+        return self.current.paths(prefix)
+
+    def start(self):
+        """Begin reconciling with the filesystem in a background thread"""
+        self._thread = threading.Thread(target=self._reconcile,
+                                        name='catalog-rescan')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def wait(self, timeout=None):
+        """Block until the initial rescan has finished.
+
+        :rtype: `bool`
+        :returns: Whether it has finished and succeeded.
+        """
+        return self.ready.wait(timeout) and self.error is None
+
+    def _reconcile(self):
+        """Seed the live catalog, rescan, switch over, and save.
+
+        On failure, keep answering from the saved catalog rather than a
+        partially built live one, and don't overwrite the saved file.
+        """
+        mapped = self.current
+        try:
+            if mapped is not self.live:
+                self.live.seed(mapped)
+            changes = self.live.rescan()
+        except Exception as err:  # pylint: disable=W0703
+            log.exception("Background catalog rescan failed")
+            self.error, changes = err, None
+        else:
+            self._switch()
+            self.save()
+        del mapped
+        if self.ready_cb:
+            self.ready_cb(changes)
+        self.ready.set()
+
+    def _switch(self):
+        """Start answering from the live catalog.
+
+        The mapping isn't closed explicitly, since another thread may be
+        partway through a lookup on it. It's released once the last
+        reference goes away.
+        """
+        self.current = self.live
+        self._swaps += 1
+
+    def rescan(self):
+        """Rescan the live catalog and save it if anything changed. Must not
+        be called before `ready` is set.
+
+        If the initial rescan failed, a successful call switches to the live
+        catalog and clears `error`.
+
+        :rtype: `CatalogChanges`
+        """
+        changes = self.live.rescan()
+        if self.current is not self.live:
+            self._switch()
+            self.error = None
+            self.save()
+        elif changes.added or changes.removed or changes.changed:
+            self.save()
+        return changes
+
+    def save(self):
+        """Write the live catalog to `path`, logging any failure"""
+        try:
+            write_catalog(self.live, self.path)
+        except (IOError, OSError) as err:
+            log.error("Could not save catalog to %s: %s", self.path, err)
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Precompiled command tables for lexers and command dispatch
+
+The lexers in `snakebyte.shell_lexers` accept a ``commands`` dict mapping
+``argv[0]`` values to ``(opts_list, arg_test_cb)`` tuples. Since that dict
+rarely changes, `CompiledCommands` does the normalization every lexer would
+otherwise repeat on each call (filtering non-string options, building
+option sets) once, up front, and adds a trie of command names so that
+dispatch can accept unique abbreviations.
+"""
+
+__author__  = "Stephan Sokolow (deitarion/SSokolow)"
+__license__ = "GNU GPL 3.0 or later"
+__docformat__ = "restructuredtext en"
+
+import logging
+from collections import namedtuple
+from itertools import islice
+log = logging.getLogger(__name__)
+
+try:                                                      # pragma: no cover
+    basestring
+except NameError:                                         # pragma: no cover
+    basestring = str  # pylint: disable=W0622
+
+from snakebyte.catalog import PathTrie
+
+#: Normalized hints for one command. Unpacks just like the tuples in a plain
+#: ``commands`` dict, but ``opts_list`` is a ``frozenset`` of strings.
+CommandSpec = namedtuple('CommandSpec', 'opts_list arg_test_cb')
+
+#: Hints for commands which aren't in the table
+NO_HINTS = CommandSpec(frozenset(), None)
+
+class CompiledCommands(object):
+    """An immutable, read-only ``dict``-like view of a ``commands`` table
+    which lexers and dispatchers can query without per-call setup.
+
+    Instances can be passed anywhere a ``commands`` dict is accepted.
+    """
+
+    def __init__(self, commands):
+        """
+        :Parameters:
+          commands : `dict` or `CompiledCommands`
+            A mapping from ``argv[0]`` values to ``(opts_list, arg_test_cb)``
+            tuples as described in
+            `snakebyte.shell_lexers.LexerInterface.__call__`.
+        """
+        self._specs, self._names, owners = {}, PathTrie(), []
+        for name, hints in commands.items():
+            opts_list, arg_test_cb = hints or ((), None)
+            spec = CommandSpec(frozenset(x for x in opts_list or ()
+                                         if isinstance(x, basestring)),
+                               arg_test_cb)
+            self._specs[name] = spec
+            self._names.insert(name, name)
+
+            # Callbacks may carry a version of their own (eg. a
+            # snakebyte.search.SuggestingArgTest) or be bound methods of an
+            # object which has one.
+            owner = arg_test_cb
+            if not hasattr(owner, 'version'):
+                owner = getattr(arg_test_cb, '__self__', None)
+            if hasattr(owner, 'version') and owner not in owners:
+                owners.append(owner)
+        self._owners = tuple(owners)
+
+    def __contains__(self, name):
+        return name in self._specs
+
+    def __getitem__(self, name):
+        return self._specs[name]
+
+    def __iter__(self):
+        return iter(self._specs)
+
+    def __len__(self):
+        return len(self._specs)
+
+    @property
+    def version(self):
+        """A value which changes whenever an ``arg_test_cb`` with a
+        ``version`` attribute, or an object owning one of the ``arg_test_cb``
+        bound methods (eg. a `snakebyte.catalog.FileCatalog`), bumps its
+        ``version``."""
+        return tuple(x.version for x in self._owners)
+
+    def candidates(self, prefix):
+        """Return the sorted names of all commands beginning with
+        ``prefix``."""
+        return [x for x, _ in self._names.items(prefix)]
+
+    def get(self, name, default=None):
+        """Return the `CommandSpec` for an exact command name"""
+        return self._specs.get(name, default)
+
+    def hints(self, name):
+        """Return the `CommandSpec` for a command name or unique
+        abbreviation, or `NO_HINTS` if there's no such command."""
+        name = self.resolve(name)
+        return NO_HINTS if name is None else self._specs[name]
+
+    def items(self):
+        return self._specs.items()
+
+    def keys(self):
+        return self._specs.keys()
+
+    def resolve(self, name):
+        """Expand a command name or unique abbreviation.
+
+        :returns: The full command name, or ``None`` if ``name`` doesn't
+            match any command or is ambiguous.
+        """
+        if name in self._specs:
+            return name
+
+        matches = list(islice(self._names.items(name), 2))
+        return matches[0][0] if len(matches) == 1 else None
+
+    def values(self):
+        return self._specs.values()
+
+def compile_commands(commands):
+    """Return ``commands`` as a `CompiledCommands`, compiling it if it isn't
+    one already."""
+    if isinstance(commands, CompiledCommands):
+        return commands
+    return CompiledCommands(commands or {})
@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Streaming framing of raw IRC protocol data into messages
+
+`LineFramer` accepts chunks straight from ``socket.recv`` and yields
+`IRCMessage` objects which are views into those chunks rather than copies.
+Only the tail of a chunk which ends partway through a line is ever copied.
+Parsing and decoding are deferred until a message's fields are accessed, so
+traffic nobody looks at (eg. other channels' chatter) costs little more
+than a newline search.
+
+:attention: Messages may refer directly to the memory of the chunk they came
+    from. If you pass in a mutable buffer (eg. one reused with
+    ``socket.recv_into``), don't modify it while its messages are in use.
+"""
+
+__author__  = "Stephan Sokolow (deitarion/SSokolow)"
+__license__ = "GNU GPL 3.0 or later"
+__docformat__ = "restructuredtext en"
+
+import logging, re
+log = logging.getLogger(__name__)
+
+from snakebyte.shell_lexers import get_lexer
+
+#: Matches the end of a line, regardless of whether the server sends CRLF
+_eol_re = re.compile(b'\n')
+
+#: Matches the optional IRCv3 tags and prefix and the mandatory command
+_head_re = re.compile(b'(?:@([^ ]*) +)?(?::([^ ]*) +)?([^ ]+)')
+
+#: Matches one parameter following the command
+_param_re = re.compile(b' +(?::(.*)|([^ ]+))', re.DOTALL)
+
+class IRCMessage(object):
+    """A single IRC protocol message, parsed and decoded on demand.
+
+    All text fields are ``None`` if absent from the message.
+    """
+    __slots__ = ('raw', 'encoding', 'fallback_encoding', '_spans', '_cache')
+
+    def __init__(self, raw, encoding='utf-8', fallback_encoding='latin-1'):
+        """
+        :Parameters:
+          raw : ``bytes``-like
+            The message without its line terminator.
+          encoding : `str`
+            The encoding to try first when decoding fields.
+          fallback_encoding : `str`
+            The encoding to use when ``encoding`` fails. This should be one,
+            like ``latin-1``, which can decode any byte sequence.
+        """
+        self.raw = raw
+        self.encoding, self.fallback_encoding = encoding, fallback_encoding
+        self._spans, self._cache = None, {}
+
+    def __repr__(self):
+        return '<%s %r>' % (self.__class__.__name__, bytes(self.raw))
+
+    def _parse(self):
+        """Locate the fields of the message without copying any of them.
+
+        :rtype: ``dict``
+        :returns: A mapping from field names to ``(start, end)`` offsets
+            into `raw` and, for ``params``, a list of such offsets.
+        """
+        if self._spans is None:
+            spans = {'params': []}
+            match = _head_re.match(self.raw)
+            if match:
+                for pos, field in enumerate(('tags', 'prefix', 'command'), 1):
+                    if match.start(pos) >= 0:
+                        spans[field] = match.span(pos)
+
+                pos = match.end()
+                match = _param_re.match(self.raw, pos)
+                while match:
+                    if match.start(1) >= 0:
+                        spans['trailing'] = match.span(1)
+                        spans['params'].append(match.span(1))
+                        break
+                    spans['params'].append(match.span(2))
+                    match = _param_re.match(self.raw, match.end())
+            self._spans = spans
+        return self._spans
+
+    def _decode(self, span):
+        """Decode the bytes in ``raw[start:end]`` without copying them."""
+        view = memoryview(self.raw)[span[0]:span[1]]
+        try:
+            return str(view, self.encoding)
+        except UnicodeDecodeError:
+            return str(view, self.fallback_encoding)
+
+    def _field(self, name):
+        """Return a decoded field, caching the result"""
+        if name not in self._cache:
+            span = self._parse().get(name)
+            self._cache[name] = span and self._decode(span)
+        return self._cache[name]
+
+    @property
+    def tags(self):
+        """The raw IRCv3 message tags string (without the ``@``)"""
+        return self._field('tags')
+
+    @property
+    def prefix(self):
+        """The message source (without the leading ``:``)"""
+        return self._field('prefix')
+
+    @property
+    def nick(self):
+        """The nickname portion of `prefix`"""
+        prefix = self.prefix
+        return prefix and prefix.split('!', 1)[0]
+
+    @property
+    def command(self):
+        """The command or numeric reply code, upper-cased"""
+        command = self._field('command')
+        return command and command.upper()
+
+    @property
+    def params(self):
+        """All parameters, including `trailing`, as a list"""
+        if 'params' not in self._cache:
+            self._cache['params'] = [self._decode(x)
+                                     for x in self._parse()['params']]
+        return self._cache['params']
+
+    @property
+    def trailing(self):
+        """The final parameter if it was introduced by ``:``"""
+        return self._field('trailing')
+
+    def lex(self, lexer, commands):
+        """Tokenize `trailing` using one of the lexers from
+        `snakebyte.shell_lexers`.
+
+        :raises ValueError: Failed to parse the command line.
+        """
+        return lexer(self.trailing or '', commands)
+
+class LineFramer(object):
+    """Incrementally split a stream of raw IRC data into `IRCMessage`s.
+
+    Lines may end in either CRLF or a bare LF. Empty lines are ignored, and
+    lines longer than ``max_length`` bytes (including the terminator) are
+    discarded in their entirety and counted in `overflows`.
+    """
+
+    def __init__(self, max_length=512, encoding='utf-8',
+                 fallback_encoding='latin-1', lexer='posix', commands=None,
+                 lex_commands=('PRIVMSG',)):
+        """
+        :Parameters:
+          max_length : `int`
+            The maximum permitted length of a line. RFC 1459 specifies 512
+            but servers supporting IRCv3 message tags may need more.
+          encoding : `str`
+            See `IRCMessage.__init__`.
+          fallback_encoding : `str`
+            See `IRCMessage.__init__`.
+          lexer : `str` or `snakebyte.shell_lexers.LexerInterface`
+            The lexer (or the ``name`` of one in ``LEXERS``) used by
+            `feed_lexed`.
+          commands : `dict`
+            The ``commands`` argument passed to ``lexer``.
+          lex_commands : ``iterable``
+            The IRC commands whose trailing parameter `feed_lexed` tokenizes.
+        """
+        if not callable(lexer):
+            lexer = get_lexer(lexer)
+        self.max_length = max_length
+        self.encoding, self.fallback_encoding = encoding, fallback_encoding
+        self.lexer, self.commands = lexer, commands or {}
+        self.lex_commands = frozenset(lex_commands)
+
+        self.overflows = 0  #: Number of over-long lines discarded so far
+        self._buffer, self._discarding = bytearray(), False
+
+    def _message(self, raw):
+        """Wrap a line in an `IRCMessage` or return ``None`` to skip it"""
+        if raw[-1:] == b'\r':
+            raw = raw[:-1]
+        if not raw:
+            return None
+        return IRCMessage(raw, self.encoding, self.fallback_encoding)
+
+    def _overflow(self):
+        """Record that an over-long line was discarded"""
+        self.overflows += 1
+        log.warning("Discarded line exceeding %d bytes", self.max_length)
+
+    def feed(self, chunk):
+        """Add raw data and return every message it completes.
+
+        The whole chunk is consumed before this returns, so the framer's
+        state never depends on how much of the result the caller uses.
+
+        :Parameters:
+          chunk : ``bytes``, ``bytearray``, or ``memoryview``
+            Data as received from the socket.
+
+        :rtype: ``list`` of `IRCMessage`
+        """
+        return list(self._feed(chunk))
+
+    def _feed(self, chunk):
+        """Generator which does the work for `feed`"""
+        view, pos = memoryview(chunk), 0
+        match = _eol_re.search(view)
+
+        # Finish the line left over from the previous chunk, if any
+        if self._buffer or self._discarding:
+            end = match.start() if match else len(view)
+            if not self._discarding:
+                if len(self._buffer) + end + 1 > self.max_length:
+                    self._overflow()
+                    self._buffer, self._discarding = bytearray(), True
+                else:
+                    self._buffer += view[:end]
+            if not match:
+                return
+
+            raw, self._buffer = self._buffer, bytearray()
+            if self._discarding:
+                self._discarding = False
+            else:
+                message = self._message(raw)
+                if message is not None:
+                    yield message
+            pos = match.end()
+            match = _eol_re.search(view, pos)
+
+        # Lines which fall entirely within this chunk are never copied
+        while match:
+            end = match.start()
+            if end - pos + 1 > self.max_length:
+                self._overflow()
+            else:
+                message = self._message(view[pos:end])
+                if message is not None:
+                    yield message
+            pos = match.end()
+            match = _eol_re.search(view, pos)
+
+        if len(view) - pos >= self.max_length:
+            self._overflow()
+            self._discarding = True
+        elif pos < len(view):
+            self._buffer += view[pos:]
+
+    def feed_lexed(self, chunk):
+        """Like `feed`, but tokenize the trailing parameter of each message
+        whose command is in ``lex_commands`` using the configured lexer.
+
+        :rtype: ``list`` of ``(IRCMessage, list)``
+        :returns: Messages paired with their argv, or with ``None`` if they
+            weren't lexed or the lexer raised ``ValueError``.
+        """
+        results = []
+        for message in self._feed(chunk):
+            argv = None
+            if message.command in self.lex_commands:
+                try:
+                    argv = message.lex(self.lexer, self.commands)
+                except ValueError as err:
+                    log.debug("Could not lex %r: %s", message, err)
+            results.append((message, argv))
+        return results
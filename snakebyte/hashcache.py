@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Persistent cache of CRC32 and MD5 checksums for served files
+
+Hashing a multi-gigabyte file takes long enough to stall an event loop, so
+`HashCache` computes checksums in a ``ProcessPoolExecutor`` and hands them
+back as ``concurrent.futures.Future`` objects. (Use ``asyncio.wrap_future``
+to await them from a coroutine.)
+
+Results are keyed by `file_identity` (device, inode, size, and mtime) rather
+than by path, so renaming a file doesn't invalidate its checksums but
+modifying it does. The cache is saved with `snakebyte.atomic.write_json`,
+so checksums survive restarts without ever being trusted for a file which
+has since changed.
+"""
+
+__author__  = "Stephan Sokolow (deitarion/SSokolow)"
+__license__ = "GNU GPL 3.0 or later"
+__docformat__ = "restructuredtext en"
+
+import hashlib, logging, mmap, os, threading, zlib
+from collections import namedtuple
+from concurrent.futures import Future, ProcessPoolExecutor
+log = logging.getLogger(__name__)
+
+from snakebyte.atomic import read_json, write_json
+
+#: Version number written to (and required of) saved cache files
+FORMAT_VERSION = 1
+
+#: Checksums for one file as lowercase hex strings
+FileHashes = namedtuple('FileHashes', 'crc32 md5')
+
+def file_identity(path_or_stat):
+    """Return the ``(st_dev, st_ino, st_size, st_mtime_ns)`` tuple which
+    `HashCache` uses to recognize a file's contents.
+
+    :Parameters:
+      path_or_stat : `str` or ``os.stat_result``
+        A path to ``stat`` or the result of doing so.
+
+    :raises OSError: ``path_or_stat`` is a path which couldn't be examined.
+    """
+    st = path_or_stat
+    if not isinstance(st, os.stat_result):
+        st = os.stat(st)
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+def _hash_file(path, block_size=1 << 20):
+    """Compute `FileHashes` for ``path``. Runs in a worker process.
+
+    The file is memory-mapped where possible so its pages are hashed
+    straight from the page cache. Otherwise, it's read through a single
+    reusable buffer of ``block_size`` bytes.
+
+    :rtype: ``(identity, FileHashes)``
+    :returns: The hashes, along with the file's identity if it stayed the
+        same throughout hashing or ``None`` if it was modified meanwhile.
+    """
+    crc, md5 = 0, hashlib.md5()
+    with open(path, 'rb') as fobj:
+        before = file_identity(os.fstat(fobj.fileno()))
+        try:
+            mapped = mmap.mmap(fobj.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):  # Empty or unmappable file
+            mapped = None
+
+        if mapped is not None:
+            with mapped:
+                view = memoryview(mapped)
+                try:
+                    for pos in range(0, len(view), block_size):
+                        block = view[pos:pos + block_size]
+                        crc = zlib.crc32(block, crc)
+                        md5.update(block)
+                        block.release()
+                finally:
+                    view.release()
+        else:
+            buf = bytearray(block_size)
+            view = memoryview(buf)
+            while True:
+                count = fobj.readinto(buf)
+                if not count:
+                    break
+                crc = zlib.crc32(view[:count], crc)
+                md5.update(view[:count])
+        after = file_identity(os.fstat(fobj.fileno()))
+
+    hashes = FileHashes('%08x' % (crc & 0xffffffff), md5.hexdigest())
+    return (before if before == after else None), hashes
+
+class HashCache(object):
+    """Checksums for served files, computed in the background and persisted
+    across restarts.
+
+    Only one computation runs per file identity at a time. Concurrent
+    requests for a file which is still being hashed share its ``Future``.
+    """
+
+    def __init__(self, path=None, executor=None, max_workers=None):
+        """
+        :Parameters:
+          path : `str`
+            Where to load and `save` the cache. ``None`` disables
+            persistence.
+          executor : ``concurrent.futures.Executor``
+            Where to run `_hash_file`. A ``ProcessPoolExecutor`` is created
+            on first use (and shut down by `close`) if none is provided.
+          max_workers : `int`
+            The size of the ``ProcessPoolExecutor`` created if ``executor``
+            is ``None``.
+        """
+        self.path, self.max_workers = path, max_workers
+        self.executor, self._own_executor = executor, executor is None
+        self.dirty = False  #: Whether there are unsaved changes
+
+        self._entries, self._inflight = {}, {}
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            self.load()
+
+    def __contains__(self, identity):
+        return identity in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def close(self):
+        """Wait for pending work, shut down the pool, and `save`"""
+        if self._own_executor and self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        self.save()
+
+    def get_cached(self, path, st=None):
+        """Return the `FileHashes` for ``path`` if they're already known.
+
+        :Parameters:
+          st : ``os.stat_result``
+            ``path``'s ``stat`` result, if the caller already has it.
+
+        :rtype: `FileHashes` or ``None``
+        """
+        try:
+            return self._entries.get(file_identity(st or path))
+        except OSError:
+            return None
+
+    def get(self, path, st=None):
+        """Return a ``Future`` for the `FileHashes` of ``path``, starting a
+        background computation if they aren't cached.
+
+        The ``Future``'s exception is set to an ``OSError`` if the file
+        couldn't be read or was modified (so its identity no longer
+        matches) before hashing finished.
+
+        :Parameters:
+          st : ``os.stat_result``
+            ``path``'s ``stat`` result, if the caller already has it.
+        """
+        try:
+            identity = file_identity(st or path)
+        except OSError as err:
+            future = Future()
+            future.set_exception(err)
+            return future
+
+        with self._lock:
+            hashes = self._entries.get(identity)
+            if hashes is not None:
+                future = Future()
+                future.set_result(hashes)
+                return future
+
+            future = self._inflight.get(identity)
+            if future is not None:
+                return future
+            future = self._inflight[identity] = Future()
+            if self.executor is None:
+                self.executor = ProcessPoolExecutor(self.max_workers)
+            job = self.executor.submit(_hash_file, path)
+
+        # Outside the lock since this runs immediately if ``job`` is done
+        job.add_done_callback(
+            lambda job: self._finished(path, identity, future, job))
+        return future
+
+    def _finished(self, path, identity, future, job):
+        """Store a worker's result and resolve the ``Future`` handed out for
+        it.
+
+        Hashes for a file which turned out not to match ``identity`` are
+        never handed out as if they did. (They're still cached if the file
+        held still long enough to give them a valid identity of their own.)
+        """
+        try:
+            actual, hashes = job.result()
+        except Exception as err:  # pylint: disable=W0703
+            with self._lock:
+                del self._inflight[identity]
+            future.set_exception(err)
+            return
+
+        with self._lock:
+            del self._inflight[identity]
+            if actual is not None:
+                self._entries[actual] = hashes
+                self.dirty = True
+
+        if actual != identity:
+            future.set_exception(OSError(
+                "%s was modified while being hashed" % path))
+        else:
+            future.set_result(hashes)
+
+    def retain(self, identities):
+        """Forget every cached file whose identity isn't in ``identities``
+        (eg. after a rescan has shown which files still exist).
+
+        :returns: The number of entries forgotten.
+        """
+        keep = set(identities)
+        with self._lock:
+            stale = [x for x in self._entries if x not in keep]
+            for identity in stale:
+                del self._entries[identity]
+            if stale:
+                self.dirty = True
+        return len(stale)
+
+    def load(self):
+        """Replace the contents of the cache with those saved at `path`.
+
+        An unreadable or incompatible file is logged and treated as empty.
+        """
+        try:
+            entries = dict((tuple(x[:4]), FileHashes(*x[4:]))
+                           for x in read_json(self.path, FORMAT_VERSION))
+        except (IOError, OSError, ValueError, KeyError, TypeError) as err:
+            log.warning("Ignoring unusable hash cache %s: %s", self.path, err)
+            entries = {}
+
+        with self._lock:
+            self._entries, self.dirty = entries, False
+
+    def save(self):
+        """Write the cache to `path` if it has unsaved changes"""
+        if not (self.path and self.dirty):
+            return
+        with self._lock:
+            entries = [list(k) + list(v) for k, v in self._entries.items()]
+            self.dirty = False
+
+        try:
+            write_json(self.path, FORMAT_VERSION, entries)
+        except BaseException:
+            self.dirty = True
+            raise
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Paginated, cached rendering of ``!list`` and ``!queue`` replies
+
+IRC can only show a screenful of lines at a time, so a `Listing` renders
+one page on request and remembers it until whatever it lists changes.
+
+Change detection uses generation numbers: `Listing` compares the value
+returned by its ``generation_cb`` (eg. `snakebyte.catalog.FileCatalog.version`
+or `snakebyte.queue.FairQueue.generation`) against the one its cached pages
+were built under and starts over when they differ.
+
+Within a generation, the items come from a source built once by
+``source_cb``. If the source is a sequence, pages are sliced out of it
+directly. Otherwise, it's consumed lazily, so reading pages in order only
+ever formats and pulls the items actually shown. Jumping ahead to a deep
+page still has to pull (though not format) every item before it, since an
+iterator can't skip. Pulled items are kept until the generation changes,
+so revisiting a page whose rendering was evicted never rebuilds the source.
+"""
+
+__author__  = "Stephan Sokolow (deitarion/SSokolow)"
+__license__ = "GNU GPL 3.0 or later"
+__docformat__ = "restructuredtext en"
+
+import logging
+from collections import namedtuple
+from itertools import islice
+log = logging.getLogger(__name__)
+
+try:
+    from collections import OrderedDict
+except ImportError:  # pragma: no cover
+    from ordereddict import OrderedDict
+
+#: One rendered page. ``number`` is 1-based. ``more`` is ``True`` if at
+#: least one later page exists.
+Page = namedtuple('Page', 'number lines more')
+
+def _format_item(position, item):
+    """Default line format for `Listing`"""
+    return '%d. %s' % (position, item)
+
+class Listing(object):
+    """Lazily render and cache pages of lines.
+
+    ``format_cb(position, item)`` turns one item into one line of text.
+    ``position`` is the item's 1-based position in the whole listing.
+    """
+
+    def __init__(self, source_cb, generation_cb, format_cb=None,
+                 page_size=10, max_cached=32):
+        """
+        :Parameters:
+          source_cb : ``function()``
+            Returns the items to list, in order, as a sequence or any
+            iterable. Called at most once per generation.
+            Items pulled from an iterable are kept for the rest of the
+            generation, so memory use grows with the deepest page shown.
+          generation_cb : ``function()``
+            Returns a value which changes whenever ``source_cb``'s result
+            would.
+          format_cb : ``function(position, item)``
+            Renders one line. Defaults to ``"%d. %s" % (position, item)``.
+          page_size : `int`
+            The number of lines per page.
+          max_cached : `int`
+            The maximum number of rendered pages kept per generation.
+        """
+        if page_size < 1:
+            raise ValueError("page_size must be at least 1")
+        self.source_cb, self.generation_cb = source_cb, generation_cb
+        self.format_cb = format_cb or _format_item
+        self.page_size, self.max_cached = page_size, max_cached
+        self.invalidate()
+
+    def invalidate(self):
+        """Discard all cached pages and the current source"""
+        self.generation = self._source = self._iterator = None
+        self._exhausted = False
+        self._pages = OrderedDict()
+
+    def _refresh(self):
+        """Start over if the listed data has changed"""
+        generation = self.generation_cb()
+        if generation != self.generation or self._source is None:
+            self.invalidate()
+            self.generation = generation
+            source = self.source_cb()
+            if hasattr(source, '__getitem__') and hasattr(source, '__len__'):
+                self._source = source
+            else:
+                # Items pulled so far accumulate in _source
+                self._source, self._iterator = [], iter(source)
+
+    def _items(self, start, count):
+        """Return up to ``count`` items beginning at ``start``, pulling
+        more from a lazy source if necessary."""
+        end = start + count
+        if self._iterator is not None and not self._exhausted:
+            missing = end - len(self._source)
+            if missing > 0:
+                self._source.extend(islice(self._iterator, missing))
+                self._exhausted = len(self._source) < end
+        return list(self._source[start:end])
+
+    def page(self, number):
+        """Return the given 1-based page as a `Page`.
+
+        Pages past the end have no lines.
+
+        :raises ValueError: ``number`` is less than 1.
+        """
+        if number < 1:
+            raise ValueError("Page numbers start at 1: %r" % number)
+        self._refresh()
+
+        cached = self._pages.pop(number, None)
+        if cached is not None:
+            self._pages[number] = cached
+            return cached
+
+        # Fetch one extra item to learn whether there's a next page
+        start = (number - 1) * self.page_size
+        items = self._items(start, self.page_size + 1)
+        more = len(items) > self.page_size
+        items = items[:self.page_size]
+
+        result = Page(number, [self.format_cb(start + pos + 1, item)
+                               for pos, item in enumerate(items)], more)
+        self._pages[number] = result
+        if len(self._pages) > self.max_cached:
+            self._pages.popitem(last=False)
+        return result
+
+    def page_count(self):
+        """Return the number of pages, or ``None`` if it can't be known
+        without consuming the rest of a lazy source."""
+        self._refresh()
+        if self._iterator is not None and not self._exhausted:
+            return None
+        return max(1, -(-len(self._source) // self.page_size))
+
+def catalog_listing(catalog, prefix='', **kwargs):
+    """Build a `Listing` of the paths in a
+    `snakebyte.catalog.FileCatalog` which begin with ``prefix``.
+
+    Paths are streamed from the catalog's trie in sorted order, so the first
+    page costs nothing proportional to the size of the share.
+    """
+    return Listing(lambda: catalog.paths(prefix), lambda: catalog.version,
+                   **kwargs)
+
+def _format_bucket(position, item):
+    """Default line format for `queue_listing`"""
+    key, count = item
+    return '%d. %s (%d queued)' % (position, key, count)
+
+def queue_listing(queue, **kwargs):
+    """Build a `Listing` of the buckets in a `snakebyte.queue.FairQueue`, in
+    the order they'll be served, as ``(key, number_of_entries)`` items.
+
+    Buckets are taken from `FairQueue.iter_ordered` as pages are shown, so
+    rebuilding the listing after the queue changes costs ``O(k log k)`` for
+    the first ``k`` buckets rather than a sort of the whole queue.
+    """
+    kwargs.setdefault('format_cb', _format_bucket)
+    return Listing(lambda: ((x, len(queue[x])) for x in queue.iter_ordered()),
+                   lambda: queue.generation, **kwargs)
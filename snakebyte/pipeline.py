@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Asyncio pipeline from incoming command lines to `FairQueue` entries
+
+When a popular pack is announced, hundreds of requests can arrive within
+seconds. `CommandPipeline` keeps that from stalling the connection by:
+
+ - Throttling each user with a `TokenBucket` before their line is even
+   buffered, so flooders cost one dictionary lookup per line.
+ - Collecting lines into batches and handing the ones which need an
+   ``arg_test_cb`` (and may therefore be slow) to a thread pool as a single
+   job rather than one job per line.
+ - Pushing each batch's accepted requests into the queue with one
+   `snakebyte.queue.FairQueue.extend` call per user.
+"""
+
+__author__  = "Stephan Sokolow (deitarion/SSokolow)"
+__license__ = "GNU GPL 3.0 or later"
+__docformat__ = "restructuredtext en"
+
+import asyncio, logging, time
+from collections import OrderedDict
+log = logging.getLogger(__name__)
+
+from snakebyte.commands import compile_commands
+from snakebyte.shell_lexers import get_lexer
+
+class TokenBucket(object):
+    """A classic token bucket which refills continuously at ``rate`` tokens
+    per second up to a maximum of ``capacity``."""
+    __slots__ = ('rate', 'capacity', 'tokens', 'stamp')
+
+    def __init__(self, rate, capacity, now):
+        self.rate, self.capacity = rate, capacity
+        self.tokens, self.stamp = capacity, now
+
+    def consume(self, now, amount=1):
+        """Take ``amount`` tokens if available.
+
+        :rtype: `bool`
+        :returns: Whether the tokens were available.
+        """
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return True
+        return False
+
+    def is_full(self, now):
+        """Whether the bucket would be full at ``now`` and is, therefore,
+        indistinguishable from a freshly created one."""
+        return self.tokens + (now - self.stamp) * self.rate >= self.capacity
+
+class FloodControl(object):
+    """Per-key `TokenBucket` rate limiting with bounded memory.
+
+    Buckets which have refilled completely are discarded during periodic
+    sweeps, since a new bucket would behave identically.
+    """
+
+    def __init__(self, rate=1.0, burst=5, sweep_size=1024,
+                 clock=time.monotonic):
+        """
+        :Parameters:
+          rate : `float`
+            Sustained number of lines per second allowed for each key.
+          burst : `int`
+            Number of lines a key may send at once after being idle.
+          sweep_size : `int`
+            Sweep for full buckets whenever there are this many more
+            buckets than after the previous sweep.
+          clock : ``function()``
+            Source of timestamps in seconds.
+        """
+        self.rate, self.burst, self.clock = rate, burst, clock
+        self.sweep_size = sweep_size
+
+        self._buckets, self._sweep_at = {}, sweep_size
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def allow(self, key, now=None):
+        """Record a line from ``key`` and return whether it should be
+        accepted."""
+        now = self.clock() if now is None else now
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if len(self._buckets) >= self._sweep_at:
+                self.sweep(now)
+            bucket = self._buckets[key] = TokenBucket(
+                    self.rate, self.burst, now)
+        return bucket.consume(now)
+
+    def sweep(self, now=None):
+        """Discard every bucket which has refilled completely"""
+        now = self.clock() if now is None else now
+        for key in [k for k, v in self._buckets.items() if v.is_full(now)]:
+            del self._buckets[key]
+        self._sweep_at = len(self._buckets) + self.sweep_size
+
+class CommandPipeline(object):
+    """Lex, validate, and enqueue command lines in batches.
+
+    ``request_cb(key, argv)`` is called on the event loop for each
+    successfully lexed line and returns the values to enqueue for ``key``
+    (eg. the files named by a ``!get``). It may raise ``ValueError`` to
+    reject the request. Any other exception is logged and rejects only the
+    line which caused it.
+    """
+
+    def __init__(self, queue, request_cb, lexer='smart', commands=None,
+                 rate=1.0, burst=5, batch_size=64, batch_delay=0.05,
+                 max_pending=4096, executor=None, tracker=None):
+        """
+        :Parameters:
+          queue : `snakebyte.queue.FairQueue`
+            The queue accepted requests should be pushed into.
+          request_cb : ``function(key, argv)``
+            Validates a request and returns an iterable of values to
+            enqueue.
+          lexer : `str` or `snakebyte.shell_lexers.LexerInterface`
+            The lexer (or the ``name`` of one in ``LEXERS``) to use.
+          commands : `dict` or `snakebyte.commands.CompiledCommands`
+            The ``commands`` table passed to ``lexer``.
+          rate : `float`
+            See `FloodControl.__init__`.
+          burst : `int`
+            See `FloodControl.__init__`.
+          batch_size : `int`
+            The maximum number of lines processed as one batch.
+          batch_delay : `float`
+            How long to wait for more lines after the first line of a batch
+            arrives. Zero processes whatever is already waiting.
+          max_pending : `int`
+            The maximum number of lines buffered before new ones are
+            dropped.
+          executor : ``concurrent.futures.Executor``
+            Where lines needing an ``arg_test_cb`` are lexed. ``None``
+            selects the event loop's default executor.
+          tracker : `snakebyte.popularity.PopularityTracker`
+            If provided, every value enqueued is recorded as a request.
+        """
+        if not callable(lexer):
+            lexer = get_lexer(lexer)
+        self.queue, self.request_cb, self.lexer = queue, request_cb, lexer
+        self.commands = compile_commands(commands)
+        self.flood_control = FloodControl(rate, burst)
+        self.batch_size, self.batch_delay = batch_size, batch_delay
+        self.executor, self.tracker = executor, tracker
+
+        #: Lines accepted, rejected, refused by flood control, and dropped
+        #: because the buffer was full.
+        self.accepted = self.rejected = self.throttled = self.dropped = 0
+        self._pending = asyncio.Queue(max_pending)
+
+    def submit(self, key, cmd_string):
+        """Buffer a command line from ``key`` for processing.
+
+        This is cheap enough to call directly from a protocol's
+        ``data_received``.
+
+        :rtype: `bool`
+        :returns: ``False`` if the line was dropped due to flood control or
+            a full buffer.
+        """
+        if not self.flood_control.allow(key):
+            self.throttled += 1
+            return False
+        try:
+            self._pending.put_nowait((key, cmd_string))
+        except asyncio.QueueFull:
+            log.warning("Pipeline full. Dropping line from %r", key)
+            self.dropped += 1
+            return False
+        return True
+
+    def _is_heavy(self, cmd_string):
+        """Whether a line's ``argv[0]`` has an ``arg_test_cb`` and may,
+        therefore, take a while to lex."""
+        words = cmd_string.split(None, 1)
+        return bool(words) and bool(self.commands.hints(words[0])[1])
+
+    def _lex_batch(self, batch):
+        """Lex a list of ``(key, cmd_string)`` pairs.
+
+        :returns: A list of ``(key, argv)`` pairs, with ``argv`` set to the
+            ``ValueError`` raised if lexing failed.
+        """
+        results = []
+        for key, cmd_string in batch:
+            try:
+                results.append((key, self.lexer(cmd_string, self.commands)))
+            except ValueError as err:
+                results.append((key, err))
+        return results
+
+    async def _next_batch(self):
+        """Wait for at least one line, then collect up to ``batch_size``."""
+        batch = [await self._pending.get()]
+        if self.batch_delay and self._pending.qsize() < self.batch_size:
+            await asyncio.sleep(self.batch_delay)
+        while len(batch) < self.batch_size and not self._pending.empty():
+            batch.append(self._pending.get_nowait())
+        return batch
+
+    async def process(self, batch):
+        """Lex, validate, and enqueue a list of ``(key, cmd_string)``
+        pairs.
+
+        :returns: A list of ``(key, argv, values)`` tuples in the order the
+            lines were given. ``values`` is the list that was enqueued or the
+            exception explaining why nothing was.
+        """
+        light, heavy = [], []
+        for pos, (key, cmd_string) in enumerate(batch):
+            if self._is_heavy(cmd_string):
+                heavy.append((pos, (key, cmd_string)))
+            else:
+                light.append((pos, (key, cmd_string)))
+
+        lexed = [None] * len(batch)
+        if heavy:
+            loop = asyncio.get_running_loop()
+            results = await loop.run_in_executor(self.executor,
+                    self._lex_batch, [x for _, x in heavy])
+            for (pos, _), result in zip(heavy, results):
+                lexed[pos] = result
+        for (pos, _), result in zip(light,
+                                    self._lex_batch([x for _, x in light])):
+            lexed[pos] = result
+
+        results, bulk = [], OrderedDict()
+        for key, argv in lexed:
+            values = argv
+            if not isinstance(argv, ValueError):
+                try:
+                    values = list(self.request_cb(key, argv))
+                except ValueError as err:
+                    values = err
+                except Exception as err:  # pylint: disable=W0703
+                    log.exception("request_cb failed for %r", key)
+                    values = err
+                else:
+                    bulk.setdefault(key, []).extend(values)
+
+            if isinstance(values, Exception):
+                self.rejected += 1
+                argv = None if argv is values else argv
+            else:
+                self.accepted += 1
+            results.append((key, argv, values))
+
+        for key, values in bulk.items():
+            self.queue.extend(key, values)
+            if self.tracker is not None:
+                for value in values:
+                    self.tracker.record(value)
+        return results
+
+    async def run(self):
+        """Process batches forever. Run this as an ``asyncio`` task."""
+        while True:
+            batch = await self._next_batch()
+            try:
+                await self.process(batch)
+            except Exception:  # pylint: disable=W0703
+                log.exception("Failed to process batch of %d lines",
+                              len(batch))
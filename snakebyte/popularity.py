@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Hot-file detection and page-cache prefetching
+
+A handful of files usually account for most requests. `PopularityTracker`
+counts requests in a `CountMinSketch`, so memory stays fixed no matter how
+many distinct files are requested, and keeps a small exact list of the
+current top K.
+
+`snakebyte.pipeline.CommandPipeline` records each request it queues if
+given a tracker.
+
+`Prefetcher` uses `snakebyte.queue.FairQueue.peek` to see which files the
+queue will serve next (plus, optionally, the hottest files) and asks the
+kernel to start reading them into the page cache, so a transfer's first
+reads don't stall on a cold disk. ``posix_fadvise(POSIX_FADV_WILLNEED)`` is
+the only mechanism used, so where it isn't available (eg. on Windows or
+macOS), prefetching does nothing.
+"""
+
+__author__  = "Stephan Sokolow (deitarion/SSokolow)"
+__license__ = "GNU GPL 3.0 or later"
+__docformat__ = "restructuredtext en"
+
+import logging, os
+from array import array
+log = logging.getLogger(__name__)
+
+try:                                                      # pragma: no cover
+    from collections import OrderedDict
+    OrderedDict  # Silence erroneous PyFlakes warning
+except ImportError:                                       # pragma: no cover
+    from ordereddict import OrderedDict
+
+from snakebyte.resume import ResumeEntry
+
+def advise_willneed(path, offset=0, length=0):
+    """Ask the kernel to start reading part of a file into the page cache
+    without waiting for it.
+
+    :Parameters:
+      offset : `int`
+        Where to start prefetching.
+      length : `int`
+        How many bytes to prefetch. ``0`` means to the end of the file.
+
+    :returns: Whether the advice was given. (``False`` where
+        ``posix_fadvise`` is unavailable or the file couldn't be opened.)
+    """
+    if not hasattr(os, 'posix_fadvise'):
+        return False
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError as err:
+        log.debug("Could not prefetch %s: %s", path, err)
+        return False
+    try:
+        os.posix_fadvise(fd, offset, length, os.POSIX_FADV_WILLNEED)
+    except OSError as err:
+        log.debug("Could not prefetch %s: %s", path, err)
+        return False
+    finally:
+        os.close(fd)
+    return True
+
+class CountMinSketch(object):
+    """Approximate counts for an unbounded set of items in fixed memory.
+
+    Estimates never undercount, and overcount by more than
+    ``e * total / width`` with a probability of at most ``e ** -depth``.
+    """
+
+    def __init__(self, width=2048, depth=4):
+        """
+        :Parameters:
+          width : `int`
+            Counters per row. Larger values reduce overcounting.
+          depth : `int`
+            Rows, each with an independent hash. Larger values reduce the
+            chance of a bad estimate.
+        """
+        self.width, self.depth = width, depth
+        self.total = 0  #: The sum of all counts added
+        self._rows = [array('L', [0]) * width for _ in range(depth)]
+
+    def _cells(self, item):
+        """Return the counter index for ``item`` in each row.
+
+        The rows' hashes are derived from the two halves of one 64-bit
+        ``hash()`` (Kirsch-Mitzenmacher double hashing), which keeps them
+        independent without hashing the item once per row.
+        """
+        value = hash(item) & 0xffffffffffffffff
+        low, high = value & 0xffffffff, (value >> 32) | 1
+        return [(low + row * high) % self.width for row in range(self.depth)]
+
+    def add(self, item, count=1):
+        """Count ``item`` and return its new estimated count"""
+        self.total += count
+        estimate = None
+        for row, cell in zip(self._rows, self._cells(item)):
+            row[cell] += count
+            if estimate is None or row[cell] < estimate:
+                estimate = row[cell]
+        return estimate
+
+    def decay(self):
+        """Halve every count, so that old popularity fades"""
+        self.total //= 2
+        for row in self._rows:
+            for cell, value in enumerate(row):
+                if value:
+                    row[cell] = value >> 1
+
+    def estimate(self, item):
+        """Return the estimated count for ``item``"""
+        return min(row[cell] for row, cell in
+                   zip(self._rows, self._cells(item)))
+
+class PopularityTracker(object):
+    """Track how often each file is requested and which are hottest.
+
+    Call `record` whenever a file is requested (eg. when it's queued).
+
+    Items must be hashable but needn't be comparable, since ties in `top`
+    are broken by how long each item has been in the top K.
+    """
+
+    def __init__(self, top_k=20, width=2048, depth=4):
+        """
+        :Parameters:
+          top_k : `int`
+            How many of the most requested items to keep track of.
+          width, depth : `int`
+            The dimensions of the underlying `CountMinSketch`.
+        """
+        self.top_k = top_k
+        self.sketch = CountMinSketch(width, depth)
+        #: ``{item: estimated count}`` for the top K, in order of entry
+        self._top = OrderedDict()
+
+    def __contains__(self, item):
+        """Implements ``item in tracker`` as "item is in the top K"."""
+        return item in self._top
+
+    def decay(self):
+        """Halve every count, so that recent requests outweigh old ones"""
+        self.sketch.decay()
+        for item in self._top:
+            self._top[item] //= 2
+
+    def estimate(self, item):
+        """Return the estimated number of requests for ``item``"""
+        return self.sketch.estimate(item)
+
+    def record(self, item, count=1):
+        """Count a request for ``item``.
+
+        :returns: The item's new estimated count.
+        """
+        estimate = self.sketch.add(item, count)
+        if item in self._top or len(self._top) < self.top_k:
+            self._top[item] = estimate
+        else:
+            coldest = min(self._top, key=self._top.get)
+            if estimate > self._top[coldest]:
+                del self._top[coldest]
+                self._top[item] = estimate
+        return estimate
+
+    def top(self, count=None):
+        """Return up to ``count`` ``(item, estimated_count)`` pairs for the
+        most requested items, hottest first. Among equally hot items, those
+        which entered the top K first come first."""
+        ranked = sorted(self._top.items(), key=lambda x: -x[1])  # (Stable)
+        return ranked if count is None else ranked[:count]
+
+class Prefetcher(object):
+    """Warm the page cache for the files a `FairQueue` will serve next.
+
+    Call `prefetch` whenever the queue may have changed.
+    `snakebyte.transfer.TransferEngine` does so after filling its slots if
+    given one.
+    """
+
+    def __init__(self, queue, resolve_cb=None, lookahead=4, tracker=None,
+                 hot=0, length=8 * 1024 * 1024, advise_cb=advise_willneed,
+                 remember=256):
+        """
+        :Parameters:
+          queue : `snakebyte.queue.FairQueue`
+            The queue to look ahead in.
+          resolve_cb : ``function(value)``
+            Maps a queue entry to a path. Entries are used as paths
+            directly if none is provided.
+          lookahead : `int`
+            How many upcoming queue entries to prefetch.
+          tracker : `PopularityTracker`
+            If provided, the ``hot`` most requested items are prefetched
+            too. (They are resolved with ``resolve_cb``.)
+          hot : `int`
+            See ``tracker``.
+          length : `int`
+            How many bytes to prefetch from where each transfer will start
+            (the resume offset for a `snakebyte.resume.ResumeEntry`). ``0``
+            means to the end of the file.
+          advise_cb : ``function(path, offset, length)``
+            Issues the prefetch. (For testing or alternative mechanisms.)
+          remember : `int`
+            How many recently prefetched regions to remember so they aren't
+            advised again while they're likely still cached.
+        """
+        self.queue, self.lookahead = queue, lookahead
+        self.resolve_cb = resolve_cb or (lambda value: value)
+        self.tracker, self.hot, self.length = tracker, hot, length
+        self.advise_cb, self.remember = advise_cb, remember
+
+        self._recent, self._generation = OrderedDict(), None
+
+    def prefetch(self):
+        """Advise the kernel about upcoming files not advised recently.
+
+        Does nothing if the queue hasn't changed since the last call.
+
+        :returns: The paths which were advised, in order.
+        """
+        if self.queue.generation == self._generation:
+            return []
+        self._generation = self.queue.generation
+
+        items = [value for _, value in self.queue.peek(self.lookahead)]
+        if self.tracker is not None and self.hot:
+            items.extend(item for item, _ in self.tracker.top(self.hot))
+
+        advised = []
+        for item in items:
+            offset = 0
+            if isinstance(item, ResumeEntry):
+                item, offset = item.value, item.offset
+            path = self.resolve_cb(item)
+            if (path, offset) in self._recent:
+                # Still likely cached. Refresh it in the LRU order.
+                self._recent[(path, offset)] = self._recent.pop((path, offset))
+                continue
+            if self.advise_cb(path, offset, self.length):
+                advised.append(path)
+            self._recent[(path, offset)] = True
+            while len(self._recent) > self.remember:
+                self._recent.popitem(last=False)
+        return advised
@@ -16,6 +16,12 @@ __docformat__ = "restructuredtext en"
 import heapq, logging, time
 log = logging.getLogger(__name__)
 
+try:                                                      # pragma: no cover
+    from collections import OrderedDict
+    OrderedDict  # Silence erroneous PyFlakes warning
+except ImportError:                                       # pragma: no cover
+    from ordereddict import OrderedDict
+
 class FairQueue(object):
     """A queue that maximizes fairness via the following properties:
 
@@ -42,6 +48,16 @@ class FairQueue(object):
     to force a recalculation of a specific bucket's priority once a download's
     total time to completion has become known.)
 
+    Buckets may also be given privilege classes (eg. channel ops, voiced
+    users, and everyone else) with weighted shares of the service. Classful
+    queues replace the timestamps with stride scheduling: each bucket has a
+    "pass" value, serving it advances that pass by ``1 / weight`` of its
+    class, and the bucket with the lowest pass is served next. A bucket
+    with twice the weight is therefore served twice as often, but a waiting
+    bucket's pass stands still while the queue's virtual time (`vtime`)
+    catches up to it, so every bucket ages into first place eventually and
+    nobody can be starved no matter how many privileged users are queued.
+
     Naturally, it need not only be used for users and lists of files.
 
     Its API follows that of the ``dict`` built-in wherever possible,
@@ -69,7 +85,8 @@ class FairQueue(object):
            with those who requested much bigger files.
     """
 
-    def __init__(self, contents=None, priority_cb=None):
+    def __init__(self, contents=None, priority_cb=None, class_weights=None,
+                 class_cb=None, max_stats=1024):
         """Initialize the queue, storing any provided initial state
         using a batch-adding algorithm if available.
 
@@ -82,11 +99,31 @@ class FairQueue(object):
             when updating the queue. Lesser values are considered more urgent.
 
             ``lambda key: time.time()`` will be used if none is provided.
+            Not consulted if ``class_weights`` is provided.
+          class_weights : `dict`
+            ``{class: weight}`` giving each privilege class its share of
+            the service. Providing this makes the queue classful. Classes
+            which aren't listed get a weight of 1.
+          class_cb : ``function(key)``
+            A callback which returns the privilege class for a newly added
+            bucket. Every bucket is in class ``None`` if none is provided.
+          max_stats : `int`
+            The most keys to keep `transfer_stats` for before forgetting
+            the least recently reported.
         """
         self.priority_cb = priority_cb
         if not self.priority_cb:
             self.priority_cb = lambda key: time.time()
 
+        self.class_weights = class_weights
+        self.class_cb = class_cb or (lambda key: None)
+        self.max_stats = max_stats
+
+        #: Incremented by every method which changes the queue's contents
+        #: so that views of it (eg. listings) know when they're stale.
+        #: Changes made through lists returned by `__getitem__` don't count.
+        self.generation = 0
+
         # Initialize the internal data structures
         self.clear()
 
@@ -100,7 +137,7 @@ class FairQueue(object):
             if key in self._subqueues:
                 log.warning("Bucket already queued. Merging: %s", key)
             else:
-                heapq.heappush(self._buckets, (self.priority_cb(key), key))
+                self._schedule(key)
             self._subqueues.setdefault(key, []).extend(values)
 
     def __contains__(self, item):
@@ -110,13 +147,14 @@ class FairQueue(object):
     def __delitem__(self, key):
         """Remove the specified bucket and all its entries from the queue."""
         if key in self._subqueues:
-            # Remove the subqueue
+            # Remove the subqueue and anything else tied to the bucket
             del self._subqueues[key]
+            self.generation += 1
+            self._classes.pop(key, None)
 
-            # ...and find and remove the entry in the heap
-            for entry in self._find_key_in_heap(key):
-                self._buckets.remove(entry)
-            heapq.heapify(self._buckets)
+            # ...and remove the entry in the heap
+            if key in self._positions:
+                self._heap_remove(key)
         else:
             raise KeyError(repr(key))
 
@@ -149,31 +187,103 @@ class FairQueue(object):
             if sq:
                 return True
         return False
+    __bool__ = __nonzero__
 
     def __setitem__(self, key, value):
         """Add/replace an entire bucket's subqueue at once"""
         self._add_to_heap(key)
         self._subqueues[key] = value
+        self.generation += 1
 
     def _add_to_heap(self, key):
         """Common code for adding a key to the heap if not already present."""
         if key not in self._subqueues:
-            heapq.heappush(self._buckets, (self.priority_cb(key), key))
-
-    def _find_key_in_heap(self, key):
-        """Common code for finding a bucket in the heap.
-
-        :rtype: ``tuple``
-        :returns: A list of matching entries suitable for ``heap.find()``.
-
-        :note: This is designed on the assumption that `pop` calls without
-               a specific bucket key will happen overwhelmingly more often.
+            self._schedule(key)
+
+    def _heap_remove(self, key):
+        """Remove a bucket's entry from the heap in ``O(log n)`` time."""
+        pos = self._positions.pop(key)
+        last = self._buckets.pop()
+        if pos < len(self._buckets):
+            self._buckets[pos] = last
+            self._sift(pos)
+
+    def _schedule(self, key):
+        """Place a bucket in the heap (or move it) as if it had just been
+        serviced."""
+        pos = self._positions.get(key)
+        if self.class_weights is None:
+            priority = self.priority_cb(key)
+        elif pos is None:
+            cls = self.get_class(key)
+            priority = self.vtime + 1.0 / self.class_weights.get(cls, 1)
+        else:
+            priority = (max(self._buckets[pos][0], self.vtime) +
+                        1.0 / self._weight(key))
+
+        if pos is None:
+            pos = len(self._buckets)
+            self._buckets.append(None)
+            if self.class_weights is not None:
+                # Only now is there a bucket for the class to expire with
+                self._classes.setdefault(key, cls)
+        self._buckets[pos] = (priority, key)
+        self._sift(pos)
+
+    def _sift(self, pos):
+        """Restore the heap invariant after the entry at ``pos`` has been
+        replaced, keeping `_positions` up to date for every entry moved.
+
+        This is the ``heapq`` algorithm, but ``heapq`` can't report where
+        entries end up, and knowing that is what makes reprioritizing a
+        specific bucket ``O(log n)`` rather than ``O(n)``.
         """
-        return [x for x in self._buckets if x[1] == key]
+        heap, positions = self._buckets, self._positions
+        entry, end = heap[pos], len(heap)
+
+        while pos:
+            parent = (pos - 1) >> 1
+            if not entry < heap[parent]:
+                break
+            heap[pos] = heap[parent]
+            positions[heap[pos][1]] = pos
+            pos = parent
+
+        while True:
+            child = 2 * pos + 1
+            if child >= end:
+                break
+            if child + 1 < end and heap[child + 1] < heap[child]:
+                child += 1
+            if not heap[child] < entry:
+                break
+            heap[pos] = heap[child]
+            positions[heap[pos][1]] = pos
+            pos = child
+
+        heap[pos] = entry
+        positions[entry[1]] = pos
+
+    def _weight(self, key):
+        """Return the weight of a bucket's privilege class"""
+        return self.class_weights.get(self.get_class(key), 1)
 
     def clear(self):
         """Empty the queue in constant time"""
         self._buckets, self._subqueues = [], {}
+        self._positions, self._classes = {}, {}
+        self.generation += 1
+
+        #: The pass value of the last bucket served in a classful queue.
+        #: Newly added buckets are placed one stride beyond it.
+        self.vtime = 0
+
+        #: ``{key: (transfers, bytes, seconds)}`` as reported via
+        #: `record_transfer`, for up to ``max_stats`` keys in order of last
+        #: report. Kept after a bucket empties, since a user's history still
+        #: matters when they queue again. ``priority_cb`` may consult this.
+        #: It is not included in `dump`.
+        self.transfer_stats = OrderedDict()
 
     def dump(self):
         """Serialize all state necessary to save the queue to disk using a
@@ -183,10 +293,108 @@ class FairQueue(object):
         """
         return self._buckets[:], self._subqueues.copy()
 
+    def extend(self, key, values):
+        """Add several values to the specified bucket in one operation,
+        creating the bucket if necessary.
+
+        Equivalent to calling `push` once per value, but the bucket's heap
+        entry is only looked at once.
+
+        :Parameters:
+         - `key` Any hashable identifier.
+         - `values` An iterable of values to enqueue in order.
+
+        :raises TypeError: The given ``key`` was not hashable
+        """
+        values = list(values)
+        if values:
+            self._add_to_heap(key)
+            self._subqueues.setdefault(key, []).extend(values)
+            self.generation += 1
+
+    def get_class(self, key):
+        """Return a bucket's privilege class, asking ``class_cb`` the first
+        time the bucket is seen.
+
+        The answer is only remembered for buckets which are queued, so
+        asking about other keys can't leave stale assignments behind.
+        """
+        if key in self._classes:
+            return self._classes[key]
+        cls = self.class_cb(key)
+        if key in self._positions:
+            self._classes[key] = cls
+        return cls
+
+    def iter_ordered(self):
+        """Lazily iterate through all non-empty bucket IDs (keys) in the
+        same order as `__iter__`.
+
+        Rather than sorting every bucket up front, this walks the heap in
+        order, so taking the first ``k`` keys costs ``O(k log k)`` no
+        matter how many buckets are queued.
+
+        :raises RuntimeError: The queue changed during iteration.
+        """
+        heap, generation = self._buckets, self.generation
+        fresh = [(heap[0], 0)] if heap else []
+        while fresh:
+            if self.generation != generation:
+                raise RuntimeError("FairQueue changed during iteration")
+            (_, key), pos = heapq.heappop(fresh)
+            for child in (2 * pos + 1, 2 * pos + 2):
+                if child < len(heap):
+                    heapq.heappush(fresh, (heap[child], child))
+            if self._subqueues.get(key):
+                yield key
+
     def keys(self):
         """Return a list of all non-empty buckets"""
         return list(self)
 
+    def peek(self, count=1):
+        """Return the next ``count`` ``(key, value)`` pairs that `pop` would
+        return, in order, without changing the queue.
+
+        Rescheduling a bucket which appears more than once is predicted
+        exactly for classful queues. Otherwise, ``priority_cb`` can't be
+        called without side effects, so a bucket is assumed to go to the
+        back of the line after being served, which is what the default
+        timestamp priorities do.
+
+        Only the part of the heap the answer comes from is examined, so
+        this takes ``O(count log count)`` time regardless of queue size.
+
+        :rtype: `list`
+        """
+        heap, classful = self._buckets, self.class_weights is not None
+        fresh = [(heap[0], 0)] if heap else []
+        served, taken, result = [], {}, []
+
+        while len(result) < count and (fresh or served):
+            if served and (not fresh or
+                           (classful and served[0] < fresh[0][0])):
+                priority, key = heapq.heappop(served)
+            else:
+                (priority, key), pos = heapq.heappop(fresh)
+                for child in (2 * pos + 1, 2 * pos + 2):
+                    if child < len(heap):
+                        heapq.heappush(fresh, (heap[child], child))
+
+            subqueue, index = self._subqueues.get(key, ()), taken.get(key, 0)
+            if index >= len(subqueue):
+                continue
+            result.append((key, subqueue[index]))
+            taken[key] = index + 1
+
+            if index + 1 < len(subqueue):
+                if classful:
+                    heapq.heappush(served,
+                            (priority + 1.0 / self._weight(key), key))
+                else:
+                    heapq.heappush(served, (len(result), key))
+        return result
+
     def pop(self, key=None):
         """Remove and return the next item in the queue.
 
@@ -209,22 +417,22 @@ class FairQueue(object):
                 raise IndexError("Queue is empty")
 
             if heap_id is None:
-                _, heap_id = heapq.heappop(self._buckets)
-            else:
-                for entry in self._find_key_in_heap(heap_id):
-                    self._buckets.remove(entry)
-            heapq.heappush(self._buckets, (self.priority_cb(heap_id), heap_id))
+                priority, heap_id = self._buckets[0]
+                if self.class_weights is not None:
+                    self.vtime = max(self.vtime, priority)
+            self._schedule(heap_id)
 
             if heap_id in self._subqueues:
                 if self._subqueues[heap_id]:
                     result = heap_id, self._subqueues[heap_id].pop(0)
+                    self.generation += 1
                 if not self._subqueues[heap_id]:
                     del self[heap_id]
                     heap_id = None
             else:
                 log.error("Key in heap but not subqueues: %s", heap_id)
-                for entry in self._find_key_in_heap(heap_id):
-                    self._buckets.remove(entry)
+                self._heap_remove(heap_id)
+                self._classes.pop(heap_id, None)
                 heap_id = None
 
         return result
@@ -241,6 +449,63 @@ class FairQueue(object):
         """
         self._add_to_heap(key)
         self._subqueues.setdefault(key, []).append(value)
+        self.generation += 1
+
+    def record_transfer(self, key, nbytes, duration):
+        """Report that a value popped from the specified bucket has been
+        delivered, so that future prioritization can take download times
+        into account.
+
+        Statistics are kept whether or not the bucket still has entries
+        waiting (the last file a user requested usually finishes after
+        their bucket has emptied), but only for the ``max_stats`` most
+        recently reported keys.
+
+        :Parameters:
+         - `key` The bucket the delivered value was popped from.
+         - `nbytes` How many bytes were transferred.
+         - `duration` How long the transfer took, in seconds.
+
+        :rtype: `tuple`
+        :returns: The bucket's updated ``(transfers, bytes, seconds)``.
+        """
+        count, total_bytes, seconds = self.transfer_stats.pop(key, (0, 0, 0))
+        stats = self.transfer_stats[key] = (count + 1, total_bytes + nbytes,
+                                            seconds + duration)
+        while len(self.transfer_stats) > self.max_stats:
+            self.transfer_stats.popitem(last=False)
+        return stats
+
+    def set_class(self, key, cls):
+        """Move a bucket to a different privilege class (eg. because its
+        user was just opped) in ``O(log n)`` time.
+
+        In a classful queue, the bucket keeps the progress it has made
+        through its current wait and the remainder is rescaled to the new
+        class's weight.
+
+        Assignments last until the bucket expires and are not included in
+        `dump`, so ``class_cb`` will be asked again after `load`.
+
+        :raises KeyError: The requested subqueue does not exist.
+        """
+        if key not in self._subqueues:
+            raise KeyError(repr(key))
+
+        pos = self._positions.get(key)
+        if pos is None:
+            return  # Not really queued. (See the recovery branch in pop.)
+        elif self.class_weights is None:
+            self._classes[key] = cls
+            return
+
+        old_weight = self._weight(key)
+        self._classes[key] = cls
+        remaining = max(self._buckets[pos][0] - self.vtime, 0)
+        self._buckets[pos] = (self.vtime +
+                remaining * old_weight / self._weight(key), key)
+        self._sift(pos)
+        self.generation += 1
 
     @classmethod
     def load(cls, state, **kwargs):
@@ -264,4 +529,8 @@ class FairQueue(object):
         obj = cls(**kwargs)
         obj._buckets, obj._subqueues = state
         heapq.heapify(obj._buckets)
+        obj._positions = dict((key, pos)
+                              for pos, (_, key) in enumerate(obj._buckets))
+        if obj._buckets and obj.class_weights is not None:
+            obj.vtime = obj._buckets[0][0]
         return obj
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Resume offsets for interrupted DCC SENDs
+
+IRC clients drop often, and without a record of how far a transfer got,
+the file is requeued and sent again from the beginning. `ResumeStore`
+remembers the acknowledged offset of each interrupted transfer, keyed by
+the `snakebyte.queue.FairQueue` bucket and the
+`snakebyte.hashcache.file_identity` of what was being sent, so a record is
+never applied to a file which has since been modified.
+
+`snakebyte.transfer.TransferEngine` pushes interrupted transfers back into
+the queue as `ResumeEntry` objects carrying the offset so the retry can
+pick up where the last attempt stopped once the recipient asks to resume.
+Code which looks at queued values for other reasons should `unwrap` them.
+
+The store is bounded both in size (least recently used records are dropped
+first) and in time (records untouched for ``ttl`` seconds expire), and is
+saved with `snakebyte.atomic.write_json`.
+"""
+
+__author__  = "Stephan Sokolow (deitarion/SSokolow)"
+__license__ = "GNU GPL 3.0 or later"
+__docformat__ = "restructuredtext en"
+
+import logging, os, time
+from collections import namedtuple
+log = logging.getLogger(__name__)
+
+try:                                                      # pragma: no cover
+    from collections import OrderedDict
+    OrderedDict  # Silence erroneous PyFlakes warning
+except ImportError:                                       # pragma: no cover
+    from ordereddict import OrderedDict
+
+from snakebyte.atomic import read_json, write_json
+
+#: Version number written to (and required of) saved store files
+FORMAT_VERSION = 1
+
+#: A `FairQueue` entry being retried after an interrupted transfer.
+#: ``value`` is the original entry, ``offset`` the byte count the recipient
+#: acknowledged, ``identity`` the `file_identity` the offset applies to, and
+#: ``attempts`` how many times it has been requeued.
+ResumeEntry = namedtuple('ResumeEntry', 'value offset identity attempts')
+
+def unwrap(value):
+    """Return the original `FairQueue` entry for a value which may be a
+    `ResumeEntry`."""
+    return value.value if isinstance(value, ResumeEntry) else value
+
+def _freeze(obj):
+    """Convert the lists JSON produces back into (hashable) tuples"""
+    if isinstance(obj, list):
+        return tuple(_freeze(x) for x in obj)
+    return obj
+
+class ResumeStore(object):
+    """A bounded, persistent map of ``(key, identity)`` to resume offset.
+
+    Bucket keys must be JSON-serializable for `save` to work. Tuples are
+    saved as lists and converted back by `load`.
+    """
+
+    def __init__(self, path=None, max_entries=1024, ttl=7 * 86400,
+                 clock=time.time):
+        """
+        :Parameters:
+          path : `str`
+            Where to load and `save` the store. ``None`` disables
+            persistence.
+          max_entries : `int`
+            The most records to keep before dropping the least recently
+            used.
+          ttl : `float`
+            Seconds a record may go unused before it expires.
+          clock : ``function()``
+            The source of timestamps (for testing).
+        """
+        self.path, self.max_entries, self.ttl = path, max_entries, ttl
+        self.clock = clock
+        self.dirty = False  #: Whether there are unsaved changes
+
+        #: ``{(key, identity): (offset, last_used)}`` in order of last use
+        self._entries = OrderedDict()
+        if path and os.path.exists(path):
+            self.load()
+
+    def __contains__(self, item):
+        """Implements ``(key, identity) in store``"""
+        return item in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def discard(self, key, identity):
+        """Forget the record for a transfer (eg. because it completed)"""
+        if self._entries.pop((key, identity), None) is not None:
+            self.dirty = True
+
+    def expire(self, now=None):
+        """Drop records which haven't been used for ``ttl`` seconds.
+
+        :returns: The number of records dropped.
+        """
+        now = self.clock() if now is None else now
+        count = 0
+        while self._entries:
+            item, (_, last_used) = next(iter(self._entries.items()))
+            if now - last_used < self.ttl:
+                break
+            del self._entries[item]
+            count += 1
+        self.dirty = self.dirty or bool(count)
+        return count
+
+    def get(self, key, identity, default=0):
+        """Return the offset recorded for a transfer, or ``default``.
+
+        Looking a record up counts as using it.
+        """
+        now = self.clock()
+        self.expire(now)
+        entry = self._entries.pop((key, identity), None)
+        if entry is None:
+            return default
+        self._entries[(key, identity)] = (entry[0], now)
+        self.dirty = True
+        return entry[0]
+
+    def record(self, key, identity, offset):
+        """Remember how far a transfer got, replacing any previous record.
+
+        An ``offset`` of zero (nothing worth resuming) discards the record.
+        """
+        if offset <= 0:
+            self.discard(key, identity)
+            return
+
+        now = self.clock()
+        self._entries.pop((key, identity), None)
+        self._entries[(key, identity)] = (offset, now)
+        self.dirty = True
+
+        self.expire(now)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def load(self):
+        """Replace the contents of the store with those saved at `path`.
+
+        An unreadable or incompatible file is logged and treated as empty.
+        """
+        try:
+            saved = sorted(read_json(self.path, FORMAT_VERSION),
+                           key=lambda x: x[3])
+            entries = OrderedDict(((_freeze(x[0]), tuple(x[1])), (x[2], x[3]))
+                                  for x in saved)
+        except (IOError, OSError, ValueError, KeyError, TypeError,
+                IndexError) as err:
+            log.warning("Ignoring unusable resume store %s: %s",
+                        self.path, err)
+            entries = OrderedDict()
+
+        self._entries, self.dirty = entries, False
+        self.expire()
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def save(self):
+        """Write the store to `path` if it has unsaved changes"""
+        if not (self.path and self.dirty):
+            return
+        entries = [[key, list(identity), offset, last_used]
+                   for (key, identity), (offset, last_used)
+                   in self._entries.items()]
+        write_json(self.path, FORMAT_VERSION, entries)
+        self.dirty = False
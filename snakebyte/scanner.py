@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Parallel share scanner for the file catalog
+
+Walking a share one directory at a time spends most of its time waiting
+on the disk or network. `ShareScanner` keeps several directory listings in
+flight at once on a thread pool, using ``os.scandir`` so that file types
+come from the listing itself rather than a ``stat`` per entry.
+
+Concurrency is bounded per device (``st_dev``) so that one slow NFS mount
+or spinning disk isn't thrashed with more requests than it can serve, while
+other mounts proceed independently.
+
+Directories whose mtime hasn't changed since the previous scan aren't
+listed again. Their cached files are reused and only their subdirectories
+are ``stat``\\ ed to decide whether to descend further. A directory's mtime
+only reflects entries being added, removed, or renamed, so with
+``trust_dir_mtime`` enabled, a file modified in place inside an unchanged
+directory keeps its old size and mtime until that directory changes.
+"""
+
+__author__  = "Stephan Sokolow (deitarion/SSokolow)"
+__license__ = "GNU GPL 3.0 or later"
+__docformat__ = "restructuredtext en"
+
+import logging, os, stat, time
+from collections import deque, namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+log = logging.getLogger(__name__)
+
+from snakebyte.catalog import CatalogEntry
+
+#: How close (in seconds) to the start of a scan a directory's mtime may be
+#: before it's considered too fresh to trust. Guards against changes made
+#: within the filesystem's timestamp granularity of the listing.
+RACY_WINDOW = 2.0
+
+#: What `ShareScanner` remembers about a directory between scans. ``files``
+#: holds ``(name, size, mtime)`` tuples and ``subdirs`` holds names.
+DirState = namedtuple('DirState', 'mtime_ns files subdirs')
+
+class ShareScanner(object):
+    """Walk share roots in parallel, streaming `CatalogEntry` objects.
+
+    Pass one to `snakebyte.catalog.FileCatalog` as its ``scanner`` or call
+    `scan` directly. A scanner remembers the directories it has listed, so
+    reuse the same instance for every rescan of a share.
+    """
+
+    def __init__(self, max_workers=16, per_device=4, trust_dir_mtime=True):
+        """
+        :Parameters:
+          max_workers : `int`
+            The number of threads listing directories.
+          per_device : `int`
+            The maximum number of directories listed at once on any one
+            device.
+          trust_dir_mtime : `bool`
+            Reuse the previous listing of directories whose mtime hasn't
+            changed.
+        """
+        self.max_workers, self.per_device = max_workers, per_device
+        self.trust_dir_mtime = trust_dir_mtime
+
+        self.listed = self.reused = 0  #: Directory counts for the last scan
+        self._dirs = {}
+
+    def _visit(self, dirpath, mtime_ns, cutoff):
+        """List one directory. Runs on a worker thread.
+
+        :Parameters:
+          mtime_ns : `int`
+            The directory's mtime, as already ``stat``\\ ed by the caller.
+          cutoff : `int`
+            Directories modified after this (in nanoseconds) are too fresh
+            for their listing to be trusted next time.
+
+        :rtype: ``(DirState, list, bool)``
+        :returns: The directory's state, ``(name, st_dev, mtime_ns)`` for
+            each subdirectory, and whether a cached listing was reused.
+        """
+        cached = self._dirs.get(dirpath)
+        if (self.trust_dir_mtime and cached is not None and
+                cached.mtime_ns == mtime_ns):
+            subdirs = []
+            for name in cached.subdirs:
+                try:
+                    st = os.stat(os.path.join(dirpath, name),
+                                 follow_symlinks=False)
+                except OSError:
+                    continue  # Gone since, but the parent mtime lags
+                subdirs.append((name, st.st_dev, st.st_mtime_ns))
+            return cached, subdirs, True
+
+        files, subdirs = [], []
+        with os.scandir(dirpath) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir():
+                        # Like os.walk, don't follow symlinked directories
+                        if not entry.is_symlink():
+                            st = entry.stat(follow_symlinks=False)
+                            subdirs.append((entry.name, st.st_dev,
+                                            st.st_mtime_ns))
+                        continue
+                    st = entry.stat()
+                except OSError as err:
+                    log.warning("Could not stat %s: %s", entry.path, err)
+                    continue
+                if stat.S_ISREG(st.st_mode):
+                    files.append((entry.name, st.st_size, st.st_mtime))
+
+        state = DirState(mtime_ns if mtime_ns < cutoff else None, files,
+                         [x[0] for x in subdirs])
+        return state, subdirs, False
+
+    def scan(self, roots):
+        """Walk ``roots``, yielding results as directory listings complete.
+
+        Results from different directories (and roots) arrive in no
+        particular order.
+
+        :rtype: ``iterable`` of ``(root_index, CatalogEntry)``
+        """
+        cutoff = int((time.time() - RACY_WINDOW) * 1e9)
+        pending, inflight, futures, seen = {}, {}, {}, {}
+        self.listed = self.reused = 0
+
+        def enqueue(dev, job):
+            pending.setdefault(dev, deque()).append(job)
+            inflight.setdefault(dev, 0)
+
+        def dispatch():
+            for dev, jobs in pending.items():
+                while jobs and inflight[dev] < self.per_device:
+                    job = jobs.popleft()
+                    _, dirpath, _, mtime_ns = job
+                    future = executor.submit(self._visit, dirpath, mtime_ns,
+                                             cutoff)
+                    futures[future] = (dev, job)
+                    inflight[dev] += 1
+
+        for index, root in enumerate(roots):
+            try:
+                st = os.stat(root)
+            except OSError as err:
+                log.warning("Could not scan share root %s: %s", root, err)
+                continue
+            enqueue(st.st_dev, (index, root, '', st.st_mtime_ns))
+
+        executor = ThreadPoolExecutor(self.max_workers)
+        try:
+            dispatch()
+            while futures:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                ready = []
+                for future in done:
+                    dev, (index, dirpath, rel, _) = futures.pop(future)
+                    inflight[dev] -= 1
+                    try:
+                        state, subdirs, reused = future.result()
+                    except OSError as err:
+                        log.warning("Could not list %s: %s", dirpath, err)
+                        continue
+
+                    seen[dirpath] = state
+                    if reused:
+                        self.reused += 1
+                    else:
+                        self.listed += 1
+                    for name, sub_dev, mtime_ns in subdirs:
+                        enqueue(sub_dev, (index, os.path.join(dirpath, name),
+                                          rel + name + '/', mtime_ns))
+                    ready.append((index, dirpath, rel, state.files))
+
+                # Keep the workers busy while the caller consumes results
+                dispatch()
+                for index, dirpath, rel, files in ready:
+                    for name, size, mtime in files:
+                        yield index, CatalogEntry(rel + name,
+                                os.path.join(dirpath, name), size, mtime)
+        finally:
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=True)
+
+        # Only forget vanished directories after a complete scan
+        self._dirs = seen
@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Trigram index for substring and fuzzy ``!find`` over the file catalog
+
+`TrigramIndex` maps every three-character substring of every served path
+to the set of paths containing it. A substring query then only has to
+examine paths containing *all* of the query's trigrams, found by
+intersecting posting sets smallest-first, instead of scanning the whole
+share.
+
+Fuzzy (typo-tolerant) queries rank paths by how many trigrams they share
+with the query, which tolerates transpositions, omissions, and misspellings
+without needing an edit-distance computation per path. Only the rarest
+posting sets are walked to find candidates. The commonest are merely probed,
+and only for candidates which can still reach the minimum score.
+
+The index is built once from a `snakebyte.catalog.FileCatalog` and kept
+current by feeding it the `snakebyte.catalog.CatalogChanges` returned by
+each rescan.
+"""
+
+__author__  = "Stephan Sokolow (deitarion/SSokolow)"
+__license__ = "GNU GPL 3.0 or later"
+__docformat__ = "restructuredtext en"
+
+import heapq, logging, math
+from collections import defaultdict
+log = logging.getLogger(__name__)
+
+try:
+    from collections import OrderedDict
+except ImportError:  # pragma: no cover
+    from ordereddict import OrderedDict
+
+def trigrams(text):
+    """Return the set of three-character substrings of ``text``"""
+    return set(text[x:x + 3] for x in range(len(text) - 2))
+
+class TrigramIndex(object):
+    """An inverted index from trigrams to the paths containing them.
+
+    Paths are identified internally by small integers (recycled on removal)
+    so posting sets stay compact.
+    """
+
+    def __init__(self, paths=(), casefold=True):
+        """
+        :Parameters:
+          paths : ``iterable``
+            Paths to index immediately.
+          casefold : `bool`
+            If ``True``, queries ignore differences in case.
+        """
+        self.casefold = casefold
+        self.version = 0  #: Incremented whenever the indexed paths change
+
+        self._paths, self._folded, self._sizes = [], [], []
+        self._ids, self._free = {}, []
+        self._postings = defaultdict(set)
+        for path in paths:
+            self.add(path)
+
+    def __contains__(self, path):
+        return path in self._ids
+
+    def __len__(self):
+        return len(self._ids)
+
+    @classmethod
+    def from_catalog(cls, catalog, **kwargs):
+        """Build an index of every path in a
+        `snakebyte.catalog.FileCatalog`."""
+        return cls(catalog.paths(), **kwargs)
+
+    def _fold(self, text):
+        """Convert a path or query into the form which is indexed"""
+        return text.lower() if self.casefold else text
+
+    def add(self, path):
+        """Index a path. Adding an indexed path again has no effect."""
+        if path in self._ids:
+            return
+        folded = self._fold(path)
+        grams = trigrams(folded)
+        if self._free:
+            doc = self._free.pop()
+            self._paths[doc], self._folded[doc] = path, folded
+            self._sizes[doc] = len(grams)
+        else:
+            doc = len(self._paths)
+            self._paths.append(path)
+            self._folded.append(folded)
+            self._sizes.append(len(grams))
+        self._ids[path] = doc
+        for gram in grams:
+            self._postings[gram].add(doc)
+        self.version += 1
+
+    def remove(self, path):
+        """Stop indexing a path.
+
+        :raises KeyError: ``path`` isn't indexed.
+        """
+        doc = self._ids.pop(path)
+        for gram in trigrams(self._folded[doc]):
+            posting = self._postings[gram]
+            posting.discard(doc)
+            if not posting:
+                del self._postings[gram]
+        self._paths[doc] = self._folded[doc] = None
+        self._free.append(doc)
+        self.version += 1
+
+    def update(self, changes):
+        """Apply the `snakebyte.catalog.CatalogChanges` from a rescan.
+
+        Entries which merely changed size or mtime keep their path, so only
+        additions and removals touch the index.
+        """
+        for entry in changes.removed:
+            if entry.path in self._ids:
+                self.remove(entry.path)
+        for entry in changes.added:
+            self.add(entry.path)
+
+    def _scan(self, needle, limit):
+        """Yield the IDs of paths containing ``needle`` by brute force.
+        (For queries too short to have trigrams.)"""
+        found = 0
+        for doc, folded in enumerate(self._folded):
+            if folded is not None and needle in folded:
+                yield doc
+                found += 1
+                if found == limit:
+                    return
+
+    def search(self, query, limit=None):
+        """Return the indexed paths containing ``query``, sorted.
+
+        :Parameters:
+          limit : `int`
+            Stop looking once this many matches have been found. Which
+            matches are returned is then unspecified.
+        """
+        needle = self._fold(query)
+        grams = trigrams(needle)
+        if not grams:
+            return sorted(self._paths[x] for x in self._scan(needle, limit))
+
+        postings = []
+        for gram in grams:
+            posting = self._postings.get(gram)
+            if not posting:
+                return []
+            postings.append(posting)
+        postings.sort(key=len)
+
+        # Walk the rarest trigram's posting set and probe the rest, so the
+        # work done is bounded by the smallest set and ``limit``.
+        smallest, rest, matches = postings[0], postings[1:], []
+        for doc in smallest:
+            if all(doc in x for x in rest) and needle in self._folded[doc]:
+                matches.append(self._paths[doc])
+                if len(matches) == limit:
+                    break
+        matches.sort()
+        return matches
+
+    def fuzzy(self, query, limit=10, min_score=0.5):
+        """Return up to ``limit`` indexed paths resembling ``query``, best
+        match first.
+
+        Paths are scored by the fraction of the query's trigrams they
+        contain. Ties go to the path whose own trigrams are most similar to
+        the query's (by Dice coefficient) and then alphabetically, so an
+        exact match beats a longer path which merely contains the query.
+
+        :Parameters:
+          min_score : `float`
+            Omit paths scoring lower than this (between 0 and 1).
+
+        :rtype: ``list`` of ``(score, path)``
+        """
+        grams = trigrams(self._fold(query))
+        if not grams:
+            return [(1.0, x) for x in self.search(query, limit)]
+
+        postings = sorted((self._postings.get(x, ()) for x in grams), key=len)
+        size, cutoff = float(len(grams)), min_score * len(grams)
+        need = max(1, int(math.ceil(cutoff)))
+        if need > len(postings):
+            return []
+
+        # A path which shares none of the rarest ``len - need + 1`` trigrams
+        # can't reach ``need``, so only those sets are walked in full.
+        split, shared = len(postings) - need + 1, defaultdict(int)
+        for posting in postings[:split]:
+            for doc in posting:
+                shared[doc] += 1
+        for left, posting in zip(range(need - 2, -1, -1), postings[split:]):
+            for doc, count in list(shared.items()):
+                if doc in posting:
+                    shared[doc] = count + 1
+                elif count + left < need:
+                    del shared[doc]  # Can no longer reach the cutoff
+
+        best = heapq.nsmallest(limit,
+                ((-count / size, -2.0 * count / (size + self._sizes[doc]),
+                  self._paths[doc])
+                 for doc, count in shared.items() if count >= cutoff))
+        return [(-score, path) for score, _, path in best]
+
+class SuggestingArgTest(object):
+    """Wrap an ``arg_test_cb`` so that rejected arguments can be answered
+    with fuzzy suggestions from a `TrigramIndex`.
+
+    Calls are passed straight through to the wrapped callback (including its
+    ``prefix_aware`` flag), so lexing behaves exactly as before. `suggest`
+    results are cached until the index changes.
+
+    Its `version` follows the object owning the wrapped bound method, so
+    `snakebyte.commands.CompiledCommands` and
+    `snakebyte.shell_lexers.CachingLexer` still notice when that object
+    (eg. a `snakebyte.catalog.FileCatalog`) bumps its version.
+    """
+
+    def __init__(self, arg_test_cb, index, limit=5, maxsize=256):
+        """
+        :Parameters:
+          arg_test_cb : ``function(candidate_str, argv)``
+            The callback to delegate to.
+          index : `TrigramIndex`
+            Where suggestions come from.
+          limit : `int`
+            The maximum number of suggestions per argument.
+          maxsize : `int`
+            The maximum number of cached suggestion lists.
+        """
+        self.arg_test_cb, self.index = arg_test_cb, index
+        self.limit, self.maxsize = limit, maxsize
+        self.prefix_aware = getattr(arg_test_cb, 'prefix_aware', False)
+
+        self._cache, self._cache_version = OrderedDict(), index.version
+
+    def __call__(self, candidate_str, argv):
+        return self.arg_test_cb(candidate_str, argv)
+
+    @property
+    def version(self):
+        """The ``version`` of the object owning the wrapped callback, or
+        ``None`` if it has none."""
+        return getattr(getattr(self.arg_test_cb, '__self__', None),
+                       'version', None)
+
+    def check(self, candidate_str, argv=()):
+        """Test an argument, returning suggestions if it's rejected.
+
+        :rtype: ``(bool, list)``
+        :returns: Whether ``candidate_str`` was accepted and, if not, a list
+            of suggested paths.
+        """
+        result = self.arg_test_cb(candidate_str, list(argv))
+        if result:
+            return True, []
+        return False, self.suggest(candidate_str)
+
+    def suggest(self, candidate_str):
+        """Return up to ``limit`` indexed paths resembling
+        ``candidate_str``, best first."""
+        if self._cache_version != self.index.version:
+            self._cache.clear()
+            self._cache_version = self.index.version
+
+        result = self._cache.pop(candidate_str, None)
+        if result is None:
+            result = [x for _, x in self.index.fuzzy(candidate_str,
+                                                     self.limit)]
+        self._cache[candidate_str] = result
+        while len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+        return list(result)
@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Hierarchical token-bucket bandwidth shaping for transfers
+
+`BandwidthShaper` divides an upload cap among transfers at three levels:
+
+ - A **global** rate, produced as tokens which are split evenly between
+   the `FairQueue` buckets (users) which currently have a transfer running.
+   This mirrors the queue's own notion of fairness: one user with three
+   slots doesn't get three times the bandwidth of a user with one.
+ - An optional **per-bucket** ceiling on any one user's combined rate.
+ - An optional **per-slot** ceiling on any one transfer's rate.
+
+Capacity a bucket can't use (because it's capped, or its recipient's
+connection is slower than its share) overflows into a spare pool which
+any other bucket may borrow from, so the uplink doesn't sit idle while a
+slow user holds a share.
+
+Redistributing the global tokens costs ``O(active buckets)`` but happens
+at most once per ``tick``. Per-chunk accounting in `BandwidthShaper.grant`
+is a handful of arithmetic operations and a monotonic clock read.
+"""
+
+__author__  = "Stephan Sokolow (deitarion/SSokolow)"
+__license__ = "GNU GPL 3.0 or later"
+__docformat__ = "restructuredtext en"
+
+import logging, time
+log = logging.getLogger(__name__)
+
+class _Meter(object):
+    """A minimal token bucket for byte counts"""
+    __slots__ = ('rate', 'capacity', 'tokens', 'stamp')
+
+    def __init__(self, rate, capacity, now):
+        self.rate, self.capacity = rate, capacity
+        self.tokens, self.stamp = capacity, now
+
+    def available(self, now):
+        """Refill for the time elapsed and return the current balance"""
+        if now > self.stamp:
+            self.tokens = min(self.capacity,
+                              self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+        return self.tokens
+
+class _Bucket(object):
+    """Shaping state for one `FairQueue` bucket"""
+    __slots__ = ('slots', 'share', 'ceiling')
+
+    def __init__(self, ceiling):
+        self.slots, self.share, self.ceiling = 0, 0.0, ceiling
+
+class BandwidthShaper(object):
+    """Rate-limit transfers globally, per bucket, and per slot.
+
+    Transfers ("slots") must be `register`\\ ed with the `FairQueue` key
+    they belong to before calling `grant` and `unregister`\\ ed when done.
+    Slot identifiers may be any hashable object (eg. the transfer itself).
+
+    All rates are in bytes per second. ``None`` means unlimited.
+    """
+
+    def __init__(self, global_rate=None, bucket_rate=None, slot_rate=None,
+                 burst=0.1, tick=0.01, clock=time.monotonic):
+        """
+        :Parameters:
+          global_rate : `float`
+            The cap on the combined rate of all transfers.
+          bucket_rate : `float`
+            The cap on the combined rate of any one bucket's transfers.
+          slot_rate : `float`
+            The cap on the rate of any one transfer.
+          burst : `float`
+            How many seconds' worth of tokens each level may accumulate.
+          tick : `float`
+            The minimum interval between redistributions of global tokens.
+            This is also how long `delay` suggests waiting.
+          clock : ``function()``
+            Source of monotonic timestamps in seconds.
+        """
+        self.global_rate, self.bucket_rate = global_rate, bucket_rate
+        self.slot_rate, self.burst = slot_rate, burst
+        self.tick, self.clock = tick, clock
+
+        self.spare = 0.0  #: Global tokens any bucket may borrow
+        self._slots, self._buckets = {}, {}
+        self._stamp = clock()
+
+    def __len__(self):
+        return len(self._slots)
+
+    def _meter(self, rate, now):
+        """Build a ceiling `_Meter` for ``rate`` or ``None`` if unlimited"""
+        return None if rate is None else _Meter(rate, rate * self.burst, now)
+
+    def _redistribute(self, now):
+        """Split the global tokens produced since the last call between
+        the active buckets, spilling anything they can't hold into
+        `spare`."""
+        elapsed, self._stamp = now - self._stamp, now
+        if self.global_rate is None or elapsed <= 0:
+            return
+
+        produced = self.global_rate * elapsed
+        capacity = self.global_rate * self.burst
+        if self._buckets:
+            share = produced / len(self._buckets)
+            room = capacity / len(self._buckets)
+            produced = 0.0
+            for bucket in self._buckets.values():
+                added = min(share, max(0.0, room - bucket.share))
+                bucket.share += added
+                produced += share - added
+        self.spare = min(capacity, self.spare + produced)
+
+    def delay(self, slot=None):
+        """Suggest how long a slot which was granted nothing should wait
+        before asking again."""
+        return self.tick
+
+    def grant(self, slot, want, now=None):
+        """Ask permission to send up to ``want`` bytes and deduct whatever
+        is granted from every level's allowance.
+
+        :rtype: `int`
+        :returns: The number of bytes which may be sent now (possibly 0).
+        :raises KeyError: ``slot`` was never registered.
+        """
+        now = self.clock() if now is None else now
+        if now - self._stamp >= self.tick:
+            self._redistribute(now)
+
+        meter, key = self._slots[slot]
+        bucket = self._buckets[key]
+        allowed = float(want)
+        if meter is not None:
+            allowed = min(allowed, meter.available(now))
+        if bucket.ceiling is not None:
+            allowed = min(allowed, bucket.ceiling.available(now))
+
+        if self.global_rate is not None:
+            # Round down before deducting so the fractional remainder of a
+            # small share carries over to the next call instead of vanishing
+            allowed = int(min(allowed, bucket.share + self.spare))
+            own = min(allowed, bucket.share)
+            bucket.share -= own
+            self.spare -= allowed - own
+        else:
+            allowed = int(allowed)
+
+        if meter is not None:
+            meter.tokens -= allowed
+        if bucket.ceiling is not None:
+            bucket.ceiling.tokens -= allowed
+        return allowed
+
+    def refund(self, slot, unused):
+        """Return tokens for bytes which were granted but not sent (eg.
+        because the socket buffer was full)."""
+        meter, key = self._slots[slot]
+        bucket = self._buckets[key]
+        if meter is not None:
+            meter.tokens += unused
+        if bucket.ceiling is not None:
+            bucket.ceiling.tokens += unused
+        if self.global_rate is not None:
+            bucket.share += unused
+
+    def register(self, slot, key):
+        """Start shaping a transfer belonging to the bucket ``key``"""
+        now = self.clock()
+        self._redistribute(now)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = _Bucket(
+                    self._meter(self.bucket_rate, now))
+        bucket.slots += 1
+        self._slots[slot] = (self._meter(self.slot_rate, now), key)
+
+    def unregister(self, slot):
+        """Stop shaping a transfer. Unused share is released to `spare`."""
+        _, key = self._slots.pop(slot)
+        bucket = self._buckets[key]
+        bucket.slots -= 1
+        if not bucket.slots:
+            del self._buckets[key]
+            if self.global_rate is not None:
+                self.spare = min(self.global_rate * self.burst,
+                                 self.spare + bucket.share)
@@ -1,21 +1,55 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-"""A selection of lexers for tokenizing shell command lines
-
-:todo: Figure out how to remove shlex from the coverage report
-"""
+"""A selection of lexers for tokenizing shell command lines"""
 
 __author__  = "Stephan Sokolow (deitarion/SSokolow)"
 __license__ = "GNU GPL 3.0 or later"
 __docformat__ = "restructuredtext en"
 
-import logging, shlex
+import logging, re, threading
 log = logging.getLogger(__name__)
 
+try:                                                      # pragma: no cover
+    from collections import OrderedDict
+    OrderedDict  # Silence erroneous PyFlakes warning
+except ImportError:                                       # pragma: no cover
+    from ordereddict import OrderedDict
+
+try:                                                      # pragma: no cover
+    basestring
+except NameError:                                         # pragma: no cover
+    basestring = str  # pylint: disable=W0622
+
 #: Just an internal convenience to avoid duplication
 _not_implemented_msg = ("This class merely specifies an interface. "
                         "You must subclass it to use it.")
 
+#: Characters ``shlex`` treats as whitespace in its default configuration
+_POSIX_WS = ' \t\r\n'
+
+#: Matches any character which forces `posix_lexer` off its fast path
+_posix_special_re = re.compile(r'[\'"\\]')
+
+#: Matches whole tokens for command lines without quotes or escapes
+_posix_word_re = re.compile(r'[^%s]+' % _POSIX_WS)
+
+#: Matches one run of characters which can't change the lexer's state.
+#: The final ``error`` alternative only matches unterminated constructs.
+_posix_piece_re = re.compile(r"""
+     (?P<space>[%(ws)s]+)
+    |(?P<plain>[^%(ws)s'"\\]+)
+    |\\(?P<escape>.)
+    |'(?P<single>[^']*)'
+    |"(?P<double>(?:[^"\\]|\\.)*)"
+    |(?P<error>.)
+""" % {'ws': _POSIX_WS}, re.DOTALL | re.VERBOSE)
+
+#: Matches the escapes which are honoured inside double quotes
+_posix_dq_escape_re = re.compile(r'\\(["\\])')
+
+#: Matches the longest possible prefix of an unterminated double-quoted string
+_posix_dq_prefix_re = re.compile(r'"(?:[^"\\]|\\.)*', re.DOTALL)
+
 class LexerInterface(object):
     """A template for creating lexers which take parameters both on
     initialization and on being invoked.
@@ -108,8 +142,10 @@ mirc_lexer.name = 'mirc'
 def posix_lexer(cmd_string, commands):  # pylint: disable=W0613
     """This lexer implements POSIX-like command-line parsing.
 
-    More specifically, it wraps Python's ``shlex.split`` in the default
-    POSIX-like mode.
+    More specifically, it reproduces the output and errors of Python's
+    ``shlex.split`` in the default POSIX-like mode, but tokenizes in a single
+    regex-driven pass over runs of characters rather than reading one
+    character at a time through a stream object.
 
     :Parameters:
         - `cmd_string` A raw command-line string
@@ -121,11 +157,329 @@ def posix_lexer(cmd_string, commands):  # pylint: disable=W0613
     :raises ValueError: Failed to parse the provided command line.
     """
 
-    # If None somehow gets passed in, prevent it from triggering a stdin leak.
-    return shlex.split(cmd_string or '')
+    # If None somehow gets passed in, treat it like shlex would treat ''
+    cmd_string = cmd_string or ''
+
+    # Most command lines contain no quotes or escapes at all
+    if not _posix_special_re.search(cmd_string):
+        return _posix_word_re.findall(cmd_string)
+    return _posix_split(cmd_string)[0]
 posix_lexer.name = 'posix'
 
-#TODO: Implement the smart lexer
+def _posix_split(cmd_string):
+    """Tokenize like `posix_lexer` but also return where each token was found.
+
+    :rtype: ``(list, list)``
+    :returns: The tokens and a parallel list of ``(start, end)`` offsets
+        into ``cmd_string`` covering each token's raw (unlexed) text.
+
+    :raises ValueError: Failed to parse the provided command line.
+    """
+    if not _posix_special_re.search(cmd_string):
+        matches = list(_posix_word_re.finditer(cmd_string))
+        return [x.group() for x in matches], [x.span() for x in matches]
+
+    tokens, spans, token, start = [], [], [], None
+    for match in _posix_piece_re.finditer(cmd_string):
+        kind = match.lastgroup
+        if kind == 'space':
+            if start is not None:
+                tokens.append(''.join(token))
+                spans.append((start, match.start()))
+                token, start = [], None
+            continue
+        elif kind == 'double':
+            value = match.group(kind)
+            if '\\' in value:
+                value = _posix_dq_escape_re.sub(r'\1', value)
+            token.append(value)
+        elif kind == 'error':
+            _posix_raise(cmd_string, match.start())
+        else:
+            token.append(match.group(kind))
+        if start is None:
+            start = match.start()
+
+    if start is not None:
+        tokens.append(''.join(token))
+        spans.append((start, len(cmd_string)))
+    return tokens, spans
+
+def _posix_raise(cmd_string, pos):
+    """Raise the same ``ValueError`` ``shlex`` would for a construct left
+    unterminated at ``pos``.
+
+    :raises ValueError: Always.
+    """
+    char = cmd_string[pos]
+    if char == '"':
+        # An escape consuming the final character takes priority over the
+        # missing quote, just as it does in shlex's state machine.
+        end = _posix_dq_prefix_re.match(cmd_string, pos).end()
+        if end < len(cmd_string):
+            char = cmd_string[end]
+
+    if char == '\\':
+        raise ValueError("No escaped character")
+    raise ValueError("No closing quotation")
+
+class _ArgPrefix(object):
+    """Type of the `ARG_PREFIX` singleton"""
+    def __repr__(self):
+        return 'ARG_PREFIX'
+
+    def __nonzero__(self):
+        """Evaluate as ``False`` so that callers which don't know about
+        prefixes treat it as a rejection."""
+        return False
+    __bool__ = __nonzero__
+
+#: May be returned by an ``arg_test_cb`` with a true ``prefix_aware``
+#: attribute to indicate that ``candidate_str`` is not valid by itself but
+#: is the prefix of something which is. (It evaluates as ``False``.)
+ARG_PREFIX = _ArgPrefix()
+
+class SmartLexer(LexerInterface):
+    """A lexer which uses the hints in ``commands`` to accept unquoted
+    arguments (eg. filenames) which contain spaces.
+
+    Tokenizing starts out identical to `posix_lexer`. Then, if ``argv[0]``
+    has an ``arg_test_cb``, each run of consecutive unquoted tokens which
+    doesn't begin with a member of ``opts_list`` is rejoined (preserving the
+    original whitespace) into the longest candidate the callback accepts.
+    Tokens which were quoted or escaped are never joined with their
+    neighbours, so quoting always behaves as it would with `posix_lexer`.
+
+    If the command line has unbalanced quotes (eg. ``The O'Neill story.txt``)
+    and ``argv[0]`` has an ``arg_test_cb``, the lexer falls back to splitting
+    on whitespace alone and joins the raw words instead. The original
+    ``ValueError`` is still raised if that leaves any argument containing a
+    quote or backslash which ``arg_test_cb`` doesn't accept.
+
+    To avoid calling ``arg_test_cb`` ``N**2`` times, candidates are never
+    longer than ``max_words`` tokens and each candidate span is tested at
+    most once per call:
+
+     - Plain callbacks are tried longest-first, so the common case of a
+       filename running to the end of the line costs a single call.
+     - Callbacks with a true ``prefix_aware`` attribute are tried
+       shortest-first and the search stops at the first candidate which is
+       neither valid nor `ARG_PREFIX`, so the number of calls is linear in
+       the number of tokens.
+    """
+    name = 'smart'
+
+    def __init__(self, max_words=16, *args, **kwargs):
+        """
+        :Parameters:
+          max_words : `int`
+            The maximum number of whitespace-separated words which will be
+            joined into a single argument.
+        """
+        self.max_words = max_words
+
+    def __call__(self, cmd_string, commands):
+        """Parse a command line into a ``sys.argv``-compatible list.
+
+        See `LexerInterface.__call__` for details.
+        """
+        cmd_string, error = cmd_string or '', None
+        try:
+            tokens, spans = _posix_split(cmd_string)
+        except ValueError as err:
+            matches = list(_posix_word_re.finditer(cmd_string))
+            if not self._get_hints(commands, matches[0].group())[1]:
+                raise
+            error = err
+            tokens = [x.group() for x in matches]
+            spans = [x.span() for x in matches]
+
+        if not tokens:
+            return []
+        opts_list, arg_test_cb = self._get_hints(commands, tokens[0])
+        if not arg_test_cb:
+            return tokens
+
+        unquoted = [cmd_string[start:end] == token
+                    for token, (start, end) in zip(tokens, spans)]
+
+        argv, pos = tokens[:1], 1
+        while pos < len(tokens):
+            end = pos
+            if tokens[pos] not in opts_list:
+                end = self._longest_arg(cmd_string, tokens, spans, unquoted,
+                                        pos, arg_test_cb, argv)
+            if end == pos:
+                if (error is not None and tokens[pos] not in opts_list and
+                        _posix_special_re.search(tokens[pos]) and
+                        not arg_test_cb(tokens[pos], argv)):
+                    # Nothing valid explains the stray quote or backslash
+                    raise ValueError(*error.args)
+                argv.append(tokens[pos])
+            else:
+                argv.append(cmd_string[spans[pos][0]:spans[end][1]])
+            pos = end + 1
+        return argv
+
+    @staticmethod
+    def _get_hints(commands, name):
+        """Look up ``(opts_list, arg_test_cb)`` for a command, tolerating
+        missing entries and non-string values in ``opts_list``.
+
+        If ``commands`` is a `snakebyte.commands.CompiledCommands`, its
+        precomputed lookup (which also resolves abbreviations) is used.
+        """
+        hints = getattr(commands, 'hints', None)
+        if hints is not None:
+            return hints(name)
+        opts_list, arg_test_cb = (commands or {}).get(name) or ((), None)
+        return [x for x in opts_list or () if isinstance(x, basestring)
+                ], arg_test_cb
+
+    def _longest_arg(self, cmd_string, tokens, spans, unquoted, pos,
+                     arg_test_cb, argv):
+        """Find the last token of the longest valid argument starting at
+        ``pos`` or return ``pos`` if no joined candidate is valid."""
+        last = pos
+        if unquoted[pos]:
+            limit = min(len(tokens), pos + self.max_words)
+            while last + 1 < limit and unquoted[last + 1]:
+                last += 1
+
+        def candidate(end):
+            """Reconstruct the text of tokens ``pos`` through ``end``"""
+            if end == pos:
+                return tokens[pos]
+            return cmd_string[spans[pos][0]:spans[end][1]]
+
+        if getattr(arg_test_cb, 'prefix_aware', False):
+            best = pos
+            for end in range(pos, last + 1):
+                result = arg_test_cb(candidate(end), argv)
+                if result is ARG_PREFIX:
+                    continue
+                elif not result:
+                    break
+                best = end
+            return best
+
+        for end in range(last, pos, -1):
+            if arg_test_cb(candidate(end), argv):
+                return end
+        return pos
+
+#: Default instance of `SmartLexer`
+smart_lexer = SmartLexer()
+
+def _table_version(commands):
+    """Default ``version_cb`` for `CachingLexer`.
+
+    Uses ``commands.version`` if present. Otherwise, fingerprints the
+    table's contents: each command's name, ``opts_list``, and
+    ``arg_test_cb``, plus the ``version`` attribute of each ``arg_test_cb``
+    or, failing that, of the object which owns it as a bound method (eg. a
+    `snakebyte.catalog.FileCatalog`) so that a rescan which changed the
+    catalog also invalidates cached results.
+
+    A plain function's results are assumed to depend only on its arguments.
+    Give the table a ``version`` if that isn't true.
+    """
+    version = getattr(commands, 'version', None)
+    if version is not None or not commands:
+        return version
+    return tuple((name, tuple(hints[0] or ()), hints[1],
+                  getattr(hints[1], 'version', None) if
+                  hasattr(hints[1], 'version') else
+                  getattr(getattr(hints[1], '__self__', None), 'version',
+                          None)) if hints else (name,)
+                 for name, hints in commands.items())
+
+class CachingLexer(LexerInterface):
+    """A wrapper which memoizes the results of another lexer.
+
+    Results are kept in a bounded LRU cache keyed on the command string,
+    the identity of the ``commands`` table, and a version number for that
+    table (see `_table_version`). Each entry holds a reference to its
+    table, so a table's ``id()`` can't be reused by another while cached
+    results for it remain. Parse failures are cached too, so a bot
+    repeating the same malformed line doesn't get re-lexed either.
+
+    Tables whose version isn't hashable (eg. an ``opts_list`` containing a
+    list) are lexed without caching.
+
+    Every call returns a fresh list, since callers are free to mutate argv.
+    """
+
+    def __init__(self, lexer, maxsize=1024, version_cb=None, *args, **kwargs):
+        """
+        :Parameters:
+          lexer : `LexerInterface`
+            The lexer whose results should be cached.
+          maxsize : `int`
+            The maximum number of command lines to remember.
+          version_cb : ``function(commands)``
+            Returns a hashable value which changes whenever the results of
+            lexing against ``commands`` may have changed.
+            `_table_version` will be used if none is provided.
+        """
+        self.lexer, self.maxsize = lexer, maxsize
+        self.version_cb = version_cb or _table_version
+        self.name = 'cached-%s' % lexer.name
+
+        self.hits = self.misses = 0
+        self._cache, self._lock = OrderedDict(), threading.Lock()
+
+    def __call__(self, cmd_string, commands):
+        """Parse a command line into a ``sys.argv``-compatible list.
+
+        See `LexerInterface.__call__` for details.
+        """
+        key = (cmd_string, id(commands), self.version_cb(commands))
+        try:
+            hash(key)
+        except TypeError:
+            return self.lexer(cmd_string, commands)
+
+        with self._lock:
+            entry = self._cache.pop(key, None)
+            if entry is not None and entry[0] is commands:
+                self._cache[key] = entry
+                self.hits += 1
+            else:
+                entry = None
+
+        if entry is None:
+            try:
+                result = tuple(self.lexer(cmd_string, commands))
+            except ValueError as err:
+                result = err
+            entry = (commands, result)
+            with self._lock:
+                self.misses += 1
+                self._cache[key] = entry
+                while len(self._cache) > self.maxsize:
+                    self._cache.popitem(last=False)
+
+        result = entry[1]
+        if isinstance(result, ValueError):
+            raise ValueError(*result.args)
+        return list(result)
+
+    def clear(self):
+        """Empty the cache and reset the hit and miss counters"""
+        with self._lock:
+            self._cache.clear()
+            self.hits = self.misses = 0
 
 #: All usable lexers in this module
-LEXERS = [mirc_lexer, posix_lexer]
+LEXERS = [mirc_lexer, posix_lexer, smart_lexer]
+
+def get_lexer(name):
+    """Look up a lexer in `LEXERS` by its ``name``.
+
+    :raises KeyError: No registered lexer has the given name.
+    """
+    for lexer in LEXERS:
+        if lexer.name == name:
+            return lexer
+    raise KeyError("No such lexer: %r" % (name,))
@@ -0,0 +1,603 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""DCC SEND transfer engine driven by a `FairQueue`
+
+`TransferEngine` pops ``(key, value)`` entries from a
+`snakebyte.queue.FairQueue` whenever a slot is free, opens a listening
+socket for each, and streams the file to whoever connects using a
+non-blocking ``selectors`` event loop.
+
+File data is sent with ``os.sendfile`` where available (so it never passes
+through userspace) and otherwise through a buffer allocated once per
+transfer. DCC acknowledgements (the receiver's running byte count as a
+4-byte big-endian integer) are read into a preallocated buffer too, and
+only the most recent complete one is decoded.
+
+Announcing the offer to the recipient over IRC is left to the caller via
+``offer_cb`` (see `format_dcc_send`).
+
+Bandwidth can be limited by passing a `snakebyte.shaping.BandwidthShaper`.
+Transfers it grants nothing stop polling for writability until its
+suggested delay has passed, so throttled slots don't spin the loop.
+
+Interrupted transfers can be pushed back into the queue as
+`snakebyte.resume.ResumeEntry` objects (see ``max_resumes``) and their
+offsets remembered across restarts in a `snakebyte.resume.ResumeStore`.
+DCC leaves it to the recipient to ask for a resume, so pass its
+``DCC RESUME`` requests (see `parse_dcc_resume`) to
+`TransferEngine.handle_resume` and send back the ``DCC ACCEPT`` it returns.
+"""
+
+__author__  = "Stephan Sokolow (deitarion/SSokolow)"
+__license__ = "GNU GPL 3.0 or later"
+__docformat__ = "restructuredtext en"
+
+import errno, logging, os, selectors, socket, struct, time
+log = logging.getLogger(__name__)
+
+from snakebyte.hashcache import file_identity
+from snakebyte.resume import ResumeEntry, unwrap
+
+#: DCC acknowledgements are 32-bit and wrap around for files over 4GiB
+ACK_MODULUS = 2 ** 32
+
+def format_dcc_send(filename, address, port, size):
+    """Build the CTCP message offering a file to a DCC client.
+
+    :Parameters:
+      filename : `str`
+        The name the recipient should save the file as.
+      address : `str`
+        The dotted-quad IPv4 address the recipient should connect to.
+      port : `int`
+        The port the recipient should connect to.
+      size : `int`
+        The size of the file in bytes.
+
+    :rtype: `str`
+    """
+    packed = struct.unpack('!I', socket.inet_aton(address))[0]
+    return '\x01DCC SEND %s %d %d %d\x01' % (
+        _quote_filename(filename), packed, port, size)
+
+def format_dcc_accept(filename, port, position):
+    """Build the CTCP message agreeing to a recipient's ``DCC RESUME``.
+
+    :Parameters:
+      filename : `str`
+        The filename given in the ``DCC RESUME`` request.
+      port : `int`
+        The port of the offer being resumed.
+      position : `int`
+        The byte offset the transfer will resume from.
+
+    :rtype: `str`
+    """
+    return '\x01DCC ACCEPT %s %d %d\x01' % (_quote_filename(filename),
+                                            port, position)
+
+def parse_dcc_resume(message):
+    """Parse a ``DCC RESUME`` CTCP request sent by a recipient.
+
+    :rtype: ``(filename, port, position)``
+    :returns: The request's fields or ``None`` if ``message`` isn't a
+        well-formed ``DCC RESUME``.
+    """
+    parts = message.strip('\x01').split(' ', 2)
+    if len(parts) < 3 or [x.upper() for x in parts[:2]] != ['DCC', 'RESUME']:
+        return None
+
+    fields = parts[2].rsplit(' ', 2)
+    if len(fields) != 3:
+        return None
+    filename, port, position = fields
+    try:
+        port, position = int(port), int(position)
+    except ValueError:
+        return None
+    if len(filename) > 1 and filename[0] == filename[-1] == '"':
+        filename = filename[1:-1]
+    return filename, port, position
+
+def _quote_filename(filename):
+    """Quote a filename for a DCC CTCP message if it contains spaces"""
+    if ' ' in filename:
+        filename = '"%s"' % filename.replace('"', '')
+    return filename
+
+class DCCSend(object):
+    """The state of one outgoing DCC SEND."""
+
+    def __init__(self, key, value, path, chunk_size, use_sendfile=True):
+        """
+        :Parameters:
+          key : hashable
+            The `FairQueue` bucket the request was popped from.
+          value
+            The `FairQueue` entry which was popped.
+          path : `str`
+            The file to send.
+          chunk_size : `int`
+            The maximum number of bytes to send per write.
+          use_sendfile : `bool`
+            Whether to try ``os.sendfile`` before falling back to a buffer.
+        """
+        self.key, self.value, self.path = key, value, path
+        self.chunk_size = chunk_size
+
+        self.fileobj = open(path, 'rb')
+        st = os.fstat(self.fileobj.fileno())
+        self.size, self.identity = st.st_size, file_identity(st)
+        self.offset = self.position = 0  #: Starting and current file offset
+        self.acked = 0                    #: Latest acknowledged byte count
+        #: The furthest a resume may start from: where an earlier attempt
+        #: at sending these same contents was interrupted, ``0`` if the file
+        #: changed since then, or ``None`` if no earlier attempt is known.
+        self.resume_offset = None
+        self.attempts = 0       #: How many times this entry was requeued
+
+        self.listener = self.sock = None
+        self.port = None
+        self.created = self.touched = time.time()
+        self.started = self.finished = None
+        self.error = None  #: Why the transfer failed, if it did
+        self.hashes = None  #: ``Future`` for the file's checksums, if any
+
+        # Allocated once so the hot paths don't allocate per chunk
+        self.use_sendfile = use_sendfile and hasattr(os, 'sendfile')
+        self.buffer = self.view = None
+        self.pending = (0, 0)  #: Slice of `view` not yet sent
+        self.ackbuf = bytearray(64)
+        self.ack_word, self.ack_phase = bytearray(4), 0
+
+    def __repr__(self):
+        return '<%s %r to %r: %d/%d>' % (self.__class__.__name__,
+                self.path, self.key, self.position, self.size)
+
+    @property
+    def acked_position(self):
+        """The file offset the recipient has acknowledged, corrected for
+        the 32-bit wraparound of DCC acknowledgements."""
+        unwrapped = self.position - (self.position - self.acked) % ACK_MODULUS
+        return max(self.offset, unwrapped)
+
+    @property
+    def bytes_sent(self):
+        """Bytes sent during this connection (excluding any resume offset)"""
+        return self.position - self.offset
+
+    @property
+    def duration(self):
+        """Seconds between the connection being accepted and the transfer
+        ending (or now, if it hasn't ended yet)."""
+        if self.started is None:
+            return 0
+        return (self.finished or time.time()) - self.started
+
+    @property
+    def complete(self):
+        """Whether the recipient has confirmed receipt of the whole file"""
+        return (self.position >= self.size and
+                self.acked % ACK_MODULUS == self.size % ACK_MODULUS)
+
+    def close(self):
+        """Release all resources held by the transfer"""
+        for obj in (self.listener, self.sock, self.fileobj):
+            if obj is not None:
+                obj.close()
+        if self.view is not None:
+            self.view.release()
+        self.listener = self.sock = self.fileobj = self.view = None
+
+    def send_chunk(self, limit=None):
+        """Write as much of the next chunk as the socket will take.
+
+        :Parameters:
+          limit : `int`
+            Send at most this many bytes, even if `chunk_size` is larger.
+
+        :raises OSError: The connection failed.
+        """
+        remaining = self.size - self.position
+        if limit is not None:
+            remaining = min(remaining, limit)
+        if self.use_sendfile:
+            try:
+                sent = os.sendfile(self.sock.fileno(), self.fileobj.fileno(),
+                                   self.position,
+                                   min(self.chunk_size, remaining))
+            except OSError as err:
+                if err.errno not in (errno.EINVAL, errno.ENOSYS,
+                                     errno.ENOTSOCK, errno.EOPNOTSUPP):
+                    raise
+                log.debug("sendfile unusable for %s. Falling back.",
+                          self.path)
+                self.use_sendfile = False
+                return self.send_chunk(limit)
+        else:
+            start, end = self.pending
+            if start == end:
+                if self.view is None:
+                    self.buffer = bytearray(self.chunk_size)
+                    self.view = memoryview(self.buffer)
+                self.fileobj.seek(self.position)
+                start, end = 0, self.fileobj.readinto(
+                    self.view[:min(self.chunk_size, remaining)])
+                if not end:
+                    raise OSError(errno.EIO, "File shrank during transfer")
+            sent = self.sock.send(self.view[start:min(end, start + remaining)])
+            self.pending = (start + sent, end)
+
+        self.position += sent
+        self.touched = time.time()
+        return sent
+
+    def read_acks(self):
+        """Consume acknowledgements, updating `acked`.
+
+        :returns: ``False`` if the peer closed the connection.
+        :raises OSError: The connection failed.
+        """
+        count = self.sock.recv_into(self.ackbuf)
+        if not count:
+            return False
+
+        phase = self.ack_phase
+        total = phase + count
+        if total < 4:
+            self.ack_word[phase:total] = self.ackbuf[:count]
+        else:
+            # Only the most recent complete acknowledgement matters
+            end = total // 4 * 4 - phase
+            if end >= 4:
+                self.acked = struct.unpack_from('!I', self.ackbuf, end - 4)[0]
+            else:
+                self.ack_word[phase:] = self.ackbuf[:end]
+                self.acked = struct.unpack_from('!I', self.ack_word)[0]
+            if total % 4:
+                self.ack_word[:total % 4] = self.ackbuf[end:count]
+        self.ack_phase = total % 4
+        self.touched = time.time()
+        return True
+
+class TransferEngine(object):
+    """Serve `FairQueue` entries as DCC SENDs over a non-blocking event
+    loop.
+
+    ``offer_cb(transfer)`` is called once a transfer's listening socket is
+    ready, so the caller can send the recipient a CTCP offer for
+    ``transfer.port``. ``done_cb(transfer)`` is called when a transfer
+    finishes, successfully or otherwise (check ``transfer.error``).
+    Successful transfers are also reported to the queue via
+    `snakebyte.queue.FairQueue.record_transfer`.
+
+    With ``max_resumes`` set, the queue may also hold
+    `snakebyte.resume.ResumeEntry` objects wrapping the original values.
+    `start` unwraps them before calling ``resolve_cb`` (and
+    ``transfer.value`` is always the original), but anything else which
+    inspects queued values, such as a ``!queue`` command listing filenames,
+    should pass them through `snakebyte.resume.unwrap`.
+    """
+
+    def __init__(self, queue, slots=2, host='', offer_cb=None, done_cb=None,
+                 resolve_cb=None, chunk_size=65536, accept_timeout=120,
+                 idle_timeout=300, use_sendfile=True, shaper=None,
+                 hash_cache=None, resume_store=None, max_resumes=0,
+                 prefetcher=None):
+        """
+        :Parameters:
+          queue : `snakebyte.queue.FairQueue`
+            Where pending ``(key, value)`` requests come from.
+          slots : `int`
+            The maximum number of simultaneous transfers.
+          host : `str`
+            The local address listening sockets are bound to.
+          offer_cb : ``function(transfer)``
+            Announces a ready `DCCSend` to its recipient.
+          done_cb : ``function(transfer)``
+            Called when a `DCCSend` finishes or fails.
+          resolve_cb : ``function(value)``
+            Maps a queue entry to the path of the file to send. Entries are
+            used as paths directly if none is provided.
+          chunk_size : `int`
+            The maximum number of bytes written per socket write.
+          accept_timeout : `float`
+            Seconds to wait for the recipient to connect.
+          idle_timeout : `float`
+            Seconds to wait for a connected transfer to make progress.
+          use_sendfile : `bool`
+            See `DCCSend.__init__`.
+          shaper : `snakebyte.shaping.BandwidthShaper`
+            Limits the rate transfers are sent at. Transfers are registered
+            with it under their `FairQueue` key.
+          hash_cache : `snakebyte.hashcache.HashCache`
+            If provided, each transfer's ``hashes`` attribute is set to a
+            ``Future`` for its file's checksums when it starts, so they
+            can be announced or used to verify the transfer.
+          resume_store : `snakebyte.resume.ResumeStore`
+            Remembers how far interrupted transfers got, so that
+            ``transfer.resume_offset`` is known even for entries which
+            weren't requeued (eg. a file requested again after a restart).
+          max_resumes : `int`
+            How many times an interrupted transfer which made progress is
+            pushed back into the queue as a `snakebyte.resume.ResumeEntry`.
+            (See above.)
+          prefetcher : `snakebyte.popularity.Prefetcher`
+            Warms the page cache for upcoming files whenever slots have
+            been filled.
+        """
+        self.queue, self.slots, self.host = queue, slots, host
+        self.offer_cb, self.done_cb = offer_cb, done_cb
+        self.resolve_cb = resolve_cb or (lambda value: value)
+        self.chunk_size = chunk_size
+        self.accept_timeout, self.idle_timeout = accept_timeout, idle_timeout
+        self.use_sendfile, self.shaper = use_sendfile, shaper
+        self.hash_cache = hash_cache
+        self.resume_store, self.max_resumes = resume_store, max_resumes
+        self.prefetcher = prefetcher
+
+        self.transfers = []  #: Active `DCCSend` objects
+        self.paused = {}     #: Throttled `DCCSend` objects and resume times
+        self.selector = selectors.DefaultSelector()
+
+    def __len__(self):
+        return len(self.transfers)
+
+    def close(self):
+        """Abort all active transfers and release the event loop"""
+        for transfer in self.transfers[:]:
+            self._finish(transfer, "Engine shut down")
+        self.selector.close()
+
+    def fill_slots(self):
+        """Start transfers from the queue until all slots are busy"""
+        while len(self.transfers) < self.slots and self.queue:
+            key, value = self.queue.pop()
+            try:
+                self.start(key, value)
+            except (IOError, OSError) as err:
+                log.error("Could not start transfer of %r to %r: %s",
+                          value, key, err)
+        if self.prefetcher is not None:
+            self.prefetcher.prefetch()
+
+    def start(self, key, value):
+        """Open a listener for one queue entry and announce it.
+
+        :rtype: `DCCSend`
+        :raises OSError: The file couldn't be opened or the socket couldn't
+            be bound.
+        """
+        entry = value if isinstance(value, ResumeEntry) else None
+        value = unwrap(value)
+        transfer = DCCSend(key, value, self.resolve_cb(value),
+                           self.chunk_size, self.use_sendfile)
+        if entry is not None:
+            transfer.attempts = entry.attempts
+            # The recipient's partial copy is of different contents if the
+            # file changed, so it must start over.
+            transfer.resume_offset = (entry.offset if
+                    entry.identity == transfer.identity else 0)
+        if self.resume_store is not None and not transfer.resume_offset:
+            transfer.resume_offset = self.resume_store.get(key,
+                    transfer.identity, transfer.resume_offset)
+
+        try:
+            listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            transfer.listener = listener
+            listener.bind((self.host, 0))
+            listener.listen(1)
+            listener.setblocking(False)
+            transfer.port = listener.getsockname()[1]
+        except OSError:
+            transfer.close()
+            raise
+
+        if self.hash_cache is not None:
+            transfer.hashes = self.hash_cache.get(transfer.path)
+        self.selector.register(listener, selectors.EVENT_READ, transfer)
+        self.transfers.append(transfer)
+        if self.offer_cb:
+            self.offer_cb(transfer)
+        return transfer
+
+    def handle_resume(self, key, filename, port, position):
+        """Agree to a recipient's request to resume an offered transfer.
+
+        :Parameters:
+          key : hashable
+            The `FairQueue` bucket of the recipient who sent the request.
+          filename : `str`
+            The filename given in the request.
+          port : `int`
+            The port of the offer to be resumed.
+          position : `int`
+            The byte offset the recipient wants to resume from. If it's past
+            ``transfer.resume_offset``, the transfer resumes from
+            ``resume_offset`` instead, since nothing later was acknowledged
+            (or, if that's ``0``, sent from the current file at all).
+
+        :rtype: `str`
+        :returns: The ``DCC ACCEPT`` message to send back or ``None`` if the
+            request doesn't match a transfer waiting for its connection.
+        """
+        for transfer in self.transfers:
+            if (transfer.port == port and transfer.key == key and
+                    transfer.sock is None):
+                break
+        else:
+            return None
+
+        if not 0 <= position <= transfer.size:
+            log.warning("Refusing to resume %s for %r at %d of %d bytes",
+                        transfer.path, key, position, transfer.size)
+            return None
+        if transfer.resume_offset is not None and (
+                position > transfer.resume_offset):
+            log.info("Resuming %s for %r at %d rather than the requested %d",
+                     transfer.path, key, transfer.resume_offset, position)
+            position = transfer.resume_offset
+        transfer.offset = position
+        return format_dcc_accept(filename, port, position)
+
+    def poll(self, timeout=1.0):
+        """Run one iteration of the event loop.
+
+        :returns: The number of transfers still active.
+        """
+        self.fill_slots()
+        if not self.transfers:
+            return 0
+
+        if self.paused:
+            timeout = self._resume_paused(timeout)
+        for selkey, mask in self.selector.select(timeout):
+            transfer = selkey.data
+            if transfer.sock is None:
+                self._accept(transfer)
+                continue
+            try:
+                if mask & selectors.EVENT_READ:
+                    if not transfer.read_acks():
+                        self._peer_closed(transfer)
+                        continue
+                if mask & selectors.EVENT_WRITE and transfer.sock:
+                    self._send(transfer)
+            except (IOError, OSError) as err:
+                if err.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    self._finish(transfer, str(err))
+                    continue
+            if transfer.sock and transfer.complete:
+                self._finish(transfer)
+
+        self._check_timeouts()
+        return len(self.transfers)
+
+    def run_until_idle(self, timeout=1.0):
+        """Run the event loop until the queue and all slots are empty"""
+        while self.poll(timeout) or self.queue:
+            pass
+
+    def _requeue(self, transfer):
+        """Remember how far an interrupted transfer got and, if it made
+        progress, push it back into the queue to be resumed."""
+        offset = transfer.acked_position
+        if self.resume_store is not None:
+            self.resume_store.record(transfer.key, transfer.identity, offset)
+        if offset > transfer.offset and transfer.attempts < self.max_resumes:
+            self.queue.push(transfer.key, ResumeEntry(transfer.value, offset,
+                    transfer.identity, transfer.attempts + 1))
+
+    def _resume_paused(self, timeout):
+        """Restore write polling for throttled transfers whose delay has
+        passed.
+
+        :returns: ``timeout``, shortened so the loop wakes in time to resume
+            the next transfer still paused.
+        """
+        now = time.monotonic()
+        for transfer, resume_at in list(self.paused.items()):
+            if resume_at <= now:
+                del self.paused[transfer]
+                self.selector.modify(transfer.sock,
+                        selectors.EVENT_READ | selectors.EVENT_WRITE, transfer)
+            elif timeout is None or resume_at - now < timeout:
+                timeout = resume_at - now
+        return timeout
+
+    def _accept(self, transfer):
+        """Accept the recipient's connection and start streaming"""
+        try:
+            sock, _ = transfer.listener.accept()
+        except (IOError, OSError) as err:
+            if err.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                self._finish(transfer, str(err))
+            return
+
+        self.selector.unregister(transfer.listener)
+        transfer.listener.close()
+        transfer.listener = None
+
+        sock.setblocking(False)
+        transfer.sock = sock
+        transfer.position = transfer.offset
+        transfer.started = transfer.touched = time.time()
+        if self.shaper is not None:
+            self.shaper.register(transfer, transfer.key)
+        self.selector.register(sock,
+                selectors.EVENT_READ | selectors.EVENT_WRITE, transfer)
+
+    def _send(self, transfer):
+        """Send the next chunk, then stop polling for writability once the
+        whole file has been handed to the kernel."""
+        if self.shaper is not None:
+            self._send_shaped(transfer)
+        elif transfer.position < transfer.size:
+            transfer.send_chunk()
+        if transfer.position >= transfer.size:
+            self.selector.modify(transfer.sock, selectors.EVENT_READ,
+                                 transfer)
+
+    def _send_shaped(self, transfer):
+        """Send as much of the next chunk as the shaper allows, pausing
+        write polling if it allows nothing."""
+        want = min(transfer.chunk_size, transfer.size - transfer.position)
+        if want <= 0:
+            return
+
+        allowed = self.shaper.grant(transfer, want)
+        if not allowed:
+            self.paused[transfer] = (time.monotonic() +
+                                     self.shaper.delay(transfer))
+            self.selector.modify(transfer.sock, selectors.EVENT_READ,
+                                 transfer)
+            return
+
+        sent = 0
+        try:
+            sent = transfer.send_chunk(allowed)
+        finally:
+            if sent < allowed:
+                self.shaper.refund(transfer, allowed - sent)
+
+    def _peer_closed(self, transfer):
+        """Handle the recipient closing its end of the connection"""
+        if transfer.position >= transfer.size:
+            # Some clients disconnect without sending the final ACK
+            self._finish(transfer)
+        else:
+            self._finish(transfer, "Connection closed by recipient")
+
+    def _check_timeouts(self):
+        """Abort transfers which have gone quiet for too long"""
+        now = time.time()
+        for transfer in self.transfers[:]:
+            if transfer.sock is None:
+                if now - transfer.created > self.accept_timeout:
+                    self._finish(transfer, "Timed out waiting for connection")
+            elif now - transfer.touched > self.idle_timeout:
+                self._finish(transfer, "Transfer stalled")
+
+    def _finish(self, transfer, error=None):
+        """Tear down a transfer and report the outcome"""
+        transfer.finished, transfer.error = time.time(), error
+        self.paused.pop(transfer, None)
+        if self.shaper is not None and transfer.started is not None:
+            self.shaper.unregister(transfer)
+        for obj in (transfer.listener, transfer.sock):
+            if obj is not None:
+                self.selector.unregister(obj)
+        transfer.close()
+        self.transfers.remove(transfer)
+
+        if error:
+            log.warning("Transfer of %s to %r failed: %s",
+                        transfer.path, transfer.key, error)
+            self._requeue(transfer)
+        else:
+            self.queue.record_transfer(transfer.key, transfer.bytes_sent,
+                                       transfer.duration)
+            if self.resume_store is not None:
+                self.resume_store.discard(transfer.key, transfer.identity)
+        if self.done_cb:
+            self.done_cb(transfer)
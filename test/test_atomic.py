@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Test Suite for crash-safe state file saving for SnakeByte FServe"""
+
+__author__  = "Stephan Sokolow (deitarion/SSokolow)"
+__license__ = "GNU GPL 3.0 or later"
+__docformat__ = "restructuredtext en"
+
+import logging, os, shutil, sys, tempfile
+log = logging.getLogger(__name__)
+
+if sys.version_info[0] == 2 and sys.version_info[1] < 7:  # pragma: no cover
+    import unittest2 as unittest
+    unittest  # Silence erroneous PyFlakes warning
+else:                                                     # pragma: no cover
+    import unittest
+
+from snakebyte.atomic import atomic_write, read_json, write_json
+
+class TestAtomic(unittest.TestCase):
+    """Test atomic replacement and versioned JSON round trips"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'state.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_atomic_write(self):
+        """Test that a failed write leaves the old file and no debris"""
+        atomic_write(self.path, lambda fobj: fobj.write(b'old'), binary=True)
+
+        def fail(fobj):
+            fobj.write('partial')
+            raise RuntimeError("disk full")
+        self.assertRaises(RuntimeError, atomic_write, self.path, fail)
+
+        with open(self.path, 'rb') as fobj:
+            self.assertEqual(fobj.read(), b'old')
+        self.assertEqual(os.listdir(self.tmpdir), ['state.json'])
+
+    def test_json_round_trip(self):
+        """Test saving and loading versioned entries"""
+        write_json(self.path, 2, [['a', 1], ['b', 2]])
+        self.assertEqual(read_json(self.path, 2), [['a', 1], ['b', 2]])
+        self.assertRaises(ValueError, read_json, self.path, 1)
+
+        for junk in ('not json', '[1, 2]', '{"version": 2}'):
+            with open(self.path, 'w') as fobj:
+                fobj.write(junk)
+            self.assertRaises((ValueError, KeyError), read_json, self.path, 2)
+        self.assertRaises(IOError, read_json,
+                          os.path.join(self.tmpdir, 'missing'), 2)
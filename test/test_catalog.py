@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Test Suite for the file catalog code for SnakeByte FServe"""
+
+__author__  = "Stephan Sokolow (deitarion/SSokolow)"
+__license__ = "GNU GPL 3.0 or later"
+__docformat__ = "restructuredtext en"
+
+import logging, os, shutil, sys, tempfile
+log = logging.getLogger(__name__)
+
+if sys.version_info[0] == 2 and sys.version_info[1] < 7:  # pragma: no cover
+    import unittest2 as unittest
+    unittest  # Silence erroneous PyFlakes warning
+else:                                                     # pragma: no cover
+    import unittest
+
+from snakebyte.catalog import FileCatalog, PathTrie
+from snakebyte.shell_lexers import ARG_PREFIX, smart_lexer
+
+class TestPathTrie(unittest.TestCase):
+    """Test the radix trie underlying the catalog"""
+    keys = ['Music/A.flac', 'Music/AB.flac', 'Music/B.flac', 'Movies/C.mkv',
+            'M', '']
+
+    def setUp(self):
+        self.trie = PathTrie()
+        for pos, key in enumerate(self.keys):
+            self.trie.insert(key, pos)
+
+    def test_lookup(self):
+        """Test `PathTrie.get` and ``in``"""
+        self.assertEqual(len(self.trie), len(self.keys))
+        for pos, key in enumerate(self.keys):
+            self.assertIn(key, self.trie)
+            self.assertEqual(self.trie.get(key), pos)
+        for key in ('Mu', 'Music/', 'Music/A.flacc', 'X'):
+            self.assertNotIn(key, self.trie)
+            self.assertIs(self.trie.get(key, self), self)
+
+    def test_status(self):
+        """Test `PathTrie.status` for exact matches and prefixes"""
+        self.assertIs(self.trie.status('Music/A.flac'), True)
+        self.assertIs(self.trie.status('M'), True)
+        for prefix in ('Mu', 'Music/', 'Music/A', 'Movies/C.mk'):
+            self.assertIs(self.trie.status(prefix), ARG_PREFIX)
+        for key in ('X', 'Music/C', 'Movies/C.mkv2'):
+            self.assertIs(self.trie.status(key), False)
+        self.assertIs(PathTrie().status(''), False,
+                "An empty trie must not claim to hold anything")
+
+    def test_items(self):
+        """Test that `PathTrie.items` yields sorted, prefix-filtered keys"""
+        self.assertEqual([x for x, _ in self.trie.items()], sorted(self.keys))
+        self.assertEqual([x for x, _ in self.trie.items('Music/A')],
+                ['Music/A.flac', 'Music/AB.flac'])
+        self.assertEqual([x for x, _ in self.trie.items('Mo')],
+                ['Movies/C.mkv'])
+        self.assertEqual(list(self.trie.items('Z')), [])
+
+    def test_remove(self):
+        """Test `PathTrie.remove` including pruning of emptied branches"""
+        self.assertRaises(KeyError, self.trie.remove, 'Mu')
+        self.assertRaises(KeyError, self.trie.remove, 'Z')
+        for key in self.keys:
+            self.trie.remove(key)
+            self.assertNotIn(key, self.trie)
+            self.assertRaises(KeyError, self.trie.remove, key)
+        self.assertEqual(len(self.trie), 0)
+        self.assertEqual(self.trie._root[0], {},
+                "Removing every key must leave no dangling branches")
+
+class TestFileCatalog(unittest.TestCase):
+    """Test scanning and lookups in `FileCatalog`"""
+
+    def setUp(self):
+        self.roots = [tempfile.mkdtemp(), tempfile.mkdtemp()]
+        self.write(0, 'Music/The Song.flac')
+        self.write(0, 'readme.txt')
+        self.write(1, 'readme.txt', 'shadowed')
+        self.write(1, 'Video/Clip One.mkv')
+        self.catalog = FileCatalog(self.roots)
+        self.catalog.rescan()
+
+    def tearDown(self):
+        for root in self.roots:
+            shutil.rmtree(root)
+
+    def write(self, root, path, content='data'):
+        """Create a file under one of the share roots"""
+        path = os.path.join(self.roots[root], *path.split('/'))
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as fobj:
+            fobj.write(content)
+        return path
+
+    def test_scan(self):
+        """Test the results of an initial scan"""
+        self.assertEqual(list(self.catalog.paths()),
+                ['Music/The Song.flac', 'Video/Clip One.mkv', 'readme.txt'])
+        self.assertEqual(self.catalog.get('readme.txt').size, 4,
+                "Roots listed first must shadow later roots")
+        self.assertEqual(self.catalog.version, 1)
+        self.assertEqual(len(self.catalog), 3)
+
+    def test_arg_test_cb(self):
+        """Test that the catalog's callback drives the smart lexer"""
+        cb = self.catalog.arg_test_cb
+        self.assertTrue(cb('Music/The Song.flac', []))
+        self.assertIs(cb('Music/The', []), ARG_PREFIX)
+        self.assertFalse(cb('Music/Other', []))
+
+        commands = {'!get': ([], cb)}
+        self.assertEqual(
+            smart_lexer('!get Music/The Song.flac Video/Clip One.mkv',
+                        commands),
+            ['!get', 'Music/The Song.flac', 'Video/Clip One.mkv'])
+
+    def test_casefold(self):
+        """Test case-insensitive lookups"""
+        catalog = FileCatalog(self.roots, casefold=True)
+        catalog.rescan()
+        self.assertIn('music/the song.FLAC', catalog)
+        self.assertIs(catalog.arg_test_cb('MUSIC/the', []), ARG_PREFIX)
+        self.assertEqual(catalog.get('README.TXT').path, 'readme.txt')
+        self.assertNotIn('music/the song.FLAC', self.catalog)
+
+    def test_incremental_rescan(self):
+        """Test that rescans report and apply only what changed"""
+        changes = self.catalog.rescan()
+        self.assertEqual(changes, ([], [], []))
+        self.assertEqual(self.catalog.version, 1,
+                "Unchanged rescans must not invalidate caches")
+
+        os.remove(os.path.join(self.roots[0], 'readme.txt'))
+        path = self.write(1, 'Video/Clip One.mkv', 'longer data')
+        os.utime(path, (1, 1))
+        self.write(0, 'New.txt')
+
+        added, removed, changed = self.catalog.rescan()
+        self.assertEqual([x.path for x in added], ['New.txt'])
+        self.assertEqual([x.path for x in removed], [])
+        self.assertEqual(sorted(x.path for x in changed),
+                ['Video/Clip One.mkv', 'readme.txt'],
+                "Unshadowing a file must count as a change")
+        self.assertEqual(self.catalog.get('readme.txt').size, 8)
+        self.assertEqual(self.catalog.version, 2)
+
+        shutil.rmtree(os.path.join(self.roots[0], 'Music'))
+        _, removed, _ = self.catalog.rescan()
+        self.assertEqual([x.path for x in removed], ['Music/The Song.flac'])
+        self.assertFalse(self.catalog.arg_test_cb('Music/', []))
+
+    def test_failed_rescan(self):
+        """Test that a rescan which fails partway still bumps the version"""
+        class BrokenScanner(object):
+            """Yields one new file, then fails"""
+            def scan(self, roots):
+                yield 0, self.entry
+                raise OSError("Share went away")
+
+        scanner = BrokenScanner()
+        scanner.entry = self.catalog.get('readme.txt')._replace(
+                path='New.txt')
+        self.catalog.scanner = scanner
+        self.assertRaises(OSError, self.catalog.rescan)
+        self.assertIn('New.txt', self.catalog)
+        self.assertEqual(self.catalog.version, 2,
+                "Partially applied rescans must invalidate caches")
+
+        scanner.entry = self.catalog.get('New.txt')
+        self.assertRaises(OSError, self.catalog.rescan)
+        self.assertEqual(self.catalog.version, 2,
+                "Failed rescans which changed nothing must keep caches")
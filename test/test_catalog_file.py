@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Test Suite for the memory-mapped catalog format for SnakeByte FServe"""
+
+__author__  = "Stephan Sokolow (deitarion/SSokolow)"
+__license__ = "GNU GPL 3.0 or later"
+__docformat__ = "restructuredtext en"
+
+import logging, os, shutil, sys, tempfile
+log = logging.getLogger(__name__)
+
+if sys.version_info[0] == 2 and sys.version_info[1] < 7:  # pragma: no cover
+    import unittest2 as unittest
+    unittest  # Silence erroneous PyFlakes warning
+else:                                                     # pragma: no cover
+    import unittest
+
+from snakebyte.catalog import FileCatalog
+from snakebyte.catalog_file import (MappedCatalog, PersistentCatalog,
+                                    write_catalog)
+
+class CatalogFileTestCase(unittest.TestCase):
+    """Common fixture: a share with a few awkwardly named files"""
+    names = ['Music/A.flac', 'Music/AB.flac', 'Music/B.flac', 'Zed.txt',
+             u'Caf\xe9/東京.mkv', 'Movies/C.mkv', 'a.txt']
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.root = os.path.join(self.tmpdir, 'share')
+        self.cache = os.path.join(self.tmpdir, 'catalog.bin')
+        for name in self.names:
+            self.touch(name)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def touch(self, name):
+        path = os.path.join(self.root, *name.split('/'))
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as fobj:
+            fobj.write(name)
+
+class TestMappedCatalog(CatalogFileTestCase):
+    """Test writing and querying saved catalogs"""
+
+    def check_equivalent(self, live, mapped):
+        """Verify that a mapped catalog answers exactly like the live one"""
+        self.assertEqual(len(mapped), len(live))
+        self.assertEqual(list(mapped), list(live))
+        for entry in live:
+            for end in range(len(entry.path) + 2):
+                candidate = (entry.path + 'x')[:end]
+                self.assertIs(mapped.arg_test_cb(candidate, []),
+                              live.arg_test_cb(candidate, []), candidate)
+                self.assertEqual(list(mapped.paths(candidate)),
+                                 list(live.paths(candidate)))
+            self.assertEqual(mapped.get(entry.path), entry)
+            self.assertIn(entry.path, mapped)
+        self.assertIsNone(mapped.get('nope'))
+        self.assertNotIn('Music', mapped)
+
+    def test_round_trip(self):
+        """Test that a saved catalog answers like the original"""
+        for casefold in (False, True):
+            live = FileCatalog([self.root], casefold=casefold)
+            live.rescan()
+            write_catalog(live, self.cache)
+            mapped = MappedCatalog(self.cache)
+            self.assertEqual(mapped.roots, [self.root])
+            self.assertEqual(mapped.casefold, casefold)
+            self.check_equivalent(live, mapped)
+            if casefold:
+                self.assertTrue(mapped.arg_test_cb('MUSIC/a.FLAC', []))
+            mapped.close()
+
+    def test_empty(self):
+        """Test saving a catalog with no files"""
+        write_catalog(FileCatalog([self.tmpdir]), self.cache)
+        mapped = MappedCatalog(self.cache)
+        self.assertEqual(len(mapped), 0)
+        self.assertIs(mapped.arg_test_cb('', []), False)
+        self.assertEqual(list(mapped.paths()), [])
+
+    def test_corrupt(self):
+        """Test that foreign and truncated files are rejected"""
+        with open(self.cache, 'wb') as fobj:
+            fobj.write(b'not a catalog at all, really')
+        self.assertRaises(ValueError, MappedCatalog, self.cache)
+
+        live = FileCatalog([self.root])
+        live.rescan()
+        write_catalog(live, self.cache)
+        with open(self.cache, 'rb') as fobj:
+            data = fobj.read()
+        with open(self.cache, 'wb') as fobj:
+            fobj.write(data[:60])
+        self.assertRaises(ValueError, MappedCatalog, self.cache)
+        with open(self.cache, 'wb') as fobj:
+            fobj.write(data[:-1])
+        self.assertRaises(ValueError, MappedCatalog, self.cache)
+
+class TestPersistentCatalog(CatalogFileTestCase):
+    """Test startup from a saved catalog and background reconciliation"""
+
+    def test_cold_and_warm_start(self):
+        """Test the first run, then a restart after the share changed"""
+        results = []
+        catalog = PersistentCatalog([self.root], self.cache,
+                                    ready_cb=results.append)
+        self.assertIs(catalog.arg_test_cb('Zed.txt', []), False,
+                "Nothing is known before the first scan")
+        catalog.start()
+        self.assertTrue(catalog.wait(10))
+        self.assertTrue(catalog.arg_test_cb('Zed.txt', []))
+        self.assertEqual(len(results[0].added), len(self.names))
+        self.assertTrue(os.path.exists(self.cache))
+
+        self.touch('New.txt')
+        os.remove(os.path.join(self.root, 'Zed.txt'))
+        results = []
+        catalog = PersistentCatalog([self.root], self.cache,
+                                    ready_cb=results.append)
+        self.assertIsInstance(catalog.current, MappedCatalog)
+        self.assertTrue(catalog.arg_test_cb('Zed.txt', []),
+                "Saved entries must be served before the rescan")
+        version = catalog.version
+
+        catalog.start()
+        self.assertTrue(catalog.wait(10))
+        self.assertNotEqual(catalog.version, version)
+        self.assertIs(catalog.current, catalog.live)
+        self.assertEqual([x.path for x in results[0].added], ['New.txt'])
+        self.assertEqual([x.path for x in results[0].removed], ['Zed.txt'])
+        self.assertEqual(results[0].changed, [])
+        self.assertIs(catalog.arg_test_cb('Zed.txt', []), False)
+
+        self.touch('Later.txt')
+        self.assertEqual(len(catalog.rescan().added), 1)
+        self.assertIn('Later.txt', MappedCatalog(self.cache))
+
+    def test_failed_rescan(self):
+        """Test that a failed initial rescan keeps the saved catalog"""
+        live = FileCatalog([self.root])
+        live.rescan()
+        write_catalog(live, self.cache)
+        saved = os.path.getmtime(self.cache)
+
+        results = []
+        catalog = PersistentCatalog([self.root], self.cache,
+                                    ready_cb=results.append)
+        mapped, rescan = catalog.current, catalog.live.rescan
+
+        def broken_rescan():
+            raise OSError("Share went away")
+        catalog.live.rescan = broken_rescan
+        catalog.start()
+        self.assertFalse(catalog.wait(10))
+        self.assertTrue(catalog.ready.is_set())
+        self.assertIsInstance(catalog.error, OSError)
+        self.assertEqual(results, [None])
+        self.assertIs(catalog.current, mapped,
+                "The saved catalog must keep answering after a failure")
+        self.assertTrue(catalog.arg_test_cb('Zed.txt', []))
+        self.assertEqual(os.path.getmtime(self.cache), saved,
+                "A failed rescan must not overwrite the saved catalog")
+
+        catalog.live.rescan = rescan
+        self.touch('Later.txt')
+        catalog.rescan()
+        self.assertIs(catalog.current, catalog.live)
+        self.assertIsNone(catalog.error)
+        self.assertIn('Later.txt', MappedCatalog(self.cache))
+
+    def test_other_roots_ignored(self):
+        """Test that a catalog saved for other roots isn't trusted"""
+        live = FileCatalog([self.root])
+        live.rescan()
+        write_catalog(live, self.cache)
+        catalog = PersistentCatalog([self.tmpdir], self.cache)
+        self.assertIs(catalog.current, catalog.live)
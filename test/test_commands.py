@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Test Suite for precompiled command tables for SnakeByte FServe"""
+
+__author__  = "Stephan Sokolow (deitarion/SSokolow)"
+__license__ = "GNU GPL 3.0 or later"
+__docformat__ = "restructuredtext en"
+
+import logging, sys
+log = logging.getLogger(__name__)
+
+if sys.version_info[0] == 2 and sys.version_info[1] < 7:  # pragma: no cover
+    import unittest2 as unittest
+    unittest  # Silence erroneous PyFlakes warning
+else:                                                     # pragma: no cover
+    import unittest
+
+from snakebyte.commands import (NO_HINTS, CompiledCommands,
+                                compile_commands)
+from snakebyte.shell_lexers import CachingLexer, LEXERS
+
+class Catalog(object):
+    """Stand-in for a `snakebyte.catalog.FileCatalog`"""
+    version = 0
+
+    def arg_test_cb(self, candidate_str, argv):
+        return candidate_str == 'My File.bin'
+
+class TestCompiledCommands(unittest.TestCase):
+    """Test `CompiledCommands` lookups and lexer compatibility"""
+
+    def setUp(self):
+        self.catalog = Catalog()
+        self.raw = {
+            '!get': (['-v', 5, None], self.catalog.arg_test_cb),
+            '!getall': (None, None),
+            '!list': (['-l'], None),
+            '!queue': None,
+        }
+        self.commands = CompiledCommands(self.raw)
+
+    def test_mapping(self):
+        """Test the read-only dict-like API"""
+        self.assertEqual(len(self.commands), len(self.raw))
+        self.assertEqual(sorted(self.commands), sorted(self.raw))
+        self.assertEqual(sorted(self.commands.keys()), sorted(self.raw))
+        self.assertIn('!get', self.commands)
+        self.assertNotIn('!ge', self.commands)
+
+        opts_list, arg_test_cb = self.commands['!get']
+        self.assertEqual(opts_list, frozenset(['-v']),
+                "Non-string options must be filtered out")
+        self.assertEqual(arg_test_cb, self.catalog.arg_test_cb)
+        self.assertEqual(self.commands.get('!queue'), NO_HINTS)
+        self.assertIs(self.commands.get('!nope'), None)
+        self.assertRaises(KeyError, self.commands.__getitem__, '!nope')
+
+    def test_abbreviations(self):
+        """Test resolving unique abbreviations via the name trie"""
+        self.assertEqual(self.commands.resolve('!get'), '!get',
+                "Exact matches must win over longer names")
+        self.assertEqual(self.commands.resolve('!getx'), None)
+        self.assertEqual(self.commands.resolve('!l'), '!list')
+        self.assertEqual(self.commands.resolve('!q'), '!queue')
+        self.assertIs(self.commands.resolve('!'), None)
+        self.assertIs(self.commands.resolve('!x'), None)
+        self.assertEqual(self.commands.candidates('!g'), ['!get', '!getall'])
+        self.assertEqual(self.commands.hints('!li').opts_list,
+                frozenset(['-l']))
+        self.assertIs(self.commands.hints('!x'), NO_HINTS)
+
+    def test_version(self):
+        """Test that version follows the arg_test_cb owners"""
+        before = self.commands.version
+        self.catalog.version += 1
+        self.assertNotEqual(before, self.commands.version)
+
+    def test_compile_commands(self):
+        """Test that compile_commands doesn't recompile"""
+        self.assertIs(compile_commands(self.commands), self.commands)
+        self.assertEqual(len(compile_commands(None)), 0)
+        self.assertEqual(sorted(compile_commands(self.raw)), sorted(self.raw))
+
+    def test_lexer_compatibility(self):
+        """Test that every lexer accepts both forms equivalently"""
+        cmd_string = '!get -v My File.bin'
+        for lexer in LEXERS + [CachingLexer(LEXERS[-1])]:
+            self.assertEqual(lexer(cmd_string, self.raw),
+                             lexer(cmd_string, self.commands))
+        self.assertEqual(LEXERS[-1]('!g My File.bin', self.commands),
+                ['!g', 'My', 'File.bin'],
+                "Ambiguous abbreviations must not receive hints")
+        self.assertEqual(LEXERS[-1]('!l My File.bin', self.commands),
+                ['!l', 'My', 'File.bin'])
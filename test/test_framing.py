@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Test Suite for IRC message framing code for SnakeByte FServe"""
+
+__author__  = "Stephan Sokolow (deitarion/SSokolow)"
+__license__ = "GNU GPL 3.0 or later"
+__docformat__ = "restructuredtext en"
+
+import logging, sys
+log = logging.getLogger(__name__)
+
+if sys.version_info[0] == 2 and sys.version_info[1] < 7:  # pragma: no cover
+    import unittest2 as unittest
+    unittest  # Silence erroneous PyFlakes warning
+else:                                                     # pragma: no cover
+    import unittest
+
+from snakebyte.framing import IRCMessage, LineFramer
+from snakebyte.shell_lexers import mirc_lexer
+
+class TestIRCMessage(unittest.TestCase):
+    """Test lazy parsing of individual messages"""
+
+    def test_full_message(self):
+        """Test a message with every optional component"""
+        msg = IRCMessage(b'@time=now :Nick!user@host privmsg #chan '
+                         b':!get "My File.bin"')
+        self.assertEqual(msg.tags, 'time=now')
+        self.assertEqual(msg.prefix, 'Nick!user@host')
+        self.assertEqual(msg.nick, 'Nick')
+        self.assertEqual(msg.command, 'PRIVMSG')
+        self.assertEqual(msg.params, ['#chan', '!get "My File.bin"'])
+        self.assertEqual(msg.trailing, '!get "My File.bin"')
+        self.assertEqual(msg.lex(mirc_lexer, {}),
+                ['!get', '"My File.bin"'])
+
+    def test_minimal_message(self):
+        """Test a message with only a command and middle parameters"""
+        msg = IRCMessage(b'PING  server1 server2')
+        self.assertEqual(msg.command, 'PING')
+        self.assertEqual(msg.params, ['server1', 'server2'])
+        for field in ('tags', 'prefix', 'nick', 'trailing'):
+            self.assertIs(getattr(msg, field), None)
+        self.assertEqual(msg.lex(mirc_lexer, {}), [])
+
+    def test_decoding(self):
+        """Test UTF-8 decoding with a fallback for legacy clients"""
+        msg = IRCMessage(u':n PRIVMSG #c :caf\xe9 ☃'.encode('utf-8'))
+        self.assertEqual(msg.trailing, u'caf\xe9 ☃')
+        msg = IRCMessage(u':n PRIVMSG #c :caf\xe9'.encode('latin-1'))
+        self.assertEqual(msg.trailing, u'caf\xe9')
+        self.assertEqual(msg.trailing, msg.params[-1])
+
+class TestLineFramer(unittest.TestCase):
+    """Test splitting a byte stream into messages"""
+    stream = (b':a!b@c PRIVMSG #x :!list\r\n'
+              b'PING :server\n'
+              b'\r\n'
+              b':d!e@f PRIVMSG #x :!get "A B.txt" C.txt\r\n')
+
+    def collect(self, framer, chunks, lexed=False):
+        """Feed chunks and return the raw text of all messages"""
+        results = []
+        for chunk in chunks:
+            if lexed:
+                results.extend((bytes(x.raw), y)
+                               for x, y in framer.feed_lexed(chunk))
+            else:
+                results.extend(bytes(x.raw) for x in framer.feed(chunk))
+        return results
+
+    def test_chunking(self):
+        """Test that output doesn't depend on how the stream is chunked"""
+        expected = self.collect(LineFramer(), [self.stream])
+        self.assertEqual(len(expected), 3)
+        self.assertEqual(expected[1], b'PING :server')
+
+        for size in range(1, len(self.stream)):
+            chunks = [self.stream[x:x + size]
+                      for x in range(0, len(self.stream), size)]
+            for wrapper in (bytes, bytearray, memoryview):
+                self.assertEqual(expected, self.collect(LineFramer(),
+                        [wrapper(x) for x in chunks]),
+                        "Failed with %s chunks of %d bytes" %
+                        (wrapper.__name__, size))
+
+    def test_eager(self):
+        """Test that a chunk is consumed even if its result is ignored"""
+        for method in ('feed', 'feed_lexed'):
+            framer = LineFramer()
+            getattr(framer, method)(self.stream + b'PING :par')
+            self.assertEqual(self.collect(framer, [b'tial\r\n']),
+                             [b'PING :partial'])
+
+    def test_zero_copy(self):
+        """Test that lines within a chunk are views into it"""
+        chunk = bytearray(self.stream)
+        messages = list(LineFramer().feed(chunk))
+        self.assertIsInstance(messages[0].raw, memoryview)
+        self.assertIs(messages[0].raw.obj, chunk)
+
+    def test_max_length(self):
+        """Test that over-long lines are discarded in their entirety"""
+        long_line = b'PRIVMSG #x :' + b'x' * 600 + b'\r\n'
+        stream = self.stream + long_line + self.stream
+        for size in (1, 7, 100, 512, len(stream)):
+            framer = LineFramer()
+            chunks = [stream[x:x + size] for x in range(0, len(stream), size)]
+            self.assertEqual(len(self.collect(framer, chunks)), 6)
+            self.assertEqual(framer.overflows, 1)
+
+        framer = LineFramer(max_length=1024)
+        self.assertEqual(len(self.collect(framer, [stream])), 7)
+
+    def test_lexing(self):
+        """Test handing trailing parameters to a lexer"""
+        stream = self.stream + b":g!h@i PRIVMSG #x :!get The O'Neill\r\n"
+        self.assertEqual(self.collect(LineFramer(), [stream], lexed=True), [
+            (b':a!b@c PRIVMSG #x :!list', ['!list']),
+            (b'PING :server', None),
+            (b':d!e@f PRIVMSG #x :!get "A B.txt" C.txt',
+             ['!get', 'A B.txt', 'C.txt']),
+            (b":g!h@i PRIVMSG #x :!get The O'Neill", None),
+        ])
+
+        framer = LineFramer(lexer=mirc_lexer)
+        self.assertEqual(self.collect(framer, [stream], lexed=True)[-1][1],
+                ['!get', "The O'Neill"])
+        self.assertRaises(KeyError, LineFramer, lexer='nonexistant')
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Test Suite for the checksum cache for SnakeByte FServe"""
+
+__author__  = "Stephan Sokolow (deitarion/SSokolow)"
+__license__ = "GNU GPL 3.0 or later"
+__docformat__ = "restructuredtext en"
+
+import hashlib, logging, os, shutil, sys, tempfile, threading, zlib
+from concurrent.futures import Future, ThreadPoolExecutor
+log = logging.getLogger(__name__)
+
+if sys.version_info[0] == 2 and sys.version_info[1] < 7:  # pragma: no cover
+    import unittest2 as unittest
+    unittest  # Silence erroneous PyFlakes warning
+else:                                                     # pragma: no cover
+    import unittest
+
+from snakebyte.hashcache import (FileHashes, HashCache, _hash_file,
+                                 file_identity)
+
+class NoExecutor(object):
+    """An executor which fails the test if anything is submitted to it"""
+    def submit(self, *args, **kwargs):
+        raise AssertionError("Cached file was rehashed")
+
+class FixedExecutor(object):
+    """An executor which reports a predetermined worker result"""
+    def __init__(self, result):
+        self.result = result
+
+    def submit(self, *args, **kwargs):
+        job = Future()
+        job.set_result(self.result)
+        return job
+
+class TestHashCache(unittest.TestCase):
+    """Test background hashing and persistence"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache_path = os.path.join(self.tmpdir, 'hashes.json')
+        self.data = os.urandom(300000)
+        self.path = self.make_file('a.bin', self.data)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def make_file(self, name, data):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, 'wb') as fobj:
+            fobj.write(data)
+        return path
+
+    def expected(self, data):
+        return FileHashes('%08x' % (zlib.crc32(data) & 0xffffffff),
+                          hashlib.md5(data).hexdigest())
+
+    def test_hash_file(self):
+        """Test both the mmap and buffered hashing paths"""
+        empty = self.make_file('empty.bin', b'')
+        self.assertEqual(_hash_file(self.path, block_size=65536),
+                         (file_identity(self.path), self.expected(self.data)))
+        self.assertEqual(_hash_file(empty)[1], self.expected(b''))
+
+    def test_process_pool(self):
+        """Test hashing in the default process pool"""
+        cache = HashCache(max_workers=1)
+        try:
+            self.assertEqual(cache.get(self.path).result(10),
+                             self.expected(self.data))
+            self.assertEqual(cache.get_cached(self.path),
+                             self.expected(self.data))
+        finally:
+            cache.close()
+
+    def test_inflight_shared(self):
+        """Test that concurrent requests share one computation"""
+        executor = ThreadPoolExecutor(1)
+        gate = threading.Event()
+        executor.submit(gate.wait)  # Hold the only worker
+
+        cache = HashCache(executor=executor)
+        first, second = cache.get(self.path), cache.get(self.path)
+        self.assertIs(first, second)
+        self.assertIsNone(cache.get_cached(self.path))
+        gate.set()
+        self.assertEqual(first.result(10), self.expected(self.data))
+        self.assertTrue(cache.get(self.path).done())
+        executor.shutdown()
+
+    def test_modified_during_hashing(self):
+        """Test that hashes aren't handed out for a different identity"""
+        identity, hashes = file_identity(self.path), self.expected(b'x')
+        newer = identity[:3] + (identity[3] + 1,)
+        for actual in (None, newer):
+            cache = HashCache(executor=FixedExecutor((actual, hashes)))
+            self.assertRaises(OSError, cache.get(self.path).result, 0)
+            self.assertNotIn(identity, cache)
+            self.assertEqual(actual in cache, actual is not None,
+                    "Hashes for a stable, newer identity should be kept")
+
+    def test_persistence(self):
+        """Test that a restarted cache doesn't rehash unchanged files"""
+        other = self.make_file('b.bin', b'other')
+        with ThreadPoolExecutor(2) as executor:
+            cache = HashCache(self.cache_path, executor=executor)
+            cache.get(self.path).result(10)
+            cache.get(other).result(10)
+            cache.close()
+        self.assertFalse(cache.dirty)
+
+        cache = HashCache(self.cache_path, executor=NoExecutor())
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get(self.path).result(0),
+                         self.expected(self.data))
+        self.assertEqual(cache.retain([file_identity(other)]), 1)
+        self.assertIsNone(cache.get_cached(self.path))
+
+        os.utime(other, (0, 0))
+        self.assertIsNone(cache.get_cached(other),
+                "Modified files must not be served from the cache")
+
+    def test_unusable(self):
+        """Test that corrupt caches and missing files are handled"""
+        with open(self.cache_path, 'w') as fobj:
+            fobj.write('{"version": 1, "entries": [[1, 2')
+        cache = HashCache(self.cache_path, executor=NoExecutor())
+        self.assertEqual(len(cache), 0)
+
+        future = cache.get(os.path.join(self.tmpdir, 'missing'))
+        self.assertIsInstance(future.exception(0), OSError)
+        self.assertIsNone(cache.get_cached('missing'))
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Test Suite for the paginated listings for SnakeByte FServe"""
+
+__author__  = "Stephan Sokolow (deitarion/SSokolow)"
+__license__ = "GNU GPL 3.0 or later"
+__docformat__ = "restructuredtext en"
+
+import logging, os, shutil, sys, tempfile
+log = logging.getLogger(__name__)
+
+if sys.version_info[0] == 2 and sys.version_info[1] < 7:  # pragma: no cover
+    import unittest2 as unittest
+    unittest  # Silence erroneous PyFlakes warning
+else:                                                     # pragma: no cover
+    import unittest
+
+from snakebyte.catalog import FileCatalog
+from snakebyte.listing import Listing, catalog_listing, queue_listing
+from snakebyte.queue import FairQueue
+
+class TestListing(unittest.TestCase):
+    """Test pagination and caching over plain sources"""
+
+    def setUp(self):
+        self.generation, self.built, self.pulled = 0, 0, 0
+        self.items = ['item%02d' % x for x in range(23)]
+
+    def sequence_source(self):
+        self.built += 1
+        return self.items
+
+    def lazy_source(self):
+        self.built += 1
+        for item in self.items:
+            self.pulled += 1
+            yield item
+
+    def make(self, source_cb, **kwargs):
+        self.formatted = []
+
+        def format_cb(pos, item):
+            self.formatted.append(item)
+            return '%d:%s' % (pos, item)
+        return Listing(source_cb, lambda: self.generation,
+                       format_cb=format_cb, page_size=10, **kwargs)
+
+    def check_pages(self, listing):
+        """Verify every page's contents and the end-of-listing flags"""
+        self.assertEqual(listing.page(1).lines,
+                         ['%d:item%02d' % (x + 1, x) for x in range(10)])
+        self.assertEqual(listing.page(2).lines[0], '11:item10')
+        self.assertEqual(listing.page(3),
+                         (3, ['21:item20', '22:item21', '23:item22'], False))
+        self.assertTrue(listing.page(2).more)
+        self.assertEqual(listing.page(4), (4, [], False))
+        self.assertEqual(listing.page_count(), 3)
+        self.assertRaises(ValueError, listing.page, 0)
+
+    def test_sequence(self):
+        """Test slicing pages out of a sequence source"""
+        listing = self.make(self.sequence_source)
+        self.check_pages(listing)
+        self.assertEqual(listing.page(2).lines[-1], '20:item19')
+        self.assertEqual(len(self.formatted), 23,
+                "Each item must be formatted once while cached")
+        self.assertEqual(self.built, 1)
+
+    def test_lazy(self):
+        """Test consuming a generator source only as far as needed"""
+        listing = self.make(self.lazy_source)
+        listing.page(1)
+        self.assertEqual(self.pulled, 11)
+        self.assertIsNone(listing.page_count())
+        listing.page(2)
+        self.assertEqual(self.pulled, 21)
+        self.check_pages(listing)
+        self.assertEqual(self.built, 1)
+        self.assertEqual(len(self.formatted), 23)
+
+    def test_lazy_skip_and_eviction(self):
+        """Test jumping ahead and rereading pages which were evicted"""
+        listing = self.make(self.lazy_source, max_cached=1)
+        self.assertEqual(listing.page(3).lines[0], '21:item20')
+        self.assertEqual(self.formatted, self.items[20:],
+                "Skipped items must not be formatted")
+        self.assertEqual(listing.page(1).lines[0], '1:item00')
+        self.assertEqual(listing.page(2).lines[0], '11:item10')
+        self.assertEqual(listing.page(3).lines[0], '21:item20')
+        self.assertEqual((self.built, self.pulled), (1, 23),
+                "Evicted pages must be rebuilt from items already pulled")
+        self.assertEqual(listing.page_count(), 3)
+
+    def test_invalidation(self):
+        """Test that changing the generation discards cached pages"""
+        listing = self.make(self.sequence_source)
+        first = listing.page(1)
+        self.assertIs(listing.page(1), first)
+        self.items = self.items[5:]
+        self.assertIs(listing.page(1), first)
+
+        self.generation += 1
+        self.assertEqual(listing.page(1).lines[0], '1:item05')
+        self.assertEqual(listing.page_count(), 2)
+        self.assertEqual(self.built, 2)
+
+class TestListingSources(unittest.TestCase):
+    """Test the catalog and queue listing helpers"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        for name in ('b.txt', 'a.txt', 'c.txt'):
+            open(os.path.join(self.tmpdir, name), 'w').close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_catalog_listing(self):
+        """Test listing a catalog, including after a rescan"""
+        catalog = FileCatalog([self.tmpdir])
+        catalog.rescan()
+        listing = catalog_listing(catalog, page_size=2)
+        self.assertEqual(listing.page(1), (1, ['1. a.txt', '2. b.txt'], True))
+
+        os.remove(os.path.join(self.tmpdir, 'a.txt'))
+        catalog.rescan()
+        self.assertEqual(listing.page(1).lines, ['1. b.txt', '2. c.txt'])
+        self.assertEqual(catalog_listing(catalog, 'c').page(1).lines,
+                         ['1. c.txt'])
+
+    def test_queue_listing(self):
+        """Test listing a queue, including after it changes"""
+        clock = iter(range(100))
+        queue = FairQueue(priority_cb=lambda key: next(clock))
+        queue.extend('alice', [1, 2])
+        queue.push('bob', 3)
+        listing = queue_listing(queue)
+        self.assertEqual(listing.page(1).lines,
+                         ['1. alice (2 queued)', '2. bob (1 queued)'])
+
+        queue.pop()
+        self.assertEqual(listing.page(1).lines,
+                         ['1. bob (1 queued)', '2. alice (1 queued)'])
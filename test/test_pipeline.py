@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Test Suite for the asyncio command pipeline for SnakeByte FServe"""
+
+__author__  = "Stephan Sokolow (deitarion/SSokolow)"
+__license__ = "GNU GPL 3.0 or later"
+__docformat__ = "restructuredtext en"
+
+import logging, sys, threading
+log = logging.getLogger(__name__)
+
+if sys.version_info[0] == 2 and sys.version_info[1] < 7:  # pragma: no cover
+    import unittest2 as unittest
+    unittest  # Silence erroneous PyFlakes warning
+else:                                                     # pragma: no cover
+    import unittest
+
+try:                                                      # pragma: no cover
+    import asyncio
+    from snakebyte.pipeline import CommandPipeline, FloodControl, TokenBucket
+except (ImportError, SyntaxError):                        # pragma: no cover
+    asyncio = None
+
+from snakebyte.popularity import PopularityTracker
+from snakebyte.queue import FairQueue
+
+@unittest.skipIf(asyncio is None, "asyncio not available")
+class TestFloodControl(unittest.TestCase):
+    """Test token-bucket rate limiting"""
+
+    def test_token_bucket(self):
+        """Test `TokenBucket` refill and capacity"""
+        bucket = TokenBucket(rate=2, capacity=3, now=0)
+        self.assertEqual([bucket.consume(0) for _ in range(4)],
+                         [True, True, True, False])
+        self.assertTrue(bucket.consume(0.5))
+        self.assertFalse(bucket.consume(0.5))
+        self.assertFalse(bucket.is_full(1))
+        self.assertTrue(bucket.is_full(2))
+
+    def test_sweep(self):
+        """Test that `FloodControl` forgets idle keys"""
+        flood = FloodControl(rate=1, burst=2, sweep_size=10,
+                             clock=lambda: 5)
+        for key in range(10):
+            self.assertTrue(flood.allow(key, now=0))
+        self.assertEqual(len(flood), 10)
+        self.assertTrue(flood.allow('new', now=5))
+        self.assertEqual(len(flood), 1,
+                "Refilled buckets must be discarded by the sweep")
+
+        self.assertTrue(flood.allow('new'))
+        self.assertFalse(flood.allow('new'))
+
+@unittest.skipIf(asyncio is None, "asyncio not available")
+class TestCommandPipeline(unittest.TestCase):
+    """Test batching, validation, and enqueueing"""
+    files = ['My File.bin', 'Other.txt']
+
+    def setUp(self):
+        self.queue = FairQueue()
+        self.lex_threads = set()
+        self.commands = {
+            '!get': ([], self.arg_test_cb),
+            '!list': ([], None),
+        }
+        self.tracker = PopularityTracker()
+        self.pipeline = CommandPipeline(self.queue, self.request_cb,
+                commands=self.commands, burst=3, batch_delay=0,
+                tracker=self.tracker)
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def arg_test_cb(self, candidate_str, argv):
+        self.lex_threads.add(threading.current_thread())
+        return candidate_str in self.files
+
+    def request_cb(self, key, argv):
+        if argv[0] != '!get':
+            raise ValueError("Not a request")
+        elif argv[1:] == ['crash']:
+            raise KeyError(argv[1])
+        missing = [x for x in argv[1:] if x not in self.files]
+        if missing:
+            raise ValueError("No such file: %s" % missing[0])
+        return argv[1:]
+
+    def test_process(self):
+        """Test processing a batch directly"""
+        results = self.loop.run_until_complete(self.pipeline.process([
+            ('alice', '!get My File.bin Other.txt'),
+            ('bob', '!list'),
+            ('alice', '!get Other.txt'),
+            ('carol', "!get The O'Neill"),
+            ('dave', '!list "unterminated'),
+            ('eve', '!get crash'),
+            ('bob', '!get Other.txt'),
+        ]))
+        self.assertEqual(results[0],
+                ('alice', ['!get', 'My File.bin', 'Other.txt'],
+                 ['My File.bin', 'Other.txt']))
+        self.assertEqual(results[1][1], ['!list'])
+        self.assertIsInstance(results[1][2], ValueError)
+        self.assertIsInstance(results[3][2], ValueError)
+        self.assertEqual(results[4][1], None)
+        self.assertIsInstance(results[4][2], ValueError)
+        self.assertIsInstance(results[5][2], KeyError)
+        self.assertEqual(results[6][2], ['Other.txt'],
+                "A failing request_cb must not lose the rest of the batch")
+
+        self.assertEqual(self.queue['alice'],
+                ['My File.bin', 'Other.txt', 'Other.txt'])
+        self.assertEqual(list(self.queue), ['alice', 'bob'])
+        self.assertEqual((self.pipeline.accepted, self.pipeline.rejected),
+                         (3, 4))
+        self.assertEqual(self.tracker.top(1), [('Other.txt', 3)],
+                "Enqueued requests must be recorded as popularity")
+        self.assertNotIn(threading.current_thread(), self.lex_threads,
+                "Lines using arg_test_cb must be lexed off the event loop")
+
+    def test_run(self):
+        """Test submission, flood control, and the batch loop"""
+        submitted = [self.pipeline.submit('alice', '!get Other.txt')
+                     for _ in range(5)]
+        self.assertEqual(submitted, [True] * 3 + [False] * 2)
+        self.assertEqual(self.pipeline.throttled, 2)
+        self.assertTrue(self.pipeline.submit('bob', '!get My File.bin'))
+
+        task = self.loop.create_task(self.pipeline.run())
+        self.loop.run_until_complete(asyncio.sleep(0.1))
+        task.cancel()
+        self.loop.run_until_complete(
+            asyncio.gather(task, return_exceptions=True))
+        self.assertEqual(len(self.queue), 4)
+        self.assertEqual(self.queue['bob'], ['My File.bin'])
+        self.assertEqual(self.pipeline.dropped, 0)
+
+    def test_full_buffer(self):
+        """Test that lines dropped for a full buffer are counted apart"""
+        pipeline = CommandPipeline(self.queue, self.request_cb,
+                commands=self.commands, max_pending=2)
+        self.assertEqual([pipeline.submit(x, '!list') for x in 'abc'],
+                         [True, True, False])
+        self.assertEqual((pipeline.dropped, pipeline.throttled), (1, 0))
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Test Suite for hot-file detection and prefetching for SnakeByte FServe"""
+
+__author__  = "Stephan Sokolow (deitarion/SSokolow)"
+__license__ = "GNU GPL 3.0 or later"
+__docformat__ = "restructuredtext en"
+
+import logging, os, random, shutil, sys, tempfile
+log = logging.getLogger(__name__)
+
+if sys.version_info[0] == 2 and sys.version_info[1] < 7:  # pragma: no cover
+    import unittest2 as unittest
+    unittest  # Silence erroneous PyFlakes warning
+else:                                                     # pragma: no cover
+    import unittest
+
+from snakebyte.popularity import (CountMinSketch, PopularityTracker,
+                                  Prefetcher, advise_willneed)
+from snakebyte.queue import FairQueue
+from snakebyte.resume import ResumeEntry
+
+class TestCountMinSketch(unittest.TestCase):
+    """Test the accuracy bounds of the sketch"""
+
+    def test_estimates(self):
+        """Test that estimates never undercount and rarely overcount much"""
+        sketch, truth = CountMinSketch(width=256, depth=4), {}
+        rng = random.Random(0)
+        for _ in range(20000):
+            item = 'file%d' % int(rng.paretovariate(1.0))
+            truth[item] = truth.get(item, 0) + 1
+            sketch.add(item)
+
+        self.assertEqual(sketch.total, 20000)
+        slack = 2.72 * sketch.total / sketch.width
+        bad = 0
+        for item, count in truth.items():
+            self.assertGreaterEqual(sketch.estimate(item), count)
+            bad += sketch.estimate(item) - count > slack
+        self.assertLessEqual(bad, len(truth) * 0.05)
+
+    def test_decay(self):
+        """Test that decay halves counts"""
+        sketch = CountMinSketch(width=64, depth=2)
+        self.assertEqual(sketch.estimate('a'), 0)
+        self.assertEqual(sketch.add('a', 7), 7)
+        sketch.decay()
+        self.assertEqual(sketch.estimate('a'), 3)
+        self.assertEqual(sketch.total, 3)
+
+class TestPopularityTracker(unittest.TestCase):
+    """Test top-K maintenance"""
+
+    def test_top(self):
+        """Test that the most requested items are tracked, hottest first"""
+        tracker, rng = PopularityTracker(top_k=3), random.Random(1)
+        requests = ['hot'] * 50 + ['warm'] * 30 + ['mild'] * 20
+        requests += ['cold%d' % x for x in range(200)]
+        rng.shuffle(requests)
+        for item in requests:
+            tracker.record(item)
+
+        self.assertEqual([x for x, _ in tracker.top()],
+                         ['hot', 'warm', 'mild'])
+        self.assertEqual(tracker.top(1), [('hot', 50)])
+        self.assertIn('warm', tracker)
+        self.assertNotIn('cold0', tracker)
+        self.assertEqual(tracker.estimate('mild'), 20)
+
+        tracker.decay()
+        self.assertEqual(tracker.top(1), [('hot', 25)])
+        for _ in range(40):
+            tracker.record('new')
+        self.assertEqual(tracker.top(1), [('new', 40)],
+                "Recent requests must outweigh decayed ones")
+
+    def test_top_ties(self):
+        """Test that ties don't compare items, which may be unorderable"""
+        tracker = PopularityTracker(top_k=3)
+        for item in ('b', 1, ('c',), 'b'):
+            tracker.record(item)
+        self.assertEqual(tracker.top(), [('b', 2), (1, 1), (('c',), 1)])
+
+class TestPrefetcher(unittest.TestCase):
+    """Test look-ahead prefetching"""
+
+    def setUp(self):
+        self.advised = []
+        clock = iter(range(10 ** 6))
+        self.queue = FairQueue(priority_cb=lambda key: next(clock))
+
+    def advise(self, path, offset, length):
+        self.advised.append((path, offset, length))
+        return True
+
+    def test_lookahead(self):
+        """Test that upcoming files are advised once each, in order"""
+        self.queue.extend('alice', ['a1', 'a2', 'a3'])
+        self.queue.extend('bob', ['b1', ResumeEntry('b2', 500, None, 1)])
+        prefetcher = Prefetcher(self.queue, resolve_cb=lambda x: '/srv/' + x,
+                                lookahead=4, length=100,
+                                advise_cb=self.advise)
+
+        self.assertEqual(prefetcher.prefetch(),
+                         ['/srv/a1', '/srv/b1', '/srv/a2', '/srv/b2'])
+        self.assertEqual(self.advised[-1], ('/srv/b2', 500, 100))
+        self.assertEqual(prefetcher.prefetch(), [],
+                "Nothing must be advised while the queue is unchanged")
+
+        self.queue.pop()
+        self.assertEqual(prefetcher.prefetch(), ['/srv/a3'],
+                "Recently advised files must not be advised again")
+
+    def test_hot(self):
+        """Test that the hottest files are prefetched too"""
+        tracker = PopularityTracker()
+        for item in ['x'] * 3 + ['y'] * 2 + ['z']:
+            tracker.record(item)
+        self.queue.push('alice', 'a1')
+        prefetcher = Prefetcher(self.queue, tracker=tracker, hot=2,
+                                advise_cb=self.advise, remember=2)
+        self.assertEqual(prefetcher.prefetch(), ['a1', 'x', 'y'])
+        self.assertEqual(len(prefetcher._recent), 2)
+
+    def test_advise_willneed(self):
+        """Test the real posix_fadvise call"""
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'a.bin')
+            with open(path, 'wb') as fobj:
+                fobj.write(b'x' * 10000)
+            self.assertEqual(advise_willneed(path, 0, 4096),
+                             hasattr(os, 'posix_fadvise'))
+            self.assertFalse(advise_willneed(os.path.join(tmpdir, 'nope')))
+        finally:
+            shutil.rmtree(tmpdir)
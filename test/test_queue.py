@@ -106,6 +106,11 @@ class BaseTestQueue(unittest.TestCase):
             self.assertEqual(len(queue._subqueues), target_count,
                     "Subqueues dict should gain exactly one entry per bucket")
 
+        positions = dict((key, pos)
+                         for pos, (_, key) in enumerate(queue._buckets))
+        self.assertEqual(queue._positions, positions,
+                "Heap position index must match the heap")
+
         test_heap = self.queue._buckets[:]
         heapq.heapify(test_heap)
         self.assertEqual(self.queue._buckets, test_heap,
@@ -220,6 +225,45 @@ class TestEmptyQueue(BaseTestQueue):
             target_count += 1
         self._check_equivalence(self.users)
 
+    def test_extend(self):
+        """Test that `FairQueue.extend` matches repeated `FairQueue.push`"""
+        pushed_queue = FairQueue(priority_cb=self.priority_cb)
+        for user in self.users.values():
+            self.queue.extend(user.bucket_id, iter(user.goal))
+            self.queue.extend(user.bucket_id, [])
+            for entry in user.goal:
+                pushed_queue.push(user.bucket_id, entry)
+
+        self._check_invariants(len(self.users))
+        self._check_equivalence(pushed_queue)
+
+        self.queue.extend('foo', [])
+        self.assertNotIn('foo', self.queue._subqueues,
+                "Extending with nothing must not create an empty bucket")
+        self.assertRaises(TypeError, self.queue.extend, {}, [1])
+
+    def test_generation(self):
+        """Test that every mutating method bumps `FairQueue.generation`"""
+        queue, seen = FairQueue(), set()
+
+        def check(operation, changed=True):
+            before = queue.generation
+            operation()
+            self.assertEqual(queue.generation != before, changed)
+            if changed:
+                self.assertNotIn(queue.generation, seen)
+                seen.add(queue.generation)
+
+        seen.add(queue.generation)
+        check(lambda: queue.push('foo', 1))
+        check(lambda: queue.extend('bar', [2, 3]))
+        check(lambda: queue.extend('bar', []), changed=False)
+        check(lambda: queue.__setitem__('baz', [4]))
+        check(lambda: queue.pop())
+        check(lambda: queue.__delitem__('bar'))
+        check(lambda: list(queue), changed=False)
+        check(queue.clear)
+
     def test_populate_equivalence(self):
         """Test that `FairQueue.__init__` and `FairQueue.push` order equally"""
         populated_queue = FairQueue(
@@ -313,6 +357,29 @@ class TestPopulatedQueue(BaseTestQueue):
             self.assertEqual(self.queue.pop(user.bucket_id)[1], goal_item,
                 "Mutations to lists returned by __getitem__ must affect pop()")
 
+    def test_peek(self):
+        """Test that `FairQueue.peek` predicts `pop` without side effects"""
+        clock = iter(range(10 ** 6))
+        for kwargs in ({'priority_cb': lambda key: next(clock)},
+                       {'class_weights': {'op': 3}, 'class_cb':
+                        lambda key: 'op' if key == 'alice' else None}):
+            queue = FairQueue(**kwargs)
+            queue.extend('alice', range(6))
+            queue.extend('bob', range(3))
+            queue.extend('carol', range(2))
+            queue['dave'] = []
+            queue.pop()
+
+            before, generation = queue.dump(), queue.generation
+            expected = queue.peek(20)
+            self.assertEqual(queue.dump(), before)
+            self.assertEqual(queue.generation, generation)
+            self.assertEqual(queue.peek(3), expected[:3])
+
+            self.assertEqual(expected,
+                             [queue.pop() for _ in range(len(queue))])
+            self.assertEqual(queue.peek(), [])
+
     def test_getitem_safety(self):
         """Test emptying a subqueue using `FairQueue.__getitem__`"""
         # Empty the next subqueue in line
@@ -346,6 +413,18 @@ class TestPopulatedQueue(BaseTestQueue):
         self.assertEqual(list(self.queue), list(self.users) + ['foo', 'bar'],
                 "Queue iteration must be in priority order")
 
+    def test_iter_ordered(self):
+        """Test `FairQueue.iter_ordered`"""
+        for key in range(50):
+            self.queue.extend(key, [key] * (key % 3))
+        self.assertEqual(list(self.queue.iter_ordered()), list(self.queue),
+                "Lazy iteration must match sorted iteration")
+
+        keys = self.queue.iter_ordered()
+        next(keys)
+        self.queue.pop()
+        self.assertRaises(RuntimeError, next, keys)
+
     def test_keys(self):
         """Test `FairQueue.keys`"""
         self.assertEqual(self.queue.keys(), [x for x in self.queue],
@@ -457,9 +536,43 @@ class TestPopulatedQueue(BaseTestQueue):
 
         # Test the hardest-to-reach branch in pop()
         for key in self.queue:  # pragma: no branch
+            self.queue.get_class(key)
             del self.queue._subqueues[key]
             break
         self.queue.pop()
+        self.assertNotIn(key, self.queue._classes,
+                "Recovery must not leak the class of the desynced bucket")
+
+    def test_record_transfer(self):
+        """Test `FairQueue.record_transfer` bookkeeping and expiry"""
+        key = list(self.queue)[0]
+        self.assertEqual(self.queue.record_transfer(key, 100, 2.0),
+                         (1, 100, 2.0))
+        self.assertEqual(self.queue.record_transfer(key, 50, 1.0),
+                         (2, 150, 3.0))
+        self.assertEqual(self.queue.transfer_stats[key], (2, 150, 3.0))
+
+        while key in self.queue:
+            self.queue.pop(key)
+        self.queue.record_transfer(key, 10, 1.0)
+        self.assertEqual(self.queue.transfer_stats[key], (3, 160, 4.0),
+                "Stats must outlive the bucket they were reported for")
+
+        queue = FairQueue(max_stats=2)
+        for name in ('a', 'b', 'a', 'c'):
+            queue.record_transfer(name, 1, 1)
+        self.assertEqual(list(queue.transfer_stats), ['a', 'c'],
+                "Stats must be bounded, dropping the least recent first")
+
+        self.queue.clear()
+        self.assertEqual(self.queue.transfer_stats, {})
+
+    def test_bool(self):
+        """Test that truth testing reflects whether anything is queued"""
+        self.assertTrue(self.queue)
+        self.assertIs(bool(self.queue), self.queue.__bool__())
+        self.queue.clear()
+        self.assertFalse(self.queue)
 
     def test_setitem(self):
         """Test `FairQueue.__setitem__`"""
@@ -478,3 +591,120 @@ class TestPopulatedQueue(BaseTestQueue):
         self.assertEqual(self.queue['foo'], test_value,
                 "If at all possible, existing references to __setitem__'s "
                 "input must remain as mutable references to the subqueue")
+
+class TestClassfulQueue(BaseTestQueue):
+    """Tests for privilege classes and weighted stride scheduling"""
+    weights = {'op': 4, 'voice': 2}
+
+    def setUp(self):
+        super(TestClassfulQueue, self).setUp()
+        self.classes = {}
+        self.queue = FairQueue(class_weights=self.weights,
+                               class_cb=self.classes.get)
+
+    def fill(self, keys, count=100):
+        for key in keys:
+            self.queue.extend(key, range(count))
+
+    def serve(self, pops):
+        counts = {}
+        for _ in range(pops):
+            key, _ = self.queue.pop()
+            counts[key] = counts.get(key, 0) + 1
+            self._check_invariants()
+        return counts
+
+    def test_weighted_shares(self):
+        """Test that buckets are served in proportion to class weights"""
+        self.classes.update(alice='op', bob='voice')
+        self.fill(['alice', 'bob', 'carol'])
+        self.assertEqual(self.serve(70), {'alice': 40, 'bob': 20, 'carol': 10})
+        self.assertEqual(self.queue.get_class('alice'), 'op')
+        self.assertEqual(self.queue.get_class('carol'), None)
+
+    def test_no_starvation(self):
+        """Test that regular buckets are served despite many privileged"""
+        ops = ['op%d' % x for x in range(20)]
+        self.classes.update((x, 'op') for x in ops)
+        self.fill(ops + ['regular'])
+
+        # Everyone enters one stride past vtime 0, so each op is served
+        # four times (passes 0.25 to 1.0) at most before the regular bucket
+        served = []
+        while 'regular' not in served:
+            served.append(self.queue.pop()[0])
+        self.assertLessEqual(len(served), 4 * len(ops) + 1)
+
+        counts = self.serve(810)
+        self.assertEqual(counts['regular'], 10)
+        self.assertTrue(all(counts[x] == 40 for x in ops))
+
+    def test_no_gaming(self):
+        """Test that re-adding a bucket never moves it ahead"""
+        self.fill(['alice', 'bob', 'carol'])
+        self.queue.pop()
+        del self.queue['bob']
+        self.queue.push('bob', 1)
+        self.assertEqual(list(self.queue), ['carol', 'alice', 'bob'])
+
+    def test_set_class(self):
+        """Test changing a bucket's class while it waits"""
+        self.fill(['alice', 'bob'])
+        self.assertEqual(self.serve(10), {'alice': 5, 'bob': 5})
+
+        generation = self.queue.generation
+        self.queue.set_class('bob', 'op')
+        self.assertNotEqual(self.queue.generation, generation)
+        self.assertEqual(self.queue.get_class('bob'), 'op')
+        self.assertEqual(self.serve(50), {'alice': 10, 'bob': 40})
+
+        self.queue.set_class('bob', None)
+        self.assertEqual(self.serve(10), {'alice': 5, 'bob': 5})
+        self.assertRaises(KeyError, self.queue.set_class, 'dave', 'op')
+
+    def test_set_class_rescales_wait(self):
+        """Test that a promoted bucket's remaining wait shrinks"""
+        self.fill(['alice', 'bob', 'carol'])
+        self.queue.set_class('carol', 'op')
+        self.assertEqual(list(self.queue), ['carol', 'alice', 'bob'])
+
+    def test_class_expiry(self):
+        """Test that class assignments expire along with their bucket"""
+        self.queue.push('alice', 1)
+        self.queue.set_class('alice', 'op')
+        self.queue.pop()
+        self.assertNotIn('alice', self.queue._classes)
+
+        self.classes['alice'] = 'voice'
+        self.queue.push('alice', 2)
+        self.assertEqual(self.queue.get_class('alice'), 'voice')
+        self.queue.clear()
+        self.assertEqual(self.queue._classes, {})
+
+        self.assertEqual(self.queue.get_class('alice'), 'voice')
+        self.assertEqual(self.queue._classes, {},
+                "Classes must not be cached for keys which aren't queued")
+
+    def test_random_operations(self):
+        """Test heap and position index consistency under random use"""
+        import random
+        rng = random.Random(0)
+        keys = ['user%d' % x for x in range(30)]
+        for _ in range(2000):
+            key, action = rng.choice(keys), rng.random()
+            if action < 0.4:
+                self.queue.push(key, 1)
+            elif action < 0.6 and self.queue:
+                self.queue.pop()
+            elif action < 0.7 and key in self.queue:
+                self.queue.pop(key)
+            elif action < 0.8 and key in self.queue:
+                del self.queue[key]
+            elif key in self.queue:
+                self.queue.set_class(key, rng.choice([None, 'op', 'voice']))
+            self._check_invariants()
+
+        dump = self.queue.dump()
+        loaded = FairQueue.load(dump, class_weights=self.weights)
+        self._check_invariants(queue=loaded)
+        self.assertEqual(loaded.vtime, min(x[0] for x in dump[0]))
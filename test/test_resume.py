@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Test Suite for the resume offset store for SnakeByte FServe"""
+
+__author__  = "Stephan Sokolow (deitarion/SSokolow)"
+__license__ = "GNU GPL 3.0 or later"
+__docformat__ = "restructuredtext en"
+
+import logging, os, shutil, sys, tempfile
+log = logging.getLogger(__name__)
+
+if sys.version_info[0] == 2 and sys.version_info[1] < 7:  # pragma: no cover
+    import unittest2 as unittest
+    unittest  # Silence erroneous PyFlakes warning
+else:                                                     # pragma: no cover
+    import unittest
+
+from snakebyte.resume import ResumeEntry, ResumeStore, unwrap
+
+class FakeClock(object):
+    """A manually-advanced replacement for ``time.time``"""
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+class TestResumeStore(unittest.TestCase):
+    """Test bounded storage, expiry, and persistence of resume offsets"""
+    ident = (1, 2, 3, 4)
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'resume.json')
+        self.clock = FakeClock()
+        self.store = ResumeStore(self.path, max_entries=3, ttl=100,
+                                 clock=self.clock)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_record(self):
+        """Test recording, replacing, and discarding offsets"""
+        self.assertEqual(self.store.get('alice', self.ident), 0)
+        self.store.record('alice', self.ident, 500)
+        self.store.record('alice', self.ident, 900)
+        self.assertEqual(self.store.get('alice', self.ident), 900)
+        self.assertEqual(self.store.get('alice', (1, 2, 3, 5), None), None,
+                "Records must not apply to a different file identity")
+        self.assertEqual(self.store.get('bob', self.ident), 0)
+
+        self.store.record('alice', self.ident, 0)
+        self.assertNotIn(('alice', self.ident), self.store)
+        self.store.record('bob', self.ident, 5)
+        self.store.discard('bob', self.ident)
+        self.store.discard('bob', self.ident)
+        self.assertEqual(len(self.store), 0)
+
+    def test_lru(self):
+        """Test that the least recently used record is dropped first"""
+        for name in ('a', 'b', 'c'):
+            self.store.record(name, self.ident, 1)
+        self.store.get('a', self.ident)
+        self.store.record('d', self.ident, 1)
+        self.assertEqual(len(self.store), 3)
+        self.assertNotIn(('b', self.ident), self.store)
+        self.assertIn(('a', self.ident), self.store)
+
+    def test_ttl(self):
+        """Test that unused records expire"""
+        self.store.record('a', self.ident, 1)
+        self.clock.now += 60
+        self.store.record('b', self.ident, 1)
+        self.clock.now += 50
+        self.assertEqual(self.store.get('a', self.ident), 0)
+        self.assertEqual(self.store.get('b', self.ident), 1)
+        self.clock.now += 99
+        self.assertEqual(self.store.expire(), 0,
+                "Lookups must refresh a record's lifetime")
+        self.clock.now += 1
+        self.assertEqual(self.store.expire(), 1)
+
+    def test_persistence(self):
+        """Test that records survive a save and reload"""
+        key = ('network0', 'user0')
+        self.store.record(key, self.ident, 1234)
+        self.store.record('bob', self.ident, 5)
+        self.store.save()
+        self.assertFalse(self.store.dirty)
+
+        store = ResumeStore(self.path, max_entries=3, ttl=100,
+                            clock=self.clock)
+        self.assertEqual(store.get(key, self.ident), 1234)
+        self.assertEqual(list(store._entries),
+                         [('bob', self.ident), (key, self.ident)])
+
+        self.clock.now += 100
+        store = ResumeStore(self.path, ttl=100, clock=self.clock)
+        self.assertEqual(len(store), 0, "Stale records must expire on load")
+
+    def test_unusable(self):
+        """Test that corrupt or incompatible files are ignored"""
+        for content in ('garbage', '{"version": 0, "entries": []}',
+                        '{"version": 1, "entries": [[1]]}'):
+            with open(self.path, 'w') as fobj:
+                fobj.write(content)
+            self.assertEqual(len(ResumeStore(self.path)), 0)
+
+    def test_unwrap(self):
+        """Test recovering the original value from a requeued entry"""
+        self.assertEqual(unwrap('a.bin'), 'a.bin')
+        self.assertEqual(unwrap(ResumeEntry('a.bin', 5, self.ident, 1)),
+                         'a.bin')
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Test Suite for the parallel share scanner for SnakeByte FServe"""
+
+__author__  = "Stephan Sokolow (deitarion/SSokolow)"
+__license__ = "GNU GPL 3.0 or later"
+__docformat__ = "restructuredtext en"
+
+import logging, os, shutil, sys, tempfile, threading, time
+log = logging.getLogger(__name__)
+
+if sys.version_info[0] == 2 and sys.version_info[1] < 7:  # pragma: no cover
+    import unittest2 as unittest
+    unittest  # Silence erroneous PyFlakes warning
+else:                                                     # pragma: no cover
+    import unittest
+
+from snakebyte.catalog import FileCatalog
+from snakebyte.scanner import ShareScanner
+from test import test_catalog
+
+class TestScannedFileCatalog(test_catalog.TestFileCatalog):
+    """Rerun the `FileCatalog` tests with a `ShareScanner`"""
+
+    def setUp(self):
+        super(TestScannedFileCatalog, self).setUp()
+        self.catalog = FileCatalog(self.roots,
+                scanner=ShareScanner(max_workers=4, trust_dir_mtime=False))
+        self.catalog.rescan()
+
+class CountingScanner(ShareScanner):
+    """A scanner which records how many listings run at once"""
+
+    def __init__(self, *args, **kwargs):
+        super(CountingScanner, self).__init__(*args, **kwargs)
+        self.lock, self.active, self.peak = threading.Lock(), 0, 0
+
+    def _visit(self, *args):
+        with self.lock:
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+        try:
+            time.sleep(0.005)
+            return super(CountingScanner, self)._visit(*args)
+        finally:
+            with self.lock:
+                self.active -= 1
+
+class TestShareScanner(unittest.TestCase):
+    """Test parallel traversal, concurrency limits, and mtime skipping"""
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        for top in range(4):
+            for sub in range(3):
+                self.write('d%d/s%d/file.txt' % (top, sub))
+            self.write('d%d/top.txt' % top)
+        self.write('root.txt')
+        os.symlink(os.path.join(self.root, 'root.txt'),
+                   os.path.join(self.root, 'link.txt'))
+        os.symlink(os.path.join(self.root, 'd0'),
+                   os.path.join(self.root, 'dirlink'))
+        self.age_dirs()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def write(self, path):
+        path = os.path.join(self.root, *path.split('/'))
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as fobj:
+            fobj.write(path)
+
+    def age_dirs(self):
+        """Backdate every directory's mtime so listings can be trusted"""
+        for dirpath, _, _ in os.walk(self.root):
+            os.utime(dirpath, (1000000000, 1000000000))
+
+    def scan(self, scanner):
+        return sorted((x.path, x.size) for _, x in scanner.scan([self.root]))
+
+    def test_matches_walk(self):
+        """Test that results match the serial os.walk scan"""
+        walked = FileCatalog([self.root])
+        walked.rescan()
+        self.assertEqual(self.scan(ShareScanner()),
+                         sorted((x.path, x.size) for x in walked))
+        self.assertIn('link.txt', walked)
+        self.assertNotIn('dirlink/top.txt', walked)
+
+    def test_per_device_limit(self):
+        """Test that concurrency on one device is bounded"""
+        scanner = CountingScanner(max_workers=8, per_device=2)
+        self.scan(scanner)
+        self.assertEqual(scanner.peak, 2)
+
+    def test_skip_unchanged(self):
+        """Test that directories with unchanged mtimes aren't relisted"""
+        scanner = ShareScanner()
+        first = self.scan(scanner)
+        self.assertEqual((scanner.listed, scanner.reused), (17, 0))
+        self.assertEqual(self.scan(scanner), first)
+        self.assertEqual((scanner.listed, scanner.reused), (0, 17))
+
+        self.write('d2/s1/new.txt')
+        second = self.scan(scanner)
+        self.assertEqual(len(second), len(first) + 1)
+        self.assertEqual((scanner.listed, scanner.reused), (1, 16))
+        self.assertEqual(self.scan(scanner), second)
+        self.assertEqual(scanner.listed, 1,
+                "Recently modified directories must not be trusted yet")
+
+        shutil.rmtree(os.path.join(self.root, 'd3'))
+        self.assertEqual(len(self.scan(scanner)), len(second) - 4)
+
+    def test_missing_root(self):
+        """Test that an unreadable root is skipped"""
+        scanner = ShareScanner()
+        results = list(scanner.scan([os.path.join(self.root, 'nope'),
+                                     os.path.join(self.root, 'd1')]))
+        self.assertEqual(set(x for x, _ in results), set([1]))
+        self.assertEqual(len(results), 4)
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Test Suite for the trigram search index for SnakeByte FServe"""
+
+__author__  = "Stephan Sokolow (deitarion/SSokolow)"
+__license__ = "GNU GPL 3.0 or later"
+__docformat__ = "restructuredtext en"
+
+import logging, os, random, shutil, sys, tempfile
+log = logging.getLogger(__name__)
+
+if sys.version_info[0] == 2 and sys.version_info[1] < 7:  # pragma: no cover
+    import unittest2 as unittest
+    unittest  # Silence erroneous PyFlakes warning
+else:                                                     # pragma: no cover
+    import unittest
+
+from snakebyte.catalog import FileCatalog
+from snakebyte.commands import compile_commands
+from snakebyte.search import SuggestingArgTest, TrigramIndex, trigrams
+from snakebyte.shell_lexers import ARG_PREFIX, CachingLexer, smart_lexer
+
+class TestTrigramIndex(unittest.TestCase):
+    """Test substring and fuzzy queries"""
+    paths = ['Anime/Cowboy Bebop 01.mkv', 'Anime/Cowboy Bebop 02.mkv',
+             'Books/The Hobbit.epub', 'Books/Hobbit Companion.pdf',
+             'Music/Bebop Jazz.flac', 'ab']
+
+    def setUp(self):
+        self.index = TrigramIndex(self.paths)
+
+    def test_trigrams(self):
+        """Test trigram extraction"""
+        self.assertEqual(trigrams('abcd'), set(['abc', 'bcd']))
+        self.assertEqual(trigrams('ab'), set())
+
+    def test_search(self):
+        """Test that substring search matches a linear scan"""
+        for query in ('bebop', 'HOBBIT', 'o', 'ab', '.mkv', 'zzz', '',
+                      'Bebop 03'):
+            self.assertEqual(self.index.search(query),
+                    sorted(x for x in self.paths
+                           if query.lower() in x.lower()), query)
+
+    def test_search_randomized(self):
+        """Test substring search against a linear scan on random data"""
+        rng = random.Random(0)
+        paths = set(''.join(rng.choice('abcd/.') for _ in range(12))
+                    for _ in range(300))
+        index = TrigramIndex(paths, casefold=False)
+        for _ in range(200):
+            query = ''.join(rng.choice('abcd/.') for _ in range(
+                            rng.randint(1, 5)))
+            self.assertEqual(index.search(query),
+                             sorted(x for x in paths if query in x))
+
+    def test_limit(self):
+        """Test that result limits stop the search early"""
+        self.assertEqual(len(self.index.search('bebop', limit=2)), 2)
+        self.assertEqual(len(self.index.search('o', limit=1)), 1)
+
+    def test_fuzzy(self):
+        """Test typo-tolerant ranking"""
+        results = self.index.fuzzy('Cowboy Bebpo 02.mkv')
+        self.assertEqual(results[0][1], 'Anime/Cowboy Bebop 02.mkv')
+        self.assertEqual(results[1][1], 'Anime/Cowboy Bebop 01.mkv')
+        self.assertNotIn('Books/The Hobbit.epub', [x for _, x in results])
+
+        self.assertEqual([x for _, x in self.index.fuzzy('hobit')],
+                ['Books/The Hobbit.epub', 'Books/Hobbit Companion.pdf'])
+        self.assertEqual(self.index.fuzzy('Books/The Hobbit.epub', 1),
+                         [(1.0, 'Books/The Hobbit.epub')])
+        self.assertEqual(self.index.fuzzy('qqqq'), [])
+        self.assertEqual(self.index.fuzzy('hobit', min_score=1.5), [])
+
+    def test_fuzzy_randomized(self):
+        """Test that pruned fuzzy scoring matches scoring every path"""
+        rng = random.Random(0)
+        paths = set(''.join(rng.choice('abcd/.') for _ in range(12))
+                    for _ in range(300))
+        index = TrigramIndex(paths, casefold=False)
+        for _ in range(100):
+            query = ''.join(rng.choice('abcd/.') for _ in range(
+                            rng.randint(3, 10)))
+            grams = trigrams(query)
+            for min_score in (0, 0.3, 0.5, 0.8, 1):
+                expected = sorted((-len(grams & trigrams(x)) / float(
+                        len(grams)), -2.0 * len(grams & trigrams(x)) / (
+                        len(grams) + len(trigrams(x))), x) for x in paths
+                        if grams & trigrams(x) and len(grams & trigrams(x))
+                        >= min_score * len(grams))[:10]
+                self.assertEqual(index.fuzzy(query, 10, min_score),
+                                 [(-x[0], x[2]) for x in expected])
+
+    def test_incremental(self):
+        """Test add/remove and that freed IDs are reused cleanly"""
+        version = self.index.version
+        self.index.remove('Music/Bebop Jazz.flac')
+        self.assertEqual(self.index.search('bebop'),
+                         self.paths[:2])
+        self.index.add('Music/Hard Bop.flac')
+        self.index.add('Music/Hard Bop.flac')
+        self.assertEqual(self.index.search('bop'), self.paths[:2] +
+                         ['Music/Hard Bop.flac'])
+        self.assertEqual(len(self.index), len(self.paths))
+        self.assertEqual(self.index.version, version + 2)
+        self.assertRaises(KeyError, self.index.remove, 'nope')
+
+class TestCatalogIntegration(unittest.TestCase):
+    """Test keeping the index in sync with a catalog and suggesting paths"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        for name in ('Some Show 01.mkv', 'Some Show 02.mkv', 'Other.txt'):
+            self.touch(name)
+        self.catalog = FileCatalog([self.tmpdir])
+        self.catalog.rescan()
+        self.index = TrigramIndex.from_catalog(self.catalog)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def touch(self, name):
+        open(os.path.join(self.tmpdir, name), 'w').close()
+
+    def test_update(self):
+        """Test applying rescan results to the index"""
+        os.remove(os.path.join(self.tmpdir, 'Other.txt'))
+        self.touch('Another.txt')
+        self.index.update(self.catalog.rescan())
+        self.assertEqual(self.index.search('other'), ['Another.txt'])
+        self.assertEqual(len(self.index), len(self.catalog))
+
+    def test_suggesting_arg_test(self):
+        """Test the suggesting ``arg_test_cb`` wrapper"""
+        wrapper = SuggestingArgTest(self.catalog.arg_test_cb, self.index)
+        self.assertTrue(wrapper.prefix_aware)
+        self.assertEqual(wrapper.version, self.catalog.version)
+        self.assertIsNone(SuggestingArgTest(lambda x, y: True,
+                                            self.index).version)
+        self.assertIs(wrapper('Some Sh', []), ARG_PREFIX)
+
+        commands = {'!get': ([], wrapper)}
+        self.assertEqual(smart_lexer('!get Some Show 01.mkv', commands),
+                         ['!get', 'Some Show 01.mkv'])
+        self.assertEqual(wrapper.check('Some Show 01.mkv'), (True, []))
+        truthy = SuggestingArgTest(lambda x, y: 'truthy', self.index)
+        self.assertEqual(truthy.check('anything'), (True, []))
+        accepted, suggestions = wrapper.check('Sme Show 01.mvk')
+        self.assertFalse(accepted)
+        self.assertEqual(suggestions[0], 'Some Show 01.mkv')
+
+        self.assertIs(wrapper.suggest('Sme Show 01.mvk')[0],
+                      suggestions[0], "Suggestions must be cached")
+        self.touch('Sme Show 01.mvk')
+        self.index.update(self.catalog.rescan())
+        self.assertEqual(wrapper.suggest('Sme Show 01.mvk')[0],
+                         'Sme Show 01.mvk')
+
+    def test_caching_lexer_invalidation(self):
+        """Test that wrapped callbacks still invalidate lexer caches"""
+        wrapper = SuggestingArgTest(self.catalog.arg_test_cb, self.index)
+        compiled = compile_commands({'!get': ([], wrapper)})
+        lexer = CachingLexer(smart_lexer)
+        self.assertEqual(lexer('!get New File', compiled),
+                         ['!get', 'New', 'File'])
+        self.touch('New File')
+        self.catalog.rescan()
+        self.assertEqual(lexer('!get New File', compiled),
+                         ['!get', 'New File'])
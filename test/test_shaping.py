@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Test Suite for the bandwidth shaper for SnakeByte FServe"""
+
+__author__  = "Stephan Sokolow (deitarion/SSokolow)"
+__license__ = "GNU GPL 3.0 or later"
+__docformat__ = "restructuredtext en"
+
+import logging, sys
+log = logging.getLogger(__name__)
+
+if sys.version_info[0] == 2 and sys.version_info[1] < 7:  # pragma: no cover
+    import unittest2 as unittest
+    unittest  # Silence erroneous PyFlakes warning
+else:                                                     # pragma: no cover
+    import unittest
+
+from snakebyte.shaping import BandwidthShaper
+
+class FakeClock(object):
+    """A clock which only moves when told to"""
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+class TestBandwidthShaper(unittest.TestCase):
+    """Test hierarchical token-bucket shaping"""
+
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def make(self, **kwargs):
+        kwargs.setdefault('burst', 1.0)
+        return BandwidthShaper(tick=0.1, clock=self.clock, **kwargs)
+
+    def drain(self, shaper, slots, seconds, want=100000):
+        """Greedily request bytes for each slot in turn, 0.1s at a time.
+
+        :returns: A dict of total bytes granted per slot.
+        """
+        totals = dict((x, 0) for x in slots)
+        for _ in range(int(seconds * 10)):
+            self.clock.now += 0.1
+            for slot in slots:
+                totals[slot] += shaper.grant(slot, want)
+        return totals
+
+    def test_unlimited(self):
+        """Test that a shaper with no limits grants everything"""
+        shaper = self.make()
+        shaper.register('a', 'alice')
+        self.assertEqual(shaper.grant('a', 12345), 12345)
+        self.assertRaises(KeyError, shaper.grant, 'b', 1)
+
+    def test_global_fair_between_buckets(self):
+        """Test that the global rate is split per bucket, not per slot"""
+        shaper = self.make(global_rate=1000)
+        for slot, key in (('a1', 'alice'), ('a2', 'alice'), ('b1', 'bob')):
+            shaper.register(slot, key)
+        totals = self.drain(shaper, ['a1', 'a2', 'b1'], 10)
+
+        self.assertLessEqual(sum(totals.values()), 1000 * 11)
+        self.assertAlmostEqual(totals['a1'] + totals['a2'], totals['b1'],
+                               delta=1000)
+
+    def test_slot_and_bucket_caps(self):
+        """Test per-slot and per-bucket ceilings"""
+        shaper = self.make(bucket_rate=300, slot_rate=200)
+        for slot, key in (('a1', 'alice'), ('a2', 'alice'), ('b1', 'bob')):
+            shaper.register(slot, key)
+        totals = self.drain(shaper, ['a1', 'a2', 'b1'], 10)
+
+        self.assertLessEqual(totals['a1'] + totals['a2'], 300 * 11)
+        self.assertGreaterEqual(totals['a1'] + totals['a2'], 300 * 9)
+        self.assertLessEqual(totals['b1'], 200 * 11)
+        self.assertGreaterEqual(totals['b1'], 200 * 9)
+
+    def test_borrowing(self):
+        """Test that capacity a capped bucket can't use is lent out"""
+        shaper = self.make(global_rate=1000, slot_rate=100)
+        shaper.register('a', 'alice')
+        shaper.register('b', 'bob')
+        shaper.slot_rate = None
+        shaper.register('c', 'carol')
+        totals = self.drain(shaper, ['a', 'b', 'c'], 10)
+
+        self.assertLessEqual(sum(totals.values()), 1000 * 11)
+        self.assertGreater(totals['c'], 1000 * 6,
+                "Carol must borrow what Alice and Bob can't use")
+
+    def test_many_buckets_low_rate(self):
+        """Test that fractional shares aren't lost when they're tiny"""
+        shaper = self.make(global_rate=300)
+        slots = ['s%d' % x for x in range(20)]
+        for slot in slots:
+            shaper.register(slot, slot)
+        totals = self.drain(shaper, slots, 10)
+
+        # Each bucket only earns 1.5 bytes per tick
+        self.assertLessEqual(sum(totals.values()), 300 * 11)
+        self.assertGreaterEqual(sum(totals.values()), 300 * 9)
+
+    def test_refund_and_unregister(self):
+        """Test returning unused grants and releasing shares"""
+        shaper = self.make(global_rate=1000, slot_rate=500)
+        shaper.register('a', 'alice')
+        self.clock.now += 0.5
+        granted = shaper.grant('a', 10000)
+        self.assertEqual(granted, 500)
+        shaper.refund('a', 200)
+        self.assertEqual(shaper.grant('a', 10000), 200)
+
+        shaper.register('b', 'bob')
+        shaper.unregister('a')
+        self.assertEqual(len(shaper), 1)
+        self.clock.now += 1
+        self.assertEqual(shaper.grant('b', 10000), 500)
@@ -11,7 +11,7 @@ __author__  = "Stephan Sokolow (deitarion/SSokolow)"
 __license__ = "GNU GPL 3.0 or later"
 __docformat__ = "restructuredtext en"
 
-import logging, sys
+import logging, random, shlex, sys
 log = logging.getLogger(__name__)
 
 if sys.version_info[0] == 2 and sys.version_info[1] < 7:  # pragma: no cover
@@ -20,7 +20,9 @@ if sys.version_info[0] == 2 and sys.version_info[1] < 7:  # pragma: no cover
 else:                                                     # pragma: no cover
     import unittest
 
-from snakebyte.shell_lexers import LexerInterface, mirc_lexer, posix_lexer
+from snakebyte.shell_lexers import (ARG_PREFIX, LEXERS, CachingLexer,
+                                    LexerInterface, SmartLexer, get_lexer,
+                                    mirc_lexer, posix_lexer, smart_lexer)
 
 class TestLexerInterface(unittest.TestCase):
     """Test that the lexer interface is accurately unimplemented."""
@@ -147,6 +149,40 @@ class TestPosixLexer(unittest.TestCase):
         # In POSIX rules, can't even quote a quote inside single quotes
         self.assertRaises(ValueError, posix_lexer, r"'\''", {})
 
+    def test_shlex_equivalence(self):
+        """Test that POSIX lexer matches shlex.split() output and errors"""
+        for inStr in list(self.test_pairs) + [
+                '"a\\', '"a\\"', 'a\\', "'a", '"a', "a'b'\\ c\td",
+                'x\x0by\xa0z', '"\\a\\\\" \'\\\'b', ' \t\r\n ']:
+            try:
+                expected = shlex.split(inStr)
+            except ValueError as err:
+                self.assertRaises(ValueError, posix_lexer, inStr, {})
+                try:
+                    posix_lexer(inStr, {})
+                except ValueError as err2:
+                    self.assertEqual(str(err), str(err2),
+                            "Error message for %r must match shlex" % inStr)
+            else:
+                self.assertEqual(posix_lexer(inStr, {}), expected,
+                        "Output for %r must match shlex" % inStr)
+
+    def test_shlex_fuzz(self):
+        """Test that POSIX lexer matches shlex.split() on random input"""
+        rng, pool = random.Random(0), u'ab \t\r\n\x0b\xa0"\'\\#'
+        for _ in range(2000):
+            inStr = u''.join(rng.choice(pool)
+                             for _ in range(rng.randint(0, 12)))
+            try:
+                expected = shlex.split(inStr)
+            except ValueError as err:
+                expected = str(err)
+            try:
+                actual = posix_lexer(inStr, {})
+            except ValueError as err:
+                actual = str(err)
+            self.assertEqual(actual, expected, "Mismatch for %r" % inStr)
+
     def test_ignore_hints(self):
         """Test that POSIX lexer ignores any provided hints"""
         for inStr, outList in self.test_pairs.items():
@@ -156,3 +192,184 @@ class TestPosixLexer(unittest.TestCase):
         """Test that POSIX lexer exposes a name properly"""
         self.assertEqual(posix_lexer.name, 'posix',
                 "Classes or functions, lexers require a 'name' member.")
+
+class TestSmartLexer(unittest.TestCase):
+    """Test that the smart lexer follows hints without being gullible."""
+
+    files = ['My File.bin', "The O'Neill story.txt", 'A  B C', 'A', '-v']
+
+    def setUp(self):
+        self.calls = []
+
+    def arg_test_cb(self, candidate_str, argv):
+        """Plain callback which records how often it gets called"""
+        self.calls.append(candidate_str)
+        return candidate_str in self.files
+
+    def prefix_test_cb(self, candidate_str, argv):
+        """Prefix-aware callback which records how often it gets called"""
+        self.calls.append(candidate_str)
+        if candidate_str in self.files:
+            return True
+        elif [x for x in self.files if x.startswith(candidate_str)]:
+            return ARG_PREFIX
+        return False
+    prefix_test_cb.prefix_aware = True
+
+    def hints(self, cb):
+        """Build a ``commands`` dict using the given callback"""
+        return {'get': (['-v', 2, None], cb), 'ls': (['-l'], None)}
+
+    def test_posix_fallback(self):
+        """Test that smart lexer behaves like POSIX lexer without hints"""
+        for inStr, outList in TestPosixLexer.test_pairs.items():
+            self.assertEqual(smart_lexer(inStr, {}), outList)
+            self.assertEqual(smart_lexer(inStr, self.hints(None)), outList)
+        self.assertEqual(smart_lexer(None, {}), [])
+        self.assertEqual(smart_lexer('ls My File.bin', self.hints(None)),
+                ['ls', 'My', 'File.bin'])
+        self.assertRaises(ValueError, smart_lexer,
+                "ls The O'Neill story.txt", self.hints(self.arg_test_cb))
+
+    def test_joining(self):
+        """Test that smart lexer joins unquoted arguments when valid"""
+        for cb in (self.arg_test_cb, self.prefix_test_cb):
+            commands = self.hints(cb)
+            self.assertEqual(smart_lexer('get My File.bin -v', commands),
+                    ['get', 'My File.bin', '-v'])
+            self.assertEqual(smart_lexer('get x A  B C A B', commands),
+                    ['get', 'x', 'A  B C', 'A', 'B'],
+                    "Joined arguments must preserve original whitespace")
+            self.assertEqual(smart_lexer("get The O'Neill story.txt",
+                commands), ['get', "The O'Neill story.txt"],
+                "Unbalanced quotes must fall back to whitespace splitting")
+            for bad in ("get The O'Neill", "get The O'Neill story.txt x\"",
+                        "get x \\"):
+                self.assertRaises(ValueError, smart_lexer, bad, commands)
+            self.assertEqual(smart_lexer('get "My" File.bin', commands),
+                    ['get', 'My', 'File.bin'],
+                    "Quoted tokens must never be joined with neighbours")
+            self.assertEqual(smart_lexer('get "My File.bin" A', commands),
+                    ['get', 'My File.bin', 'A'])
+
+    def test_callback_bounds(self):
+        """Test that smart lexer doesn't call arg_test_cb N**2 times"""
+        words = 200
+        cmd_string = 'get ' + ' '.join(['x'] * words)
+
+        smart_lexer(cmd_string, self.hints(self.prefix_test_cb))
+        self.assertEqual(len(self.calls), words,
+                "Prefix-aware callbacks must stop at the first dead end")
+
+        self.calls = []
+        SmartLexer(max_words=4)(cmd_string, self.hints(self.arg_test_cb))
+        self.assertTrue(len(self.calls) <= words * 3,
+                "Plain callbacks must be bounded by max_words")
+
+    def test_registration(self):
+        """Test that smart lexer is registered and exposes a name"""
+        self.assertEqual(smart_lexer.name, 'smart',
+                "Classes or functions, lexers require a 'name' member.")
+        self.assertIn(smart_lexer, LEXERS)
+        self.assertIs(get_lexer('smart'), smart_lexer)
+        self.assertRaises(KeyError, get_lexer, 'nonexistant')
+        self.assertFalse(ARG_PREFIX, "ARG_PREFIX must evaluate as False")
+
+class TestCachingLexer(unittest.TestCase):
+    """Test that the caching wrapper is transparent but effective."""
+
+    class Versioned(dict):
+        """A ``commands`` table with a version number"""
+        version = 0
+
+    def setUp(self):
+        self.calls = []
+        self.lexer = CachingLexer(self.counting_lexer, maxsize=2)
+
+    def counting_lexer(self, cmd_string, commands):
+        """Wrap `posix_lexer` and record each call"""
+        self.calls.append(cmd_string)
+        return posix_lexer(cmd_string, commands)
+    counting_lexer.name = 'counting'
+
+    def test_transparency(self):
+        """Test that cached results match uncached ones"""
+        lexer, commands = CachingLexer(posix_lexer), {}
+        self.assertEqual(lexer.name, 'cached-posix')
+        for inStr, outList in TestPosixLexer.test_pairs.items():
+            for _ in range(2):
+                self.assertEqual(lexer(inStr, commands), outList)
+        self.assertEqual(lexer.hits, len(TestPosixLexer.test_pairs))
+        self.assertEqual(lexer.misses, len(TestPosixLexer.test_pairs))
+
+        for _ in range(2):
+            self.assertRaises(ValueError, lexer, "The O'Neill story.txt",
+                              commands)
+
+    def test_fresh_lists(self):
+        """Test that mutating a returned argv doesn't poison the cache"""
+        commands = {}
+        argv = self.lexer('!get foo', commands)
+        argv.append('bar')
+        self.assertEqual(self.lexer('!get foo', commands), ['!get', 'foo'])
+        self.assertEqual(len(self.calls), 1)
+
+    def test_table_identity(self):
+        """Test that different tables never share cached results"""
+        lexer = CachingLexer(smart_lexer, version_cb=lambda commands: None)
+        for pos in range(20):
+            # Freed tables' ids get reused, so this would cross-talk if
+            # entries were keyed on id() alone.
+            accept = bool(pos % 2)
+            commands = {'get': ([], lambda candidate_str, argv: accept)}
+            self.assertEqual(lexer('get a b', commands),
+                    ['get', 'a b'] if accept else ['get', 'a', 'b'])
+            del commands
+        self.assertEqual(lexer.hits, 0)
+
+    def test_plain_dicts(self):
+        """Test that unversioned tables are invalidated by their contents"""
+        lexer = CachingLexer(smart_lexer)
+        commands = {'get': ([], None)}
+        self.assertEqual(lexer('get a b', commands), ['get', 'a', 'b'])
+        commands['get'] = ([], lambda candidate_str, argv: True)
+        self.assertEqual(lexer('get a b', commands), ['get', 'a b'])
+        self.assertEqual(lexer('get a b', commands), ['get', 'a b'])
+        self.assertEqual((lexer.hits, lexer.misses), (1, 2))
+
+        commands['get'] = ([['-v']], None)
+        self.assertEqual(lexer('get a b', commands), ['get', 'a', 'b'],
+                "Unhashable tables must be lexed without caching")
+        self.assertEqual((lexer.hits, lexer.misses), (1, 2))
+
+    def test_eviction(self):
+        """Test bounded LRU eviction"""
+        commands = {}
+        for cmd_string in ('a', 'b', 'a', 'c', 'a', 'b'):
+            self.lexer(cmd_string, commands)
+        self.assertEqual(self.calls, ['a', 'b', 'c', 'b'])
+        self.assertEqual((self.lexer.hits, self.lexer.misses), (2, 4))
+
+        self.lexer.clear()
+        self.assertEqual((self.lexer.hits, self.lexer.misses), (0, 0))
+        self.lexer('a', commands)
+        self.assertEqual(self.calls[-1], 'a')
+
+    def test_versioning(self):
+        """Test that changing the commands table invalidates results"""
+        class Owner(object):
+            """Stand-in for a file catalog"""
+            version = 0
+
+            def arg_test_cb(self, candidate_str, argv):
+                return True
+
+        owner, versioned = Owner(), self.Versioned()
+        for commands, source in (({'!get': ([], owner.arg_test_cb)}, owner),
+                                 (versioned, versioned)):
+            self.calls = []
+            self.lexer('!get foo', commands)
+            self.lexer('!get foo', commands)
+            source.version = 1
+            self.lexer('!get foo', commands)
+            self.assertEqual(len(self.calls), 2)
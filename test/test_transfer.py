@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Test Suite for the DCC transfer engine for SnakeByte FServe"""
+
+__author__  = "Stephan Sokolow (deitarion/SSokolow)"
+__license__ = "GNU GPL 3.0 or later"
+__docformat__ = "restructuredtext en"
+
+import hashlib, logging, os, shutil, socket, struct, sys, tempfile, threading
+from concurrent.futures import ThreadPoolExecutor
+log = logging.getLogger(__name__)
+
+if sys.version_info[0] == 2 and sys.version_info[1] < 7:  # pragma: no cover
+    import unittest2 as unittest
+    unittest  # Silence erroneous PyFlakes warning
+else:                                                     # pragma: no cover
+    import unittest
+
+from snakebyte.hashcache import HashCache
+from snakebyte.popularity import Prefetcher
+from snakebyte.queue import FairQueue
+from snakebyte.resume import ResumeEntry, ResumeStore
+from snakebyte.shaping import BandwidthShaper
+from snakebyte.transfer import (TransferEngine, format_dcc_accept,
+                                format_dcc_send, parse_dcc_resume)
+
+class DCCClient(threading.Thread):
+    """A minimal DCC receiver which acknowledges every read"""
+
+    def __init__(self, port, size, ack_size=4, stop_after=None,
+                 resume_from=b''):
+        super(DCCClient, self).__init__()
+        self.daemon = True
+        self.port, self.size, self.ack_size = port, size, ack_size
+        self.stop_after = stop_after
+        self.received = bytearray(resume_from)
+
+    def run(self):
+        sock = socket.create_connection(('127.0.0.1', self.port))
+        pending = b''
+        while len(self.received) < self.size:
+            data = sock.recv(8192)
+            if not data:
+                break
+            self.received += data
+            if self.stop_after and len(self.received) >= self.stop_after:
+                break
+
+            # Deliberately split ACKs across writes to exercise reassembly
+            pending += struct.pack('!I', len(self.received))
+            while len(pending) >= self.ack_size:
+                sock.sendall(pending[:self.ack_size])
+                pending = pending[self.ack_size:]
+        if pending and not self.stop_after:
+            sock.sendall(pending)
+        if not self.stop_after:
+            sock.recv(1)  # Wait for the sender to hang up
+        sock.close()
+
+class TestTransferEngine(unittest.TestCase):
+    """Test DCC SENDs end to end over loopback"""
+    size = 300000
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.data = os.urandom(self.size)
+        self.paths = []
+        for name in ('a.bin', 'b.bin', 'empty.bin'):
+            path = os.path.join(self.tmpdir, name)
+            with open(path, 'wb') as fobj:
+                fobj.write(b'' if name.startswith('empty') else self.data)
+            self.paths.append(path)
+
+        self.queue = FairQueue()
+        self.clients, self.done = [], []
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def offer(self, transfer, **kwargs):
+        """Connect a client as soon as the listener is announced"""
+        client = DCCClient(transfer.port, transfer.size, **kwargs)
+        client.start()
+        self.clients.append(client)
+
+    def make_engine(self, **kwargs):
+        """Build an engine wired up to the test's callbacks"""
+        kwargs.setdefault('offer_cb', self.offer)
+        return TransferEngine(self.queue, host='127.0.0.1',
+                done_cb=self.done.append, chunk_size=16384, **kwargs)
+
+    def check_success(self, engine):
+        """Run the engine and verify every file arrived intact"""
+        engine.run_until_idle(timeout=0.1)
+        for client in self.clients:
+            client.join(5)
+            self.assertEqual(bytes(client.received),
+                             self.data[:client.size])
+        self.assertEqual([x.error for x in self.done],
+                         [None] * len(self.done))
+        self.assertFalse(engine.transfers)
+
+    def test_sendfile(self):
+        """Test transfers using os.sendfile"""
+        self.queue.extend('alice', self.paths)
+        self.queue.push('bob', self.paths[0])
+        self.check_success(self.make_engine())
+        self.assertEqual(len(self.done), 4)
+        self.assertEqual(sorted(x.bytes_sent for x in self.done),
+                         [0, self.size, self.size, self.size])
+
+    def test_buffered(self):
+        """Test transfers using the reusable buffer fallback"""
+        self.queue.extend('alice', self.paths[:2])
+        self.check_success(self.make_engine(use_sendfile=False, slots=1))
+        self.assertEqual(len(self.done), 2)
+
+    def test_hashes(self):
+        """Test that transfers are given checksums from a hash cache"""
+        self.queue.push('alice', self.paths[0])
+        with ThreadPoolExecutor(1) as executor:
+            engine = self.make_engine(hash_cache=HashCache(executor=executor))
+            self.check_success(engine)
+            self.assertEqual(self.done[0].hashes.result(10).md5,
+                             hashlib.md5(self.data).hexdigest())
+
+    def test_split_acks(self):
+        """Test reassembly of acknowledgements split across reads"""
+        self.queue.push('alice', self.paths[0])
+        engine = self.make_engine(
+                offer_cb=lambda x: self.offer(x, ack_size=3))
+        self.check_success(engine)
+
+    def test_stats_reported(self):
+        """Test that completed transfers are reported to the queue"""
+        self.queue.extend('alice', self.paths[:2])
+        self.queue.push('bob', self.paths[0])
+        self.check_success(self.make_engine(slots=1))
+        self.assertEqual(self.done[0].key, 'alice')
+        self.assertEqual(self.done[0].bytes_sent, self.size)
+
+        queue = FairQueue()
+        queue.extend('alice', ['x', 'y'])
+        queue.pop()
+        queue.record_transfer('alice', self.size, 1.0)
+        self.assertEqual(queue.transfer_stats['alice'][:2], (1, self.size))
+
+    def test_shaped(self):
+        """Test that a shaper limits throughput without corrupting data"""
+        self.queue.push('alice', self.paths[0])
+        self.queue.push('bob', self.paths[1])
+        shaper = BandwidthShaper(global_rate=self.size * 4, burst=0.05)
+        engine = self.make_engine(shaper=shaper, use_sendfile=False)
+        self.check_success(engine)
+        self.assertEqual(len(shaper), 0)
+        self.assertFalse(engine.paused)
+        for transfer in self.done:
+            self.assertGreater(transfer.duration, 0.25,
+                    "Two transfers sharing 4x the file size per second "
+                    "must take about half a second each")
+
+    def test_disconnect(self):
+        """Test that a recipient hanging up early fails the transfer"""
+        self.queue.push('alice', self.paths[0])
+        engine = self.make_engine(
+                offer_cb=lambda x: self.offer(x, stop_after=1))
+        engine.run_until_idle(timeout=0.1)
+        self.assertEqual(len(self.done), 1)
+        self.assertTrue(self.done[0].error)
+        self.assertTrue(self.done[0].acked < self.size)
+
+    def test_accept_timeout(self):
+        """Test that unclaimed offers expire"""
+        self.queue.push('alice', self.paths[0])
+        engine = self.make_engine(offer_cb=None, accept_timeout=0)
+        engine.run_until_idle(timeout=0.01)
+        self.assertEqual(len(self.done), 1)
+        self.assertIn('Timed out', self.done[0].error)
+
+    def test_missing_file(self):
+        """Test that unreadable entries are skipped without stalling"""
+        self.queue.extend('alice', [os.path.join(self.tmpdir, 'nope'),
+                                    self.paths[0]])
+        self.check_success(self.make_engine())
+        self.assertEqual(len(self.done), 1)
+
+    def test_prefetch(self):
+        """Test that upcoming files are prefetched as slots are filled"""
+        self.queue.extend('alice', self.paths[:2])
+        advised = []
+        prefetcher = Prefetcher(self.queue, lookahead=1,
+                advise_cb=lambda *args: advised.append(args) or True)
+        self.check_success(self.make_engine(slots=1, prefetcher=prefetcher))
+        self.assertEqual(advised, [(self.paths[1], 0, prefetcher.length)])
+
+    def test_resume(self):
+        """Test that interrupted transfers are requeued and resumed"""
+        self.queue.push('alice', self.paths[0])
+        store = ResumeStore()
+        engine = self.make_engine(resume_store=store, max_resumes=2)
+        accepts = []
+
+        def offer(transfer):
+            if not transfer.attempts:
+                self.offer(transfer, stop_after=self.size // 3)
+                return
+            offset = transfer.resume_offset
+            self.assertIn(offset, range(1, self.size // 3 + 1))
+            self.assertEqual(store.get('alice', transfer.identity), offset)
+            accepts.append(engine.handle_resume('alice', 'a.bin',
+                                                transfer.port, offset))
+            self.offer(transfer, resume_from=self.data[:offset])
+        engine.offer_cb = offer
+
+        engine.run_until_idle(timeout=0.1)
+        self.clients[-1].join(5)
+        self.assertEqual(bytes(self.clients[-1].received), self.data)
+        self.assertEqual(len(self.done), 2)
+        self.assertTrue(self.done[0].error)
+        self.assertEqual(self.done[1].error, None)
+        self.assertEqual(self.done[1].bytes_sent,
+                         self.size - self.done[1].offset)
+        self.assertEqual(accepts, [format_dcc_accept('a.bin',
+                self.done[1].port, self.done[1].offset)])
+        self.assertEqual(len(store), 0,
+                "Completed transfers must not leave resume records behind")
+
+    def test_resume_limits(self):
+        """Test resume validation and the requeue limit"""
+        engine = self.make_engine(offer_cb=None, max_resumes=1)
+        transfer = engine.start('alice', ResumeEntry(self.paths[0], 100,
+                                (0, 0, 0, 0), 1))
+        self.assertEqual(transfer.resume_offset, 0,
+                "Offsets must not be applied to a file which has changed")
+        self.assertEqual(transfer.attempts, 1)
+
+        self.assertEqual(engine.handle_resume('bob', 'a.bin',
+                                              transfer.port, 5), None)
+        self.assertEqual(engine.handle_resume('alice', 'a.bin',
+                                              transfer.port + 1, 5), None)
+        self.assertEqual(engine.handle_resume('alice', 'a.bin',
+                         transfer.port, self.size + 1), None)
+        self.assertEqual(engine.handle_resume('alice', 'a.bin',
+                         transfer.port, 5), format_dcc_accept('a.bin',
+                         transfer.port, 0),
+                "Partial copies of a changed file must start over")
+        self.assertEqual(transfer.offset, 0)
+
+        transfer.acked, transfer.position = 5000, 8000
+        engine._finish(transfer, "Dropped")
+        self.assertFalse(self.queue, "Requeue limit must be enforced")
+
+        transfer = engine.start('alice', ResumeEntry(self.paths[0], 100,
+                                transfer.identity, 0))
+        self.assertEqual(transfer.resume_offset, 100)
+        self.assertEqual(engine.handle_resume('alice', 'a.bin',
+                         transfer.port, 150), format_dcc_accept('a.bin',
+                         transfer.port, 100),
+                "Resumes must not start past the acknowledged offset")
+        self.assertEqual(engine.handle_resume('alice', 'a.bin',
+                         transfer.port, 50), format_dcc_accept('a.bin',
+                         transfer.port, 50))
+        transfer.acked, transfer.position = 5000, 8000
+        engine.close()
+        self.assertEqual(self.queue.pop(), ('alice', ResumeEntry(
+                self.paths[0], 5000, transfer.identity, 1)))
+
+    def test_acked_position(self):
+        """Test unwrapping of 32-bit acknowledgements"""
+        engine = self.make_engine(offer_cb=None)
+        transfer = engine.start('alice', self.paths[0])
+        transfer.position, transfer.acked = 2 ** 32 + 10, 5
+        self.assertEqual(transfer.acked_position, 2 ** 32 + 5)
+        transfer.position, transfer.acked = 2 ** 32 + 10, 2 ** 32 - 5
+        self.assertEqual(transfer.acked_position, 2 ** 32 - 5)
+        transfer.offset, transfer.acked = 2 ** 32 + 10, 0
+        self.assertEqual(transfer.acked_position, 2 ** 32 + 10)
+        engine.close()
+
+    def test_dcc_resume_messages(self):
+        """Test DCC RESUME parsing and DCC ACCEPT formatting"""
+        self.assertEqual(parse_dcc_resume('\x01DCC RESUME a.txt 1024 5\x01'),
+                         ('a.txt', 1024, 5))
+        self.assertEqual(parse_dcc_resume('DCC RESUME "a b.txt" 1 2'),
+                         ('a b.txt', 1, 2))
+        for bad in ('DCC SEND a.txt 1 2 3', 'DCC RESUME a.txt 1',
+                    'DCC RESUME a.txt x 2', 'DCC'):
+            self.assertEqual(parse_dcc_resume(bad), None)
+        self.assertEqual(format_dcc_accept('a b.txt', 1024, 5),
+                         '\x01DCC ACCEPT "a b.txt" 1024 5\x01')
+
+    def test_format_dcc_send(self):
+        """Test CTCP offer formatting"""
+        self.assertEqual(format_dcc_send('a b.txt', '127.0.0.1', 1024, 5),
+                '\x01DCC SEND "a b.txt" 2130706433 1024 5\x01')
+        self.assertEqual(format_dcc_send('a.txt', '0.0.0.1', 1, 0),
+                '\x01DCC SEND a.txt 1 1 0\x01')